@@ -2,10 +2,12 @@ from flask import Flask
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import logging
-from dlapi.managers import SessionManager, RDManager, JDownloadManager, StateManager
+from dlapi.managers import SessionManager, MemorySessionStore, SQLiteSessionStore, RDManager, JDownloadManager, JDownloadBatcher, StateManager, RDPoller, LinkCache, MagnetResolver, JackettManager, LeaderElection
 import os
+from datetime import datetime
 from flask_cors import CORS
 from flask_apscheduler import APScheduler
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 CORS(app)
@@ -19,25 +21,107 @@ app.logger.setLevel(logger.level)
 limiter = Limiter(app, key_func=get_remote_address)
 
 # Managers
-session_manager = SessionManager(int(os.environ['SESSION_EXPIRY_DAYS']) if 'SESSION_EXPIRY_DAYS' in os.environ else 1)
-jdownload_manager = JDownloadManager(os.environ['JD_USER'], os.environ['JD_PASS'], os.environ['JD_DEVICE'], logger)
-real_debrid_manager = RDManager(os.environ['RD_KEY'], logger, jdownload_manager)
 state_manager = StateManager("./dlconfig/state.db")
 
+# Sessions are kept in memory unless they need to be shared between gunicorn workers.
+if 'SESSION_BACKEND' in os.environ and os.environ['SESSION_BACKEND'].lower() == 'sqlite':
+    session_store = SQLiteSessionStore(state_manager)
+else:
+    session_store = MemorySessionStore()
+session_manager = SessionManager(int(os.environ['SESSION_EXPIRY_DAYS']) if 'SESSION_EXPIRY_DAYS' in os.environ else 1,
+    session_store, float(os.environ['SESSION_CACHE_TTL']) if 'SESSION_CACHE_TTL' in os.environ else 30)
+jdownload_manager = JDownloadManager(os.environ['JD_USER'], os.environ['JD_PASS'], os.environ['JD_DEVICE'], logger,
+    float(os.environ['JD_SESSION_TTL']) if 'JD_SESSION_TTL' in os.environ else 300)
+jdownload_batcher = JDownloadBatcher(jdownload_manager,
+    float(os.environ['JD_BATCH_WINDOW']) if 'JD_BATCH_WINDOW' in os.environ else 2,
+    int(os.environ['JD_BATCH_SIZE']) if 'JD_BATCH_SIZE' in os.environ else 20, logger)
+
+# The async client is optional as it needs aiohttp.
+if 'RD_CLIENT_MODE' in os.environ and os.environ['RD_CLIENT_MODE'].lower() == 'async':
+    from dlapi.asyncmanagers import AsyncRDManager as RDClient
+else:
+    RDClient = RDManager
+
+# With several gunicorn workers only one runs the background jobs, the rest only serve requests.
+# A single worker runs everything itself and needs no election.
+if 'LEADER_ELECTION' in os.environ:
+    election = os.environ['LEADER_ELECTION'].lower() == 'true'
+else:
+    election = (int(os.environ['WEB_CONCURRENCY']) if 'WEB_CONCURRENCY' in os.environ else 1) > 1
+if election:
+    leader = LeaderElection(state_manager, 'scheduler',
+        float(os.environ['LEADER_LEASE_TTL']) if 'LEADER_LEASE_TTL' in os.environ else 30, logger)
+    run_if_leader = leader.run_if_leader
+else:
+    leader = None
+    run_if_leader = lambda func: func
+
+link_cache = LinkCache(state_manager,
+    int(os.environ['RD_LINK_CACHE_SIZE']) if 'RD_LINK_CACHE_SIZE' in os.environ else 1000,
+    float(os.environ['RD_LINK_TTL']) if 'RD_LINK_TTL' in os.environ else 3 * 60 * 60)
+
+real_debrid_manager = RDClient(os.environ['RD_KEY'], logger, jdownload_batcher,
+    int(os.environ['RD_UNRESTRICT_WORKERS']) if 'RD_UNRESTRICT_WORKERS' in os.environ else 4,
+    int(os.environ['RD_DOWNLOAD_WORKERS']) if 'RD_DOWNLOAD_WORKERS' in os.environ else 2,
+    int(os.environ['RD_POOL_SIZE']) if 'RD_POOL_SIZE' in os.environ else 10,
+    float(os.environ['RD_CONNECT_TIMEOUT']) if 'RD_CONNECT_TIMEOUT' in os.environ else 5,
+    float(os.environ['RD_READ_TIMEOUT']) if 'RD_READ_TIMEOUT' in os.environ else 30,
+    int(os.environ['RD_MAX_RETRIES']) if 'RD_MAX_RETRIES' in os.environ else 3, link_cache, leader)
+
+# Jobs left mid handoff by a process that died are picked up again by the leader, and its submissions
+# are failed as the client may have resubmitted. Work owned by a live process is left alone.
+if leader != None:
+    leader.register_callback(state_manager.recover_abandoned)
+rd_poller = RDPoller(real_debrid_manager, state_manager, logger,
+    float(os.environ['RD_POLL_INTERVAL']) if 'RD_POLL_INTERVAL' in os.environ else 15,
+    float(os.environ['RD_FAST_POLL_INTERVAL']) if 'RD_FAST_POLL_INTERVAL' in os.environ else 5,
+    float(os.environ['RD_MAX_BACKOFF']) if 'RD_MAX_BACKOFF' in os.environ else 300, leader)
+
+# Sessions in memory belong to each worker so every worker expires its own.
+if isinstance(session_store, SQLiteSessionStore):
+    expire_sessions = run_if_leader(session_manager.remove_expired_sessions)
+else:
+    expire_sessions = session_manager.remove_expired_sessions
+
+# Resolves Jackett download links to magnets.
+magnet_resolver = MagnetResolver(int(os.environ['MAGNET_MAX_HOPS']) if 'MAGNET_MAX_HOPS' in os.environ else 5,
+    float(os.environ['MAGNET_TIMEOUT']) if 'MAGNET_TIMEOUT' in os.environ else 10, logger=logger)
+
+# Jackett searches are cached. The module is disabled when jackett is not configured.
+if 'JACKETT_URL' in os.environ and 'JACKETT_API_KEY' in os.environ:
+    jackett_manager = JackettManager(os.environ['JACKETT_URL'], os.environ['JACKETT_API_KEY'],
+        int(os.environ['JACKETT_CACHE_SIZE']) if 'JACKETT_CACHE_SIZE' in os.environ else 100,
+        float(os.environ['JACKETT_CACHE_TTL']) if 'JACKETT_CACHE_TTL' in os.environ else 5 * 60,
+        float(os.environ['JACKETT_STALE_TTL']) if 'JACKETT_STALE_TTL' in os.environ else 60 * 60, logger=logger)
+else:
+    jackett_manager = None
+
+# Pool sending batch and async submissions to RD.
+content_pool = ThreadPoolExecutor(max_workers=int(os.environ['CONTENT_WORKERS']) if 'CONTENT_WORKERS' in os.environ else 4,
+    thread_name_prefix='content')
+
 # Configuration object for scheduling update
 class Config(object):
     JOBS = [
         {
-            'id': 'RDListener',
-            'func': real_debrid_manager.rd_listener,
+            'id': 'SessionManager',
+            'func': expire_sessions,
+            'args': (),
+            'trigger': 'interval',
+            'seconds': 60 * 60
+        },
+        {
+            'id': 'RDIndex',
+            'func': run_if_leader(real_debrid_manager.index_account),
             'args': (state_manager,),
             'trigger': 'interval',
-            'seconds': 15
+            'seconds': int(os.environ['RD_INDEX_INTERVAL']) if 'RD_INDEX_INTERVAL' in os.environ else 6 * 60 * 60,
+            'next_run_time': datetime.now()
         },
         {
-            'id': 'SessionManager',
-            'func': session_manager.remove_expired_sessions,
-            'args': (),
+            'id': 'RDJobPurge',
+            'func': run_if_leader(real_debrid_manager.purge_jobs),
+            'args': (state_manager,),
             'trigger': 'interval',
             'seconds': 60 * 60
         }
@@ -45,11 +129,27 @@ class Config(object):
 
     SCHEDULER_API_ENABLED = True
 
-# Scheduling
+# Scheduling. The leader is known before the first jobs run. Without an election everything left over
+# belongs to a previous run of this process and is recovered once.
+if leader != None:
+    Config.JOBS.append({
+        'id': 'RecoverAbandoned',
+        'func': leader.run_if_leader(state_manager.recover_abandoned),
+        'args': (),
+        'trigger': 'interval',
+        'seconds': 60
+    })
+    leader.start()
+else:
+    state_manager.recover_abandoned()
+
 app.config.from_object(Config())
 scheduler = APScheduler()
 scheduler.init_app(app)
 scheduler.start()
 
+# The RD listener runs on the adaptive poller rather than a fixed interval job.
+rd_poller.start()
+
 
 from dlapi import views
\ No newline at end of file
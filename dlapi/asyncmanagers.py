@@ -0,0 +1,245 @@
+from dlapi.managers import RDManager, StateManager
+import concurrent.futures
+import asyncio
+import aiohttp
+import requests
+import threading
+import logging
+
+class AsyncResponse():
+    """
+    Response read from aiohttp. This is more of a struct with the fields the
+    RDManager parsers use from a requests response.
+    Attributes:
+        status_code: The HTTP status code
+        headers: The response headers
+        text: The response body
+    """
+
+    def __init__(self, status_code: int, headers, text: str):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+class AsyncRDManager(RDManager):
+    """
+    Manager for RealDebrid communication running all RD calls on a single asyncio event loop.
+    The blocking RDManager methods are kept as wrappers so the Flask views can keep calling them.
+    Attributes:
+        _loop: The event loop every RD call runs on
+        _client: The aiohttp session, created on the loop
+        _unrestrict_limit: Semaphore bounding the number of concurrent unrestricts
+        _download_limit: Semaphore bounding the number of concurrent downloads
+    """
+
+    """
+    Start the event loop in place of the requests session and worker pools, which are not used here.
+    """
+    def _init_transport(self, unrestrict_workers: int, download_workers: int, pool_size: int):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name='rd-async', daemon=True).start()
+        self._run(self._start(unrestrict_workers, download_workers, pool_size))
+
+    """
+    Create everything that has to live on the event loop.
+    """
+    async def _start(self, unrestrict_workers: int, download_workers: int, pool_size: int):
+        self._unrestrict_limit = asyncio.Semaphore(unrestrict_workers)
+        self._download_limit = asyncio.Semaphore(download_workers)
+        self._client = aiohttp.ClientSession(headers=self._header,
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=self._timeout[0], sock_read=self._timeout[1]))
+
+    """
+    Run a coroutine on the event loop and block until it is done.
+    NOTE: Never call this from the event loop itself.
+    """
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    """
+    Close the aiohttp session and stop the event loop.
+    """
+    def close(self):
+        self._run(self._client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    """
+    Send a request to RD on the event loop. Same retry and backoff rules as RDManager._request.
+    Only failures to connect count as connect errors for a POST, timeouts are not retried.
+    returns: An AsyncResponse. Retryable responses are returned once out of retries.
+    raises: aiohttp.ClientError or asyncio.TimeoutError when the last attempt fails to connect
+    """
+    async def _request_async(self, method: str, endpoint: str, **kwargs) -> AsyncResponse:
+
+        # The session carries the timeouts.
+        kwargs.pop('timeout', None)
+        retry_statuses = self._retry_statuses(method)
+        attempt = 0
+        while True:
+            wait = self._rate_limiter.try_acquire()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._rate_limiter.try_acquire()
+
+            retry_after = None
+            try:
+                async with self._client.request(method, self._server + endpoint, **kwargs) as resp:
+                    req = AsyncResponse(resp.status, resp.headers.copy(), await resp.text())
+                if req.status_code not in retry_statuses or attempt >= self._max_retries:
+                    return req
+                retry_after = req.headers.get('Retry-After')
+                self._logger.debug("RD returned %d for %s, retrying." % (req.status_code, endpoint))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self._max_retries or (method == 'POST' and not isinstance(e, aiohttp.ClientConnectorError)):
+                    raise
+                self._logger.debug("Request to RD for %s failed, retrying. %s" % (endpoint, str(e)))
+
+            await asyncio.sleep(self._backoff(attempt, retry_after))
+            attempt += 1
+
+    """
+    Blocking wrapper around _request_async. aiohttp errors are raised as their requests
+    equivalents so the RDManager error handling works unchanged.
+    """
+    def _request(self, method: str, endpoint: str, **kwargs) -> AsyncResponse:
+        try:
+            return self._run(self._request_async(method, endpoint, **kwargs))
+        except asyncio.TimeoutError as e:
+            raise requests.exceptions.Timeout(str(e))
+        except aiohttp.ClientError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+    async def get_rd_download_urls_async(self, id: str) -> list:
+        return self._parse_download_urls(await self._request_async('GET', "torrents/info/%s" % id))
+
+    async def _unrestrict_link_async(self, link: str) -> tuple:
+        async with self._unrestrict_limit:
+            try:
+                req = await self._request_async('POST', "unrestrict/link", data={'link': link})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                return (False, "Failed to unrestrict %s: %s" % (link, str(e)))
+
+        return self._parse_unrestrict(link, req)
+
+    """
+    Unrestrict RD hoster links concurrently, bounded by the unrestrict semaphore.
+    Links still in the link cache are not sent to RD again.
+    returns: A list of (bool, download url/error) tuples in the same order as links
+    """
+    async def unrestrict_links_async(self, links: list) -> list:
+        # The link cache reads and writes sqlite so it is used off the loop.
+        cached, missing = await self._loop.run_in_executor(None, self._cached_unrestricts, links)
+        results = dict(zip(missing, await asyncio.gather(*[self._unrestrict_link_async(link) for link in missing])))
+        return await self._loop.run_in_executor(None, self._merge_unrestricts, links, cached, results)
+
+    def unrestrict_links(self, links: list) -> list:
+        return self._run(self.unrestrict_links_async(links))
+
+    async def submit_download_async(self, id: str, path: str) -> concurrent.futures.Future:
+        urls = await self.get_rd_download_urls_async(id)
+        download_urls, error = self._successful_downloads(id, urls, await self.unrestrict_links_async(urls))
+        if error != None:
+            return self._failed_handoff(error)
+
+        # myjdapi is blocking so the handoff runs off the loop.
+        return await self._loop.run_in_executor(None, self.jdownloader.submit, download_urls, path)
+
+    def submit_download(self, id: str, path: str) -> concurrent.futures.Future:
+        return self._run(self.submit_download_async(id, path))
+
+    async def download_id_async(self, id: str, path: str) -> dict:
+        return await asyncio.wrap_future(await self.submit_download_async(id, path))
+
+    def download_id(self, id: str, path: str) -> dict:
+        return self._run(self.download_id_async(id, path))
+
+    """
+    Run a claimed job on the event loop.
+    """
+    def _start_job(self, id: str, path: str, attempts: int, state_manager: StateManager):
+        asyncio.run_coroutine_threadsafe(self._run_job_async(id, path, attempts, state_manager), self._loop)
+
+    async def _run_job_async(self, id: str, path: str, attempts: int, state_manager: StateManager):
+        try:
+            async with self._download_limit:
+                handoff = await self.submit_download_async(id, path)
+        except Exception as e:
+            self._logger.exception("Failed to download id: %s, path: %s" % (id, path))
+            handoff = self._failed_handoff(str(e))
+
+        # The job table is sqlite so it is updated off the loop.
+        await self._loop.run_in_executor(None, self._await_handoff, id, path, attempts, handoff, state_manager)
+
+    """
+    Select all files for the given id without waiting for RD to answer.
+    """
+    def _select_files_for_torrent(self, id: str):
+        asyncio.run_coroutine_threadsafe(self._select_files_async(id), self._loop)
+
+    async def _select_files_async(self, id: str):
+        try:
+            await self._request_async('POST', "torrents/selectFiles/" + id, data={'files': 'all'})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._logger.warning("Failed to select files for torrent with id: %s. %s" % (id, str(e)))
+
+    async def _fetch_torrents_by_page_async(self, watched: dict, listed: list = None) -> list:
+        torrents = []
+        remaining = set(watched)
+        page = 1
+        while len(remaining) > 0:
+            req = await self._request_async('GET', "torrents", params={'page': page, 'limit': RDManager.PAGE_SIZE})
+            items = self._parse_torrent_list(req)
+            if items == None:
+                return None
+
+            if not self._add_page(items, req, remaining, torrents, listed):
+                break
+            page += 1
+
+        return torrents
+
+    """
+    Get each watched torrent from the info endpoint, all at once.
+    """
+    async def _fetch_torrents_by_id_async(self, watched: dict) -> list:
+        responses = await asyncio.gather(*[self._request_async('GET', "torrents/info/%s" % id) for id in watched])
+        torrents = []
+        for req in responses:
+            ok, file = self._parse_torrent_info(req)
+            if not ok:
+                return None
+            if file != None:
+                torrents.append(file)
+        return torrents
+
+    """
+    Function to check with real debrid to see file status and react accordingly.
+    Runs on the event loop, downloads and file selections are scheduled on the same loop.
+    The state is sqlite so it is read and written off the loop.
+    """
+    async def rd_listener_async(self, state_manager: StateManager) -> bool:
+        open_jobs = await self._loop.run_in_executor(None, self.process_jobs, state_manager)
+        plan = await self._loop.run_in_executor(None, self._start_cycle, state_manager, open_jobs)
+        if plan == None:
+            return True
+        due, progress, watched_count = plan
+
+        listed = []
+        try:
+            if self._choose_strategy(len(due)) == 'info':
+                torrents = await self._fetch_torrents_by_id_async(due)
+            else:
+                torrents = await self._fetch_torrents_by_page_async(due, listed)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self._logger.warning("Failed to get the torrent list from Real-Debrid. Might be polling too fast.")
+            return False
+
+        if torrents == None:
+            return False
+
+        await self._loop.run_in_executor(None, self._finish_cycle, torrents, due, watched_count, state_manager, progress, listed)
+        return True
+
+    def rd_listener(self, state_manager: StateManager) -> bool:
+        return self._run(self.rd_listener_async(state_manager))
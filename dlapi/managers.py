@@ -1,14 +1,27 @@
 from datetime import date, timedelta
 import secrets
-from dlapi.utilclasses import Session, EventDictionary, DictionaryEventType
+from dlapi.utilclasses import Session, EventDictionary, DictionaryEventType, RateLimiter, JobState, SubmissionState, TTLCache
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
 from myjdapi.myjdapi import Jddevice, Myjdapi, MYJDException
 import functools
+from collections.abc import Callable
 from flask import request
 import requests
 import json
 import os
 import logging
 import sqlite3
+import threading
+import random
+import time
+import base64
+import atexit
+import heapq
+import socket
+import hashlib
+from urllib.parse import urlparse, parse_qs, urlencode, urljoin
+from urllib3.exceptions import NewConnectionError
 
 class JDownloadManager():
     """
@@ -17,12 +30,18 @@ class JDownloadManager():
         username: The user's JDownloader username
         password: The user's JDownloader password
         device_name: The device name defined in JDownloader on the client
+        session_ttl: Seconds a verified session is trusted before it is refreshed
+        _verified_at: Time the session last connected or made a successful call, None if never
+        _lock: Lock so parallel downloads do not reconnect at the same time
     """
 
-    def __init__(self, username: str, password: str, device_name: str, logger: logging.Logger = None):
+    def __init__(self, username: str, password: str, device_name: str, logger: logging.Logger = None, session_ttl: float = 300):
         self.username = username
         self.password = password
         self.device_name = device_name
+        self.session_ttl = session_ttl
+        self._verified_at = None
+        self._lock = threading.Lock()
 
         # Use default logger if none is provided.
         if logger == None:
@@ -38,24 +57,86 @@ class JDownloadManager():
     returns: Dictionary 
     """
     def download(self, urls: list, path: str) -> dict:
-        
-        # Check to see if we are connected, if not try to reconnect, and at worse connect from the start.
-        # Documentation on the add_links function is sketchy, so if it works it should return a dictionary.
-        self._restart_session()
+        return self.download_many([(urls, path)])
+
+    """
+    Download the given urls right away. Same call as JDownloadBatcher.submit so the RDManager can use either one.
+    returns: A future that is already done with the download result
+    """
+    def submit(self, urls: list, path: str) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(self.download(urls, path))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    """
+    Download several sets of urls in a single add_links call, one package per entry.
+    entries: List of (urls, path) tuples
+    returns: Dictionary 
+    """
+    def download_many(self, entries: list) -> dict:
+
+        # Reuse the session while it is fresh, otherwise try to reconnect, and at worse connect from the start.
+        if not self.is_session_fresh():
+            self._refresh_session()
 
         # If the device isn't set return {} and try to download it on the next cycle.
         if self.device == None:
             return {}
-        
-        result = self.device.linkgrabber.add_links([{"autostart": True, "links": '\n'.join(urls), "destinationFolder": path + "", "overwritePackagizerRules": True}])
+
+        # Documentation on the add_links function is sketchy, so if it works it should return a dictionary.
+        try:
+            result = self._add_links(entries)
+        except (MYJDException, requests.exceptions.RequestException):
+
+            # The cached session went bad. Reconnect once and try again.
+            self.logger.info("JDownloader session failed, reconnecting.")
+            self._refresh_session(force=True)
+            if self.device == None:
+                return {}
+            try:
+                result = self._add_links(entries)
+            except (MYJDException, requests.exceptions.RequestException) as e:
+                self.logger.error("Failed to send links to JDownloader: %s" % str(e))
+                return {}
 
         # Got a boolean result once so to prevent any incorrect returns I will return {}.
         # This is an issue with myjdapi
         if type(result) != dict:
             return {}
 
+        self._verified_at = time.monotonic()
         return result
 
+    def _add_links(self, entries: list):
+        return self.device.linkgrabber.add_links([{"autostart": True, "links": '\n'.join(urls), "destinationFolder": path + "", "overwritePackagizerRules": True}
+            for urls, path in entries])
+
+    """
+    Check if the session was verified recently enough to be used without reconnecting.
+    """
+    def is_session_fresh(self) -> bool:
+        return self.device != None and self._verified_at != None and time.monotonic() - self._verified_at < self.session_ttl
+
+    """
+    Get the time.monotonic() time the session was last verified, None if never.
+    """
+    def get_last_verified(self) -> float:
+        return self._verified_at
+
+    """
+    Restart the session unless another thread already refreshed it while we waited.
+    force: Restart even if the session looks fresh
+    """
+    def _refresh_session(self, force: bool = False):
+        seen = self._verified_at
+        with self._lock:
+            if self._verified_at != seen or (not force and self.is_session_fresh()):
+                return
+            self._restart_session()
+
     def get_device(self) -> Jddevice:
         return self.device
 
@@ -69,8 +150,9 @@ class JDownloadManager():
 
         # Try to reconnect if we can, if there is an exception, restart the connection.
         try:
-            if self.jd.is_connected():
+            if self.jd.is_connected() and self.device != None:
                 self.jd.reconnect()
+                self._verified_at = time.monotonic()
                 return
         except:
             pass
@@ -96,21 +178,188 @@ class JDownloadManager():
         self.jd.update_devices()
         try:
             self.device =  self.jd.get_device(self.device_name)
+            self._verified_at = time.monotonic()
         except MYJDException:
             self.logger.warn('Device %s was not found. Will try again but double check the device name.' % self.device_name)
             self.device = None
 
+class JDownloadBatcher():
+    """
+    Collects finished torrents for a short window and hands them to JDownloader together
+    in one add_links call. Has the same download and submit calls as JDownloadManager so the
+    RDManager can use either one. The RDManager submits without waiting, so a batch is not
+    limited by the number of download workers.
+    Attributes:
+        jdownloader: The JDownloadManager the batches are sent with
+        window: Seconds to wait for more torrents after the first one arrives
+        max_batch: Number of torrents that sends the batch right away
+        _pending: List of (urls, path, future) waiting to be sent
+        _timer: Timer sending the batch when the window runs out
+    """
+
+    def __init__(self, jdownloader: JDownloadManager, window: float = 2, max_batch: int = 20, logger: logging.Logger = None):
+        self.jdownloader = jdownloader
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+        # Use default logger if none is provided.
+        if logger == None:
+            logger = logging.getLogger()
+        self.logger = logger
+
+    """
+    Download the given urls to the path provided as part of the next batch.
+    Blocks until the batch has been sent.
+    returns: The JDownloader result for this entry, {} if it failed
+    """
+    def download(self, urls: list, path: str) -> dict:
+        return self.submit(urls, path).result()
+
+    """
+    Add urls to the next batch without waiting for it to be sent.
+    returns: A future with the JDownloader result for this entry
+    """
+    def submit(self, urls: list, path: str) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        batch = None
+        with self._lock:
+            self._pending.append((urls, path, future))
+            if len(self._pending) >= self.max_batch:
+                batch = self._take_batch()
+            elif self._timer == None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if batch != None:
+            self._send(batch)
+        return future
+
+    """
+    Send everything waiting right away.
+    """
+    def flush(self):
+        with self._lock:
+            batch = self._take_batch()
+        self._send(batch)
+
+    """
+    Take the pending entries and stop the window timer. Must hold the lock.
+    """
+    def _take_batch(self) -> list:
+        batch = self._pending
+        self._pending = []
+        if self._timer != None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    """
+    Send a batch in one add_links call and give each entry its result.
+    JDownloader answers add_links with one result for the whole call, so every entry gets a copy of it.
+    """
+    def _send(self, batch: list):
+        if len(batch) == 0:
+            return
+
+        try:
+            result = self.jdownloader.download_many([(urls, path) for urls, path, future in batch])
+        except Exception:
+            self.logger.exception("Failed to send a batch of %d to JDownloader." % len(batch))
+            result = {}
+
+        for urls, path, future in batch:
+            future.set_result(dict(result))
+
 # Class to handle the management of user sessions with the application.
+class MemorySessionStore():
+    """
+    Session store kept in the memory of this process.
+    Sessions are stored by token so a lookup is a single hash lookup. An index of ip to tokens
+    keeps the per ip view, and a min heap of expiry dates lets the expiry sweep stop at the first
+    session that has not expired.
+    Attributes:
+        _sessions: dictionary of token to Session
+        _ip_index: dictionary of ip to a dictionary of token to Session, in creation order
+        _expiry_heap: min heap of (expiry, token). Removed sessions are left in until they expire.
+        _lock: Lock guarding the store
+    """
+    def __init__(self):
+        self._sessions = {}
+        self._ip_index = {}
+        self._expiry_heap = []
+        self._lock = threading.Lock()
+
+    def add(self, session: Session):
+        with self._lock:
+            self._sessions[session.get_token()] = session
+            self._ip_index.setdefault(session.get_ip(), {})[session.get_token()] = session
+            heapq.heappush(self._expiry_heap, (session.get_expiry(), session.get_token()))
+
+    """
+    returns: The session with the token, or None
+    """
+    def get(self, token: str) -> Session:
+        return self._sessions.get(token)
+
+    def remove(self, token: str):
+        with self._lock:
+            self._remove(token)
+
+    """
+    Remove every session that expired before today. Only expired sessions are looked at.
+    """
+    def remove_expired(self, today: date):
+        with self._lock:
+            while len(self._expiry_heap) > 0 and self._expiry_heap[0][0] < today:
+                expiry, token = heapq.heappop(self._expiry_heap)
+
+                # The token may have been removed already.
+                session = self._sessions.get(token)
+                if session != None and session.get_expiry() == expiry:
+                    self._remove(token)
+
+    """
+    returns: Dictionary of ip to the list of sessions at that ip
+    """
+    def get_all(self) -> dict:
+        with self._lock:
+            return {ip: list(sessions.values()) for ip, sessions in self._ip_index.items()}
+
+    """
+    Remove a session from the token store and the ip index. The caller must hold the lock.
+    """
+    def _remove(self, token: str):
+        session = self._sessions.pop(token, None)
+        if session == None:
+            return
+
+        tokens = self._ip_index[session.get_ip()]
+        del tokens[token]
+
+        # If there are no remaining sessions at the ip, remove it.
+        if len(tokens) == 0:
+            del self._ip_index[session.get_ip()]
+
 class SessionManager():
     """
-    Class to handle the management of user sessions with the application
+    Class to handle the management of user sessions with the application.
+    Sessions live in a pluggable store, in memory by default or SQLiteSessionStore to share
+    sessions between worker processes. Sessions read from the store are cached in this process.
     Attributes:
         expiry_days: number of days until we expire a session
-        ip_sessions: dictionary to keep track of sessions
+        _store: The session store
+        _cache: TTLCache of token to Session read from the store, None when the store is in memory
     """
-    def __init__(self, expiry_days: int):
+    def __init__(self, expiry_days: int, store = None, cache_ttl: float = 30):
         self.expiry_days = expiry_days
-        self.ip_sessions = {}
+        self._store = MemorySessionStore() if store == None else store
+
+        # A session closed by another process stays valid here for at most cache_ttl seconds.
+        self._cache = None if isinstance(self._store, MemorySessionStore) else TTLCache(1000, cache_ttl)
 
     """
     Close a provided session
@@ -119,37 +368,23 @@ class SessionManager():
     returns: boolean if a session was closed or not
     """
     def close_session(self, ip: str, token: str) -> bool:
-        if ip in self.ip_sessions:
-            for session in self.ip_sessions[ip]:
-                if session.get_token() == token:
-                    self.ip_sessions[ip].remove(session)
-                    return True
-
-            # If there are no remaining sessions at the ip, remove it.
-            if len(self.ip_sessions[ip]) == 0:
-                del self.ip_sessions[ip]
-        return False
+        if not isinstance(token, str):
+            return False
+
+        session = self._get(token)
+        if session == None or session.get_ip() != ip:
+            return False
+
+        self._store.remove(token)
+        if self._cache != None:
+            self._cache.pop(token)
+        return True
 
     """
     Check for expired sessions and remove them from the session list
     """
     def remove_expired_sessions(self):
-        current_time = date.today()
-        keys = list(self.ip_sessions.keys())
-        for i in range(0, len(self.ip_sessions)):
-            ip = keys[i]
-            
-            # For each session in the ip, validate its time.
-            for session in self.ip_sessions[ip]:
-                if session.get_expiry() < current_time:
-                    self.ip_sessions[ip].remove(session)
-
-            # If there are no remaining sessions at the ip, remove it.
-            if len(self.ip_sessions[ip]) == 0:
-                del self.ip_sessions[ip]
-                i -= 1
-                continue
-
+        self._store.remove_expired(date.today())
 
     """
     Authenticate a user given their ip and the token they provided
@@ -159,24 +394,20 @@ class SessionManager():
     """
     def authenticate_user(self, ip: str, token: str) -> bool:
 
+        # Tokens come straight from the request JSON, so they may not be strings at all.
+        if not isinstance(token, str):
+            return False
+
         # If the token provided is the API key, let them through!
-        if token == os.environ['API_KEY']:
+        if secrets.compare_digest(token.encode(), os.environ['API_KEY'].encode()):
             return True
 
-        # Check if the ip is in the sessions, then iterate over all sessions at the house
-        # until either it finds a valid session or it returns False        
-        if ip in self.ip_sessions:
-            sessions = self.ip_sessions[ip]
-            for session in sessions:
-                if session.get_token() == token and session.get_ip() == ip:
-                    
-                    # Verify the token is not expiried
-                    if session.get_expiry() < date.today():
-                        return False
-
-                    return True
-        
-        return False
+        # The session has to belong to the ip and not be expired.
+        session = self._get(token)
+        if session == None or not secrets.compare_digest(session.get_ip().encode(), ip.encode()):
+            return False
+
+        return session.get_expiry() >= date.today()
 
     """
     Create a session for the given ip address
@@ -185,16 +416,15 @@ class SessionManager():
     """
     def create_session(self, ip: str) -> str:
         token = secrets.token_urlsafe()
-        s = Session(ip, token, date.today() + timedelta(days=self.expiry_days))
-        if ip in self.ip_sessions:
-            self.ip_sessions[ip].append(s)
-        else:
-            self.ip_sessions[ip] = [s]
-
+        self._add_session(ip, Session(ip, token, date.today() + timedelta(days=self.expiry_days)))
         return token
 
+    """
+    Get every session.
+    returns: Dictionary of ip to the list of sessions at that ip
+    """
     def get_sessions(self) -> dict:
-        return self.ip_sessions
+        return self._store.get_all()
 
     """
     Manual session adding given a session object
@@ -202,10 +432,24 @@ class SessionManager():
     session: The session
     """
     def _add_session(self, ip: str, session: Session):
-        if ip in self.ip_sessions:
-            self.ip_sessions[ip].append(session)
-        else:
-            self.ip_sessions[ip] = [session]
+        self._store.add(session)
+        if self._cache != None:
+            self._cache.set(session.get_token(), session)
+
+    """
+    Get a session from the cache, reading through to the store on a miss.
+    Missing tokens are not cached so sessions created by other processes are seen at once.
+    """
+    def _get(self, token: str) -> Session:
+        if self._cache == None:
+            return self._store.get(token)
+
+        session = self._cache.get(token)
+        if session == None:
+            session = self._store.get(token)
+            if session != None:
+                self._cache.set(token, session)
+        return session
 
     """
     Decorator to require validation in order for the code to be ran.
@@ -224,36 +468,133 @@ class SessionManager():
 class FileStateManager(EventDictionary):
     """
     Manager for controlling the internal state file saved when needed.
+    Changes are appended to a journal next to the state file instead of rewriting it. Changes
+    made close together are written in one append, and once the journal is long enough it is
+    compacted into the state file, which is replaced atomically so a crash never leaves it half written.
+    Pending changes are flushed when the interpreter exits, the flush timer alone would be killed with it.
 
     Attributes:
         config_path: The path where the file is saved at for the state.
+        journal_path: The path of the journal of changes since the state file was written
+        flush_delay: Seconds changes are held for before being appended to the journal
+        compact_every: Number of journal entries after which the journal is compacted
+        _pending: Journal lines not written yet
+        _journal_size: Number of entries in the journal
+        _timer: Timer that flushes the pending lines, None if nothing is pending
+        _lock: Lock guarding the pending lines and the files
     """
 
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, flush_delay: float = 1, compact_every: int = 1000):
         super().__init__(self._callback)
         self.config_path = config_path
+        self.journal_path = config_path + '.journal'
+        self.flush_delay = flush_delay
+        self.compact_every = compact_every
+        self._pending = []
+        self._journal_size = 0
+        self._timer = None
+        self._lock = threading.RLock()
+        atexit.register(self.close)
 
     """
-    Internal callback to save the state everytime we are updated.
+    Internal callback to journal every change. The write is delayed so changes are grouped,
+    a batch of changes is written at once.
     """
     def _callback(self, e: str, v: str, d: DictionaryEventType):
-        self.save_state()
+        if d == DictionaryEventType.BATCH_EVENT:
+            with self._lock:
+                self._pending.extend(self._journal_line(key, value, event) for key, value, event in v)
+                self.flush()
+            return
+
+        with self._lock:
+            self._pending.append(self._journal_line(e, v, d))
+            if self._timer == None:
+                self._timer = threading.Timer(self.flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _journal_line(self, key: str, value: str, event: DictionaryEventType) -> str:
+        if event == DictionaryEventType.SET_EVENT:
+            return json.dumps({'op': 'set', 'key': key, 'value': value})
+        return json.dumps({'op': 'del', 'key': key})
+
+    """
+    Append every pending change to the journal now, compacting it if it has grown too long.
+    """
+    def flush(self):
+        with self._lock:
+            if self._timer != None:
+                self._timer.cancel()
+                self._timer = None
+            if len(self._pending) == 0:
+                return
+
+            with open(self.journal_path, 'a') as f:
+                f.write("\n".join(self._pending) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_size += len(self._pending)
+            self._pending = []
+
+            if self._journal_size >= self.compact_every:
+                self.save_state()
 
     """
-    Save our state to the file.
+    Write every pending change and stop the flush timer. Changes made afterwards are still journaled.
+    """
+    def close(self):
+        self.flush()
+
+    """
+    Save our state to the file and empty the journal. The file is written next to the
+    state file and renamed over it.
     """
     def save_state(self):
-        f = open(self.config_path, 'w')
-        f.write(json.dumps(self))
-        f.close()
+        with self._lock:
+            if self._timer != None:
+                self._timer.cancel()
+                self._timer = None
+
+            tmp_path = self.config_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(self))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.config_path)
+
+            # The state file now has every change so the journal starts over.
+            open(self.journal_path, 'w').close()
+            self._pending = []
+            self._journal_size = 0
 
     """
-    Load state from the file on the path.
+    Load state from the file on the path, then replay the journal on top of it.
+    A journal entry cut short by a crash is ignored.
     """
     def load_state(self):
-        f = open(self.config_path, 'r')
-        self.update(json.loads(f.read()))
-        f.close()
+        with self._lock:
+            # The state file is only missing if the journal has never been compacted.
+            if os.path.exists(self.config_path) or not os.path.exists(self.journal_path):
+                with open(self.config_path, 'r') as f:
+                    dict.update(self, json.loads(f.read()))
+
+            self._journal_size = 0
+            if not os.path.exists(self.journal_path):
+                return
+
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+
+                    if entry['op'] == 'set':
+                        dict.__setitem__(self, entry['key'], entry['value'])
+                    else:
+                        dict.pop(self, entry['key'], None)
+                    self._journal_size += 1
 
 class StateManager():
     """
@@ -261,13 +602,27 @@ class StateManager():
     Due to JSON not having a tuple definition, all tuples returned from sqlite are
     converted into a list.
 
+    Connections are pooled per thread and kept open for the life of the manager,
+    so a poll cycle does not pay for a connect and close on every call.
+
     Attributes:
-        _con: Connection to the database
-        _cur: Database cursor
+        db_file: Path to the database file
+        _connections: Dictionary of thread id to that thread's open connection
+        _lock: Lock guarding the connection pool
+        _callbacks: Functions called with no arguments after content is added
     """
+
+    # Sqlite limits the number of ? parameters in a single statement.
+    MAX_QUERY_PARAMETERS = 900
+
     def __init__(self, db_file: str):
         self.db_file = db_file
-        with sqlite3.connect(db_file) as _con:
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+        _con = self._get_connection()
+        with _con:
             _cur = _con.cursor()
 
             # Create the table if it does not exist.
@@ -278,26 +633,161 @@ class StateManager():
                 "title"	TEXT,
                 PRIMARY KEY("id")
             )''')
-            _con.commit()
 
+            # Last progress sample and next scheduled check for each watched id.
+            _cur.execute('''
+            CREATE TABLE IF NOT EXISTS progress (
+                "id"	TEXT NOT NULL UNIQUE,
+                "status"	TEXT,
+                "progress"	REAL,
+                "speed"	INTEGER,
+                "eta"	REAL,
+                "next_check"	REAL,
+                "sampled_at"	REAL,
+                PRIMARY KEY("id")
+            )''')
+
+            # Finished torrents waiting to be, or already, handed to JDownloader.
+            _cur.execute('''
+            CREATE TABLE IF NOT EXISTS download_jobs (
+                "id"	TEXT NOT NULL UNIQUE,
+                "path"	TEXT NOT NULL,
+                "title"	TEXT,
+                "state"	TEXT NOT NULL,
+                "attempts"	INTEGER NOT NULL DEFAULT 0,
+                "next_retry"	REAL NOT NULL,
+                "last_error"	TEXT,
+                "updated"	REAL NOT NULL,
+                "owner"	TEXT,
+                PRIMARY KEY("id")
+            )''')
+
+            # Counters bumped on every change to a table, so other processes can notice it with one read.
+            _cur.execute('''
+            CREATE TABLE IF NOT EXISTS versions (
+                "name"	TEXT NOT NULL UNIQUE,
+                "value"	INTEGER NOT NULL,
+                PRIMARY KEY("name")
+            )''')
+
+            # Leases held by one process at a time, such as the scheduler lease.
+            _cur.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                "name"	TEXT NOT NULL UNIQUE,
+                "holder"	TEXT NOT NULL,
+                "expires"	REAL NOT NULL,
+                PRIMARY KEY("name")
+            )''')
+
+            # User sessions, when sessions are shared between worker processes.
+            _cur.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                "token"	TEXT NOT NULL UNIQUE,
+                "ip"	TEXT NOT NULL,
+                "expiry"	TEXT NOT NULL,
+                "created"	REAL NOT NULL,
+                PRIMARY KEY("token")
+            )''')
+            _cur.execute('CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)')
+
+            # Content submissions accepted in async mode and their outcome.
+            _cur.execute('''
+            CREATE TABLE IF NOT EXISTS submissions (
+                "id"	TEXT NOT NULL UNIQUE,
+                "state"	TEXT NOT NULL,
+                "result"	TEXT,
+                "created"	REAL NOT NULL,
+                "updated"	REAL NOT NULL,
+                "owner"	TEXT,
+                PRIMARY KEY("id")
+            )''')
+
+            # RD torrent id for each info hash on the account, so a magnet is only added once.
+            _cur.execute('''
+            CREATE TABLE IF NOT EXISTS torrent_hashes (
+                "hash"	TEXT NOT NULL UNIQUE,
+                "id"	TEXT NOT NULL,
+                PRIMARY KEY("hash")
+            )''')
+            _cur.execute('CREATE INDEX IF NOT EXISTS torrent_hashes_id ON torrent_hashes (id)')
+
+            # Unrestricted download url for each RD hoster link, until RD expires it.
+            _cur.execute('''
+            CREATE TABLE IF NOT EXISTS unrestricted_links (
+                "link"	TEXT NOT NULL UNIQUE,
+                "download"	TEXT NOT NULL,
+                "expires"	REAL NOT NULL,
+                PRIMARY KEY("link")
+            )''')
+
+    """
+    Get the connection for the calling thread, opening and configuring one if needed.
+    Connections belonging to threads that have finished are closed at the same time.
+    returns: The sqlite3 connection for this thread.
+    """
+    def _get_connection(self) -> sqlite3.Connection:
+        ident = threading.get_ident()
+        _con = self._connections.get(ident)
+        if _con != None:
+            return _con
+
+        # check_same_thread is off only so a finished thread's connection can be closed
+        # from another thread. Each connection is still only used by its own thread.
+        _con = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        _con.execute("PRAGMA journal_mode=WAL")
+        _con.execute("PRAGMA synchronous=NORMAL")
+
+        with self._lock:
+            alive = {t.ident for t in threading.enumerate()}
+            for dead in [x for x in self._connections if x not in alive]:
+                self._connections.pop(dead).close()
+            self._connections[ident] = _con
+
+        return _con
+
+    """
+    Close every pooled connection. The manager can still be used afterwards,
+    new connections are opened on demand.
+    """
+    def close(self) -> None:
+        with self._lock:
+            for _con in self._connections.values():
+                _con.close()
+            self._connections = {}
 
     """
-    Internal decorator to open a connection to the database.
-    All actions are commited and the conneciton is closed after every call.
-    Note: Without copy and pasting, I thought this was the best solution.
-    If there is a better one, please open an issue and let me know.
+    Internal decorator to provide the calling thread's pooled connection.
+    Every call runs in its own transaction which is commited on success and rolled back on error.
     """
     def with_connection(func):
         @functools.wraps(func)
         def wrapper_decorator(*args, **kwargs):
             self = args[0]
-            with sqlite3.connect(self.db_file) as _con:
+            _con = self._get_connection()
+            with _con:
                 _cur = _con.cursor()
-                val = func(*args, **kwargs, _con=_con, _cur=_cur)
-                _con.commit()
-                return val
+                return func(*args, **kwargs, _con=_con, _cur=_cur)
+        return wrapper_decorator
+
+    """
+    Internal decorator to call every registered callback once the call has commited.
+    Must be placed above with_connection.
+    """
+    def notifies(func):
+        @functools.wraps(func)
+        def wrapper_decorator(*args, **kwargs):
+            val = func(*args, **kwargs)
+            for callback in args[0]._callbacks:
+                callback()
+            return val
         return wrapper_decorator
 
+    """
+    Register a function to be called whenever content is added.
+    callback: A function taking no arguments
+    """
+    def register_callback(self, callback: Callable[[], None]) -> None:
+        self._callbacks.append(callback)
 
     """
     Deletes all data from the state system.
@@ -305,6 +795,8 @@ class StateManager():
     @with_connection
     def delete_all(self, _con=None, _cur=None) -> None:
         _cur.execute("DELETE FROM content")
+        _cur.execute("DELETE FROM progress")
+        _cur.execute("DELETE FROM download_jobs")
 
     """
     Rename for backwards compatability with event dictionary.
@@ -319,6 +811,20 @@ class StateManager():
     @with_connection
     def delete_id(self, id: str, _con=None, _cur=None) -> None:
         _cur.execute("DELETE FROM content WHERE id = ?", (id,))
+        _cur.execute("DELETE FROM progress WHERE id = ?", (id,))
+
+    """
+    Removes multiple ids from the state system in one transaction.
+    ids: Iterable of ids to remove. Ids that are not watched are ignored.
+    """
+    @with_connection
+    def delete_many(self, ids: list, _con=None, _cur=None) -> None:
+        self._delete_many(_cur, ids)
+
+    def _delete_many(self, _cur: sqlite3.Cursor, ids: list) -> None:
+        rows = [(id,) for id in ids]
+        _cur.executemany("DELETE FROM content WHERE id = ?", rows)
+        _cur.executemany("DELETE FROM progress WHERE id = ?", rows)
 
     """
     Gets the title and path given the id.
@@ -334,6 +840,26 @@ class StateManager():
 
         return list(result)
 
+    """
+    Gets the title and path for multiple ids at once.
+    Ids that are not in the database are left out of the result.
+    Returns:
+        A dictionary in the format {ID: [title, path]}
+    """
+    @with_connection
+    def get_info_many(self, ids: list, _con=None, _cur=None) -> dict:
+        ids = list(ids)
+        result = {}
+
+        # Stay under the sqlite host parameter limit for very large lists.
+        for i in range(0, len(ids), StateManager.MAX_QUERY_PARAMETERS):
+            chunk = ids[i:i + StateManager.MAX_QUERY_PARAMETERS]
+            _cur.execute("SELECT id, title, path FROM content WHERE id IN (%s)" % ','.join('?' * len(chunk)), chunk)
+            for row in _cur.fetchall():
+                result[row[0]] = [row[1], row[2]]
+
+        return result
+
     """
     Gets everything from the database.
     Returns:
@@ -357,6 +883,43 @@ class StateManager():
             return {}
         return { x[0]: {'title': x[2], 'path': x[1]} for x in result}
 
+    """
+    Get everything from the database along with the last progress seen on RD.
+    Progress, speed and eta are None until the id has been checked.
+    Returns:
+        A dictionary in the format {ID: {title: "", path: "", status: "", progress: 0, speed: 0, eta: 0}}
+    """
+    @with_connection
+    def get_all_with_progress(self, _con=None, _cur=None) -> dict:
+        _cur.execute('''SELECT content.id, content.title, content.path, progress.status, progress.progress, progress.speed, progress.eta
+            FROM content LEFT JOIN progress ON content.id = progress.id''')
+        return { x[0]: {'title': x[1], 'path': x[2], 'status': x[3], 'progress': x[4], 'speed': x[5], 'eta': x[6]}
+            for x in _cur.fetchall()}
+
+    """
+    Get the last progress sample of every watched id that has one.
+    Returns:
+        A dictionary in the format {ID: {status: "", progress: 0, speed: 0, eta: 0, next_check: 0, sampled_at: 0}}
+    """
+    @with_connection
+    def get_all_progress(self, _con=None, _cur=None) -> dict:
+        _cur.execute("SELECT id, status, progress, speed, eta, next_check, sampled_at FROM progress")
+        return { x[0]: {'status': x[1], 'progress': x[2], 'speed': x[3], 'eta': x[4], 'next_check': x[5], 'sampled_at': x[6]}
+            for x in _cur.fetchall()}
+
+    """
+    Save progress samples in one transaction. Samples for ids that are not watched are ignored.
+    rows: List of (id, status, progress, speed, eta, next_check, sampled_at) tuples.
+    """
+    @with_connection
+    def update_progress_many(self, rows: list, _con=None, _cur=None) -> None:
+        self._update_progress_many(_cur, rows)
+
+    def _update_progress_many(self, _cur: sqlite3.Cursor, rows: list) -> None:
+        _cur.executemany('''INSERT OR REPLACE INTO progress (id, status, progress, speed, eta, next_check, sampled_at)
+            SELECT ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM content WHERE id = ?)''',
+            [tuple(row) + (row[0],) for row in rows])
+
     """
     Get all ids in the system.
     Returns:
@@ -370,8 +933,10 @@ class StateManager():
     """
     Add content to the state. Title is optional and only for reporting.
     """
+    @notifies
     @with_connection
     def add_content(self, id: str, path: str, title: str = None, _con=None, _cur=None) -> None:
+        self._bump_version(_cur, 'content')
         try:
             _cur.execute("INSERT INTO content (id, path, title) VALUES (?, ?, ?)", (id, path, '' if title == None else title))
         except sqlite3.IntegrityError:
@@ -379,188 +944,1790 @@ class StateManager():
             pass
 
     """
-    Returns the number of items inside the state manager.
+    Add multiple pieces of content to the state in one transaction.
+    Like add_content, ids that are already watched keep their original entry.
+    items: List of (id, path) or (id, path, title) tuples.
     """
-    def __len__(self) -> int:
-        with sqlite3.connect(self.db_file) as _con:
-            _cur = _con.cursor()
-            _cur.execute("SELECT COUNT(*) FROM content")
-            return int(_cur.fetchone()[0])
+    @notifies
+    @with_connection
+    def add_many(self, items: list, _con=None, _cur=None) -> None:
+        rows = []
+        for item in items:
+            title = item[2] if len(item) > 2 else None
+            rows.append((item[0], item[1], '' if title == None else title))
+        _cur.executemany("INSERT OR IGNORE INTO content (id, path, title) VALUES (?, ?, ?)", rows)
+        self._bump_version(_cur, 'content')
+
+    def _bump_version(self, _cur: sqlite3.Cursor, name: str) -> None:
+        _cur.execute("INSERT INTO versions VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
 
-class RDManager():
     """
-    Manager for RealDebrid communication.
-    Attributes:
-        _server: The real debrid server
-        _header: The authorization header
-        _logger: Logger passed into to monitor issues with RD
-        jdownloader: The JDownloadManager used to download what we need
+    Get the version of the content, which changes whenever content is added by any process.
+    Returns:
+        The version number, 0 if content was never added
     """
+    @with_connection
+    def get_content_version(self, _con=None, _cur=None) -> int:
+        _cur.execute("SELECT value FROM versions WHERE name = 'content'")
+        res = _cur.fetchone()
+        return 0 if res == None else res[0]
 
-    def __init__(self, api_key: str, logger: logging.Logger, jdownloader: JDownloadManager):
-        self._server = "https://api.real-debrid.com/rest/1.0/"
-        self._header = {'Authorization': 'Bearer ' + api_key }
-        self._logger = logger
-        self.jdownloader = jdownloader
+    """
+    Move watched ids into the download job table as pending jobs, in one transaction.
+    Ids whose job is still open are not queued twice. Ids whose job failed or was handed off
+    are queued again with the new path, as the content was added again.
+    ids: The ids that finished on RD
+    """
+    @with_connection
+    def enqueue_downloads(self, ids: list, _con=None, _cur=None) -> None:
+        self._enqueue_downloads(_cur, ids)
+
+    def _enqueue_downloads(self, _cur: sqlite3.Cursor, ids: list) -> None:
+        now = time.time()
+        rows = [(JobState.PENDING.value, now, now, id, JobState.FAILED.value, JobState.HANDED_OFF.value) for id in ids]
+        _cur.executemany('''INSERT INTO download_jobs (id, path, title, state, attempts, next_retry, updated)
+            SELECT id, path, title, ?, 0, ?, ? FROM content WHERE id = ?
+            ON CONFLICT(id) DO UPDATE SET path=excluded.path, title=excluded.title, state=excluded.state, attempts=0,
+            next_retry=excluded.next_retry, last_error=NULL, updated=excluded.updated WHERE download_jobs.state IN (?, ?)''', rows)
+        self._delete_many(_cur, ids)
 
     """
-    Get the real debrid download url from the website
-    id: The real debrid ID to get all of the links for
-    returns: The links associated with the identifier
+    Claim pending jobs that are due, marking them as unrestricting.
+    A job is only ever claimed by one caller, even across processes.
+    limit: The most jobs to claim
+    owner: The lease holder running the jobs, None if there are no leases
+    returns: A list of (id, path, attempts) for the claimed jobs
     """
-    def get_rd_download_urls(self, id: str) -> list:
-        req = requests.get(self._server + "torrents/info/%s" %  id, headers=self._header)
-        if(req.status_code == 401 or req.status_code == 403):
+    @with_connection
+    def claim_jobs(self, limit: int, owner: str = None, _con=None, _cur=None) -> list:
+        if limit <= 0:
             return []
-        res = json.loads(req.text)
 
-        if 'error' in res:
-            return []
-        
-        return res['links']
+        now = time.time()
+        _cur.execute("SELECT id, path, attempts FROM download_jobs WHERE state = ? AND next_retry <= ? ORDER BY next_retry LIMIT ?",
+            (JobState.PENDING.value, now, limit))
+        claimed = []
+        for id, path, attempts in _cur.fetchall():
+            _cur.execute("UPDATE download_jobs SET state = ?, updated = ?, owner = ? WHERE id = ? AND state = ?",
+                (JobState.UNRESTRICTING.value, now, owner, id, JobState.PENDING.value))
+            if _cur.rowcount == 1:
+                claimed.append((id, path, attempts))
+        return claimed
 
     """
-    Send a magnet url to realdebrid to start the download process.
-    magnet: The magnet url url.
-    returns: A tuple of (bool, id/error)
+    Record the outcome of a claimed job.
+    state: The new JobState
+    attempts: The number of attempts made so far
+    next_retry: When a pending job may be claimed again
+    error: The reason the attempt failed, if it did
     """
-    def send_to_rd(self, magnet_url: str) -> tuple:
-        data = {'magnet': magnet_url}
-        req = requests.post(self._server + "torrents/addMagnet", data=data, headers=self._header)
-        if req.status_code != 201:
-            return (False, "Error in sending magnet link to RD. Code: %d, Text: %s" % (req.status_code, req.text))
-        else:
-            res = json.loads(req.text)
-            id = res['id']
-            req = requests.post(self._server + "torrents/selectFiles/%s" % id, data={'files': "all"}, headers=self._header)
-            if req.status_code != 204 and req.status_code != 202:
-                return (False, "Error in sending magnet link to RD. Code: %d, Text: %s" % (req.status_code, req.text))
-            else:
-                return (True, id)
+    @with_connection
+    def update_job(self, id: str, state: JobState, attempts: int, next_retry: float = 0, error: str = None, _con=None, _cur=None) -> None:
+        _cur.execute("UPDATE download_jobs SET state = ?, attempts = ?, next_retry = ?, last_error = ?, updated = ? WHERE id = ?",
+            (state.value, attempts, next_retry, error, time.time(), id))
 
     """
-    Download the provided real debrid ID using JDownloader
-    id: The realdebrid internal id.
+    Recover the work of processes that are gone. Jobs they left unrestricting go back to pending
+    and their pending submissions are failed. A process is gone once it holds no unexpired lease,
+    work without an owner is treated the same. Expired leases are dropped at the same time.
     """
-    def download_id(self, id : str, path: str) -> dict:
-        urls = self.get_rd_download_urls(id)
-        download_urls = []
-        for url in urls:
-            req = requests.post(self._server + "unrestrict/link", data={'link': url}, headers=self._header)
-            res = json.loads(req.text)
-
-            # The status code returned meant we had a bad token or account was locked. Nothing we can do.
-            if(req.status_code == 401 or req.status_code == 403):
-                self._logger.error("Failed to connect to real debrid. Error code: %s. Out of premium/banned?" % (str(req.status_code)))
-                continue
-
-            download_urls.append(res['download'])
+    @with_connection
+    def recover_abandoned(self, _con=None, _cur=None) -> None:
+        now = time.time()
+        _cur.execute("""UPDATE download_jobs SET state = ?, next_retry = 0, owner = NULL WHERE state = ?
+            AND (owner IS NULL OR owner NOT IN (SELECT holder FROM leases WHERE expires >= ?))""",
+            (JobState.PENDING.value, JobState.UNRESTRICTING.value, now))
+        _cur.execute("""UPDATE submissions SET state = ?, result = ?, updated = ? WHERE state = ?
+            AND (owner IS NULL OR owner NOT IN (SELECT holder FROM leases WHERE expires >= ?))""",
+            (SubmissionState.FAILED.value, json.dumps({'Error': 'DLAPI restarted before the submission finished.'}),
+            now, SubmissionState.PENDING.value, now))
+        _cur.execute("DELETE FROM leases WHERE expires < ?", (now,))
 
-        return self.jdownloader.download(download_urls, path)
+    """
+    Delete handed off jobs last updated before the given time.
+    """
+    @with_connection
+    def delete_finished_jobs(self, before: float, _con=None, _cur=None) -> None:
+        _cur.execute("DELETE FROM download_jobs WHERE state = ? AND updated < ?", (JobState.HANDED_OFF.value, before))
 
-    def _download_id_and_remove_if_success(self, id: str, path: str, state_manager: StateManager) -> dict:
-        self.download_id(id, path)
-        if id in state_manager.get_all_ids():
-            state_manager.delete_id(id)
-          
     """
-    Select all files for the given id when it has waiting_file_selection
+    Get every download job.
+    Returns:
+        A dictionary in the format {ID: {path: "", title: "", state: "", attempts: 0, next_retry: 0, last_error: ""}}
     """
-    def _select_files_for_torrent(self, id: str):
-        req = requests.post(self._server + "torrents/selectFiles/" + id, data={'files': 'all'}, headers=self._header)
-        res = json.loads(req.text)
+    @with_connection
+    def get_all_jobs(self, _con=None, _cur=None) -> dict:
+        _cur.execute("SELECT id, path, title, state, attempts, next_retry, last_error FROM download_jobs")
+        return { x[0]: {'path': x[1], 'title': x[2], 'state': x[3], 'attempts': x[4], 'next_retry': x[5], 'last_error': x[6]}
+            for x in _cur.fetchall()}
 
     """
-    Function to check with real debrid to see file status and react accordingly
+    Returns the number of jobs that still need to be handed off.
     """
-    def rd_listener(self, state_manager: StateManager) -> bool:
+    @with_connection
+    def count_open_jobs(self, _con=None, _cur=None) -> int:
+        _cur.execute("SELECT COUNT(*) FROM download_jobs WHERE state IN (?, ?)", (JobState.PENDING.value, JobState.UNRESTRICTING.value))
+        return int(_cur.fetchone()[0])
+
+    """
+    Take or renew a lease. The lease is only given if it is free, expired or already held by the holder.
+    name: The name of the lease
+    holder: Unique id of the process asking for the lease
+    ttl: Seconds the lease is held for unless renewed
+    returns: True if the holder has the lease
+    """
+    @with_connection
+    def acquire_lease(self, name: str, holder: str, ttl: float, _con=None, _cur=None) -> bool:
+        now = time.time()
+        _cur.execute("""INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE
+            SET holder=excluded.holder, expires=excluded.expires WHERE leases.holder=excluded.holder OR leases.expires < ?""",
+            (name, holder, now + ttl, now))
+        return _cur.rowcount == 1
+
+    """
+    Give up a lease if the holder has it.
+    """
+    @with_connection
+    def release_lease(self, name: str, holder: str, _con=None, _cur=None) -> None:
+        _cur.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+    """
+    Save a session.
+    expiry: The expiry date as an ISO date string
+    """
+    @with_connection
+    def add_session(self, token: str, ip: str, expiry: str, _con=None, _cur=None) -> None:
+        _cur.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)", (token, ip, expiry, time.time()))
+
+    """
+    returns: The (token, ip, expiry) of the session, or None
+    """
+    @with_connection
+    def get_session(self, token: str, _con=None, _cur=None) -> tuple:
+        _cur.execute("SELECT token, ip, expiry FROM sessions WHERE token=?", (token,))
+        return _cur.fetchone()
+
+    @with_connection
+    def delete_session(self, token: str, _con=None, _cur=None) -> None:
+        _cur.execute("DELETE FROM sessions WHERE token=?", (token,))
+
+    """
+    Delete the sessions that expired before the given ISO date.
+    """
+    @with_connection
+    def delete_expired_sessions(self, today: str, _con=None, _cur=None) -> None:
+        _cur.execute("DELETE FROM sessions WHERE expiry < ?", (today,))
+
+    """
+    returns: List of (token, ip, expiry) for every session in creation order
+    """
+    @with_connection
+    def get_all_sessions(self, _con=None, _cur=None) -> list:
+        _cur.execute("SELECT token, ip, expiry FROM sessions ORDER BY created, rowid")
+        return _cur.fetchall()
+
+    """
+    Record a new pending submission. Submissions finished before keep_seconds ago are dropped.
+    owner: The lease holder running the submission, None if there are no leases
+    returns: The id of the submission
+    """
+    @with_connection
+    def add_submission(self, owner: str = None, keep_seconds: float = 24 * 60 * 60, _con=None, _cur=None) -> str:
+        id = secrets.token_urlsafe()
+        now = time.time()
+        _cur.execute("DELETE FROM submissions WHERE state != ? AND updated < ?", (SubmissionState.PENDING.value, now - keep_seconds))
+        _cur.execute("INSERT INTO submissions (id, state, result, created, updated, owner) VALUES (?, ?, NULL, ?, ?, ?)",
+            (id, SubmissionState.PENDING.value, now, now, owner))
+        return id
+
+    """
+    Record the outcome of a submission.
+    result: JSON serializable result given back to the client
+    """
+    @with_connection
+    def finish_submission(self, id: str, state: SubmissionState, result, _con=None, _cur=None) -> None:
+        _cur.execute("UPDATE submissions SET state=?, result=?, updated=? WHERE id=?", (state.value, json.dumps(result), time.time(), id))
+
+    """
+    Get a submission.
+    returns: {id, state, result, created, updated}, or None if there is no such submission
+    """
+    @with_connection
+    def get_submission(self, id: str, _con=None, _cur=None) -> dict:
+        _cur.execute("SELECT id, state, result, created, updated FROM submissions WHERE id=?", (id,))
+        x = _cur.fetchone()
+        if x == None:
+            return None
+        return {'id': x[0], 'state': x[1], 'result': None if x[2] == None else json.loads(x[2]), 'created': x[3], 'updated': x[4]}
+
+    """
+    Get the RD id of the torrent with the given info hash.
+    hash: The lowercase hex info hash
+    returns: The RD id, or None if the hash is not on the account as far as we know
+    """
+    @with_connection
+    def get_torrent_id(self, hash: str, _con=None, _cur=None) -> str:
+        _cur.execute("SELECT id FROM torrent_hashes WHERE hash=?", (hash,))
+        res = _cur.fetchone()
+        return None if res == None else res[0]
+
+    """
+    Record the RD id for info hashes.
+    rows: List of (hash, id) tuples
+    """
+    @with_connection
+    def save_torrent_hashes(self, rows: list, _con=None, _cur=None) -> None:
+        self._save_torrent_hashes(_cur, rows)
+
+    def _save_torrent_hashes(self, _cur: sqlite3.Cursor, rows: list) -> None:
+        _cur.executemany("INSERT OR REPLACE INTO torrent_hashes VALUES (?, ?)", rows)
+
+    """
+    Replace the whole info hash index, used after listing every torrent on the account.
+    rows: List of (hash, id) tuples
+    """
+    @with_connection
+    def replace_torrent_hashes(self, rows: list, _con=None, _cur=None) -> None:
+        _cur.execute("DELETE FROM torrent_hashes")
+        _cur.executemany("INSERT OR REPLACE INTO torrent_hashes VALUES (?, ?)", rows)
+
+    """
+    Forget the info hashes of torrents that are gone from RD or can never finish.
+    ids: The RD ids to forget
+    """
+    @with_connection
+    def delete_torrent_ids(self, ids: list, _con=None, _cur=None) -> None:
+        self._delete_torrent_ids(_cur, ids)
+
+    def _delete_torrent_ids(self, _cur: sqlite3.Cursor, ids: list) -> None:
+        for i in range(0, len(ids), StateManager.MAX_QUERY_PARAMETERS):
+            chunk = ids[i:i + StateManager.MAX_QUERY_PARAMETERS]
+            _cur.execute("DELETE FROM torrent_hashes WHERE id IN (%s)" % ",".join("?" * len(chunk)), chunk)
+
+    """
+    Save everything a listener cycle found in one transaction.
+    hashes: List of (hash, id) tuples for the info hash index
+    downloads: Ids that finished on RD, moved into the download job table
+    removals: Ids to stop watching
+    forgotten: Ids whose info hash is dropped from the index
+    samples: Progress samples, as given to update_progress_many
+    """
+    @with_connection
+    def save_cycle(self, hashes: list, downloads: list, removals: list, forgotten: list, samples: list, _con=None, _cur=None) -> None:
+        self._save_torrent_hashes(_cur, hashes)
+        self._enqueue_downloads(_cur, downloads)
+        self._delete_many(_cur, removals)
+        self._delete_torrent_ids(_cur, forgotten)
+        self._update_progress_many(_cur, samples)
+
+    """
+    Get the unexpired unrestricted download urls for the given hoster links.
+    links: The RD hoster links to look up
+    returns: Dictionary of link to (download url, expiry time) for every link found
+    """
+    @with_connection
+    def get_unrestricted_many(self, links: list, _con=None, _cur=None) -> dict:
+        result = {}
+        now = time.time()
+        for i in range(0, len(links), StateManager.MAX_QUERY_PARAMETERS):
+            chunk = links[i:i + StateManager.MAX_QUERY_PARAMETERS]
+            _cur.execute("SELECT link, download, expires FROM unrestricted_links WHERE expires > ? AND link IN (%s)"
+                % ",".join("?" * len(chunk)), [now] + chunk)
+            for x in _cur.fetchall():
+                result[x[0]] = (x[1], x[2])
+        return result
+
+    """
+    Save unrestricted download urls. Expired rows are dropped, and past max_size the
+    rows closest to expiring are dropped too.
+    rows: List of (link, download url, expiry time) tuples
+    max_size: The most rows kept in the table
+    """
+    @with_connection
+    def save_unrestricted_many(self, rows: list, max_size: int, _con=None, _cur=None) -> None:
+        _cur.executemany("INSERT OR REPLACE INTO unrestricted_links VALUES (?, ?, ?)", rows)
+        _cur.execute("DELETE FROM unrestricted_links WHERE expires <= ?", (time.time(),))
+        _cur.execute("""DELETE FROM unrestricted_links WHERE link NOT IN
+            (SELECT link FROM unrestricted_links ORDER BY expires DESC LIMIT ?)""", (max_size,))
+
+    """
+    Returns the number of items inside the state manager.
+    """
+    @with_connection
+    def __len__(self, _con=None, _cur=None) -> int:
+        _cur.execute("SELECT COUNT(*) FROM content")
+        return int(_cur.fetchone()[0])
+
+class SQLiteSessionStore():
+    """
+    Session store kept in the state database so every worker process shares the same sessions.
+    Attributes:
+        _state_manager: The StateManager holding the sessions table
+    """
+    def __init__(self, state_manager: StateManager):
+        self._state_manager = state_manager
+
+    def add(self, session: Session):
+        self._state_manager.add_session(session.get_token(), session.get_ip(), session.get_expiry().isoformat())
+
+    """
+    returns: The session with the token, or None
+    """
+    def get(self, token: str) -> Session:
+        row = self._state_manager.get_session(token)
+        return None if row == None else Session(row[1], row[0], date.fromisoformat(row[2]))
+
+    def remove(self, token: str):
+        self._state_manager.delete_session(token)
+
+    def remove_expired(self, today: date):
+        self._state_manager.delete_expired_sessions(today.isoformat())
+
+    """
+    returns: Dictionary of ip to the list of sessions at that ip
+    """
+    def get_all(self) -> dict:
+        sessions = {}
+        for token, ip, expiry in self._state_manager.get_all_sessions():
+            sessions.setdefault(ip, []).append(Session(ip, token, date.fromisoformat(expiry)))
+        return sessions
+
+class LeaderElection():
+    """
+    Elects one process to run the background jobs when several gunicorn workers share state.db.
+    Each process keeps trying to take a lease in the database and the holder renews it well before
+    it expires. If the leader dies its lease runs out and another process takes over.
+    Every process also holds a lease of its own while it is alive, so the work it owns is only
+    recovered once it is gone.
+    Attributes:
+        state_manager: The StateManager holding the lease
+        name: The name of the lease
+        ttl: Seconds the lease is held for without being renewed
+        holder: Unique id of this process, recorded as the owner of its jobs and submissions
+        _process_lease: The name of this process' own lease
+        _valid_until: Monotonic time this process' lease runs out, 0 if it is not the leader
+        _thread: The thread renewing the lease
+        _callbacks: Functions called with no arguments when this process becomes the leader
+    """
+
+    def __init__(self, state_manager: StateManager, name: str = 'scheduler', ttl: float = 30, logger: logging.Logger = None):
+        self.state_manager = state_manager
+        self.name = name
+        self.ttl = ttl
+        self.holder = "%s:%d:%s" % (socket.gethostname(), os.getpid(), secrets.token_hex(4))
+        self._process_lease = 'process:' + self.holder
+        self._valid_until = 0
+        self._thread = None
+        self._callbacks = []
+
+        # Use default logger if none is provided.
+        if logger == None:
+            logger = logging.getLogger()
+        self._logger = logger
+
+    """
+    Register a function to be called whenever this process becomes the leader.
+    Used to recover work the previous leader left behind.
+    callback: A function taking no arguments
+    """
+    def register_callback(self, callback: Callable[[], None]) -> None:
+        self._callbacks.append(callback)
+
+    """
+    Try to take the lease right away, then keep renewing it on a daemon thread.
+    """
+    def start(self):
+        self.renew()
+        self._thread = threading.Thread(target=self._run, name='leader-election', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.ttl / 3)
+
+            # Renewal must never stop, or this process' jobs would be recovered while it still runs them.
+            try:
+                self.renew()
+            except Exception:
+                self._logger.exception("Failed to renew the %s lease." % self.name)
+
+    """
+    Take or renew the lease.
+    returns: True if this process is the leader
+    """
+    def renew(self) -> bool:
+        was_leader = self.is_leader()
+        start = time.monotonic()
+        try:
+            self.state_manager.acquire_lease(self._process_lease, self.holder, self.ttl)
+            leader = self.state_manager.acquire_lease(self.name, self.holder, self.ttl)
+        except sqlite3.Error as e:
+            self._logger.warning("Failed to renew the %s lease. %s" % (self.name, str(e)))
+            leader = False
+
+        # The lease is counted from before the write so this process never outlives it.
+        self._valid_until = start + self.ttl if leader else 0
+        if leader != was_leader:
+            self._logger.info("%s the %s leader." % ("Became" if leader else "No longer", self.name))
+            if leader:
+                for callback in self._callbacks:
+                    try:
+                        callback()
+                    except Exception:
+                        self._logger.exception("Leader callback failed.")
+        return leader
+
+    """
+    returns: True if this process holds an unexpired lease
+    """
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    """
+    Give up the lease so another process can take over without waiting for it to expire.
+    """
+    def release(self):
+        self._valid_until = 0
+        self.state_manager.release_lease(self.name, self.holder)
+        self.state_manager.release_lease(self._process_lease, self.holder)
+
+    """
+    Wrap a function so it only runs while this process is the leader.
+    """
+    def run_if_leader(self, func):
+        @functools.wraps(func)
+        def wrapper_leader(*args, **kwargs):
+            if self.is_leader():
+                return func(*args, **kwargs)
+        return wrapper_leader
+
+class LinkCache():
+    """
+    Cache of RD hoster link to unrestricted download url, so links that are still valid are
+    not unrestricted again. Recently used links are kept in memory, backed by the state database
+    so they survive restarts.
+    Attributes:
+        _memory: The in memory TTLCache of link to download url
+        _state_manager: The StateManager persisting the links, None to only cache in memory
+        max_size: The most links kept, in memory and in the database
+        ttl: Seconds an unrestricted link is trusted for
+    """
+
+    def __init__(self, state_manager: StateManager = None, max_size: int = 1000, ttl: float = 3 * 60 * 60):
+        self._memory = TTLCache(max_size, ttl)
+        self._state_manager = state_manager
+        self.max_size = max_size
+        self.ttl = ttl
+
+    """
+    Get the cached download urls for the given links. Links missing from memory are read
+    from the database and kept in memory until they expire.
+    returns: Dictionary of link to download url for every link still valid
+    """
+    def get_many(self, links: list) -> dict:
+        result = {}
+        missing = []
+        for link in links:
+            download = self._memory.get(link)
+            if download == None:
+                missing.append(link)
+            else:
+                result[link] = download
+
+        if self._state_manager != None and len(missing) > 0:
+            for link, (download, expires) in self._state_manager.get_unrestricted_many(missing).items():
+                self._memory.set(link, download, expires)
+                result[link] = download
+
+        return result
+
+    """
+    Cache unrestricted download urls.
+    downloads: Dictionary of link to download url
+    """
+    def set_many(self, downloads: dict):
+        if len(downloads) == 0:
+            return
+
+        expires = time.time() + self.ttl
+        for link, download in downloads.items():
+            self._memory.set(link, download, expires)
+
+        if self._state_manager != None:
+            self._state_manager.save_unrestricted_many([(link, download, expires) for link, download in downloads.items()],
+                self.max_size)
+
+class RDManager():
+    """
+    Manager for RealDebrid communication.
+    Attributes:
+        _server: The real debrid server
+        _header: The authorization header
+        _logger: Logger passed into to monitor issues with RD
+        _status_handlers: Dictionary of RD torrent status to the function handling it
+        _unrestrict_pool: Worker pool used to unrestrict links concurrently
+        _download_pool: Worker pool used to process download jobs in parallel
+        _download_workers: The number of download jobs unrestricted at the same time
+        _in_flight: Dictionary of id to a future set once the job's outcome is recorded, for every job in progress
+        _busy: The number of jobs holding a download worker. Jobs waiting on JDownloader do not hold one
+        _rate_limiter: Limiter keeping us under the RD API rate limit
+        _session: Keep-alive HTTP session shared by every RD call
+        _timeout: Tuple of (connect, read) timeouts in seconds for every RD call
+        _max_retries: Number of times a call is retried on connection errors, 429 and 5xx
+        jdownloader: The JDownloadManager, or a JDownloadBatcher wrapping one, used to download what we need
+        link_cache: The LinkCache of hoster links that have already been unrestricted
+        leader: The LeaderElection deciding if this process hands off download jobs, None to always hand them off
+        last_cycle: Counters from the most recent rd_listener cycle
+        _account_size: Number of torrents on the RD account when it was last listed, None if unknown
+        _strategy: The strategy the last cycle used to fetch torrents, 'pages' or 'info'
+    """
+
+    # Log message for each RD status that means the torrent will never finish.
+    ERROR_STATUSES = {
+        'magnet_error': "Magnet error on torrent",
+        'virus': "Virus detected on torrent",
+        'error': "Generic error on torrent",
+        'dead': "Dead torrent"
+    }
+
+    # RD allows 250 requests per minute.
+    RATE_LIMIT_CALLS = 250
+    RATE_LIMIT_PERIOD = 60
+
+    # Responses worth retrying, and the backoff used between retries in seconds.
+    # A POST that got a 5xx may already have been acted on by RD, so POSTs are only retried on 429.
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    POST_RETRY_STATUSES = (429,)
+    BACKOFF_BASE = 0.5
+    BACKOFF_CAP = 30
+
+    # Torrents requested per page when listing the account.
+    PAGE_SIZE = 100
+
+    # Progress percentage at which an active torrent counts as finishing.
+    FINISHING_PROGRESS = 90
+
+    # Longest time in seconds a torrent goes unchecked, however far away its ETA is.
+    MAX_CHECK_DELAY = 300
+
+    # Download jobs are retried with exponential backoff until they run out of attempts.
+    # Handed off jobs are kept for a day.
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_BASE = 30
+    JOB_RETRY_CAP = 60 * 60
+    JOB_KEEP_SECONDS = 24 * 60 * 60
+
+    def __init__(self, api_key: str, logger: logging.Logger, jdownloader: JDownloadManager, unrestrict_workers: int = 4,
+        download_workers: int = 2, pool_size: int = 10, connect_timeout: float = 5, read_timeout: float = 30,
+        max_retries: int = 3, link_cache: LinkCache = None, leader: LeaderElection = None):
+        self._server = "https://api.real-debrid.com/rest/1.0/"
+        self._header = {'Authorization': 'Bearer ' + api_key }
+        self._timeout = (connect_timeout, read_timeout)
+        self._max_retries = max_retries
+        self._logger = logger
+        self.jdownloader = jdownloader
+        self.link_cache = LinkCache() if link_cache == None else link_cache
+        self.leader = leader
+        self.last_cycle = {}
+        self._account_size = None
+        self._strategy = None
+        self._rate_limiter = RateLimiter(RDManager.RATE_LIMIT_CALLS, RDManager.RATE_LIMIT_PERIOD)
+        self._download_workers = download_workers
+        self._in_flight = {}
+        self._busy = 0
+        self._in_flight_lock = threading.Lock()
+
+        # Each handler is given (torrent, watched info, cycle changes, cycle counters) and returns True
+        # if the id should be removed with the rest of the cycle's removals.
+        self._status_handlers = {
+            'downloaded': self._handle_downloaded,
+            'waiting_files_selection': self._handle_waiting_files_selection,
+            'downloading': self._handle_active,
+            'queued': self._handle_active
+        }
+        for status in RDManager.ERROR_STATUSES:
+            self._status_handlers[status] = self._handle_error
+
+        self._init_transport(unrestrict_workers, download_workers, pool_size)
+
+    """
+    Create the HTTP session and worker pools the RD calls run on.
+    """
+    def _init_transport(self, unrestrict_workers: int, download_workers: int, pool_size: int):
+
+        # One pooled session so calls reuse the TCP and TLS connection to RD.
+        self._session = requests.Session()
+        self._session.headers.update(self._header)
+        self._session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._unrestrict_pool = ThreadPoolExecutor(max_workers=unrestrict_workers, thread_name_prefix='rd-unrestrict')
+        self._download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='rd-download')
+
+    """
+    Send a request to RD over the shared session. Connection errors, timeouts, 429 and 5xx
+    responses are retried with jittered exponential backoff, honoring Retry-After when given.
+    POSTs are not idempotent so they are only retried when they failed to connect or got a 429.
+    method: The HTTP method
+    endpoint: The endpoint relative to the RD server
+    returns: The response. Retryable responses are returned once out of retries.
+    raises: requests.exceptions.RequestException when the last attempt fails to connect
+    """
+    def _request(self, method: str, endpoint: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self._timeout)
+        retry_statuses = self._retry_statuses(method)
+        attempt = 0
+        while True:
+            self._rate_limiter.acquire()
+            retry_after = None
+            try:
+                req = self._session.request(method, self._server + endpoint, **kwargs)
+                if req.status_code not in retry_statuses or attempt >= self._max_retries:
+                    return req
+                retry_after = req.headers.get('Retry-After')
+                self._logger.debug("RD returned %d for %s, retrying." % (req.status_code, endpoint))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+
+                # A POST is only sent again if it never reached RD. A dropped connection or read timeout may
+                # come after RD acted on it.
+                if attempt >= self._max_retries or (method == 'POST' and not self._not_connected(e)):
+                    raise
+                self._logger.debug("Request to RD for %s failed, retrying. %s" % (endpoint, str(e)))
+
+            time.sleep(self._backoff(attempt, retry_after))
+            attempt += 1
+
+    """
+    Check if a request failed before a connection to RD was made.
+    """
+    def _not_connected(self, e: Exception) -> bool:
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        reason = e.args[0] if len(e.args) > 0 else None
+        return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+    """
+    Get the response codes worth retrying for the given HTTP method.
+    """
+    def _retry_statuses(self, method: str) -> tuple:
+        return RDManager.POST_RETRY_STATUSES if method == 'POST' else RDManager.RETRY_STATUSES
+
+    """
+    Get the number of seconds to wait before the next retry.
+    attempt: The number of the attempt that just failed, starting at 0
+    retry_after: The Retry-After header from RD if there was one
+    """
+    def _backoff(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after != None and retry_after.isdigit():
+            return min(float(retry_after), RDManager.BACKOFF_CAP)
+
+        # Full jitter so that parallel workers do not retry in lockstep.
+        return random.uniform(0, min(RDManager.BACKOFF_CAP, RDManager.BACKOFF_BASE * (2 ** attempt)))
+
+    """
+    Get the real debrid download url from the website
+    id: The real debrid ID to get all of the links for
+    returns: The links associated with the identifier
+    """
+    def get_rd_download_urls(self, id: str) -> list:
+        return self._parse_download_urls(self._request('GET', "torrents/info/%s" %  id))
+
+    """
+    Get the links out of a torrents/info response.
+    """
+    def _parse_download_urls(self, req) -> list:
+        if(req.status_code == 401 or req.status_code == 403):
+            return []
+        res = json.loads(req.text)
+
+        if 'error' in res:
+            return []
         
-        # If there is nothing to watch, why poll RD?
-        if len(state_manager) == 0:
+        return res['links']
+
+    """
+    Get the info hash out of a magnet url.
+    magnet_url: The magnet url
+    returns: The info hash as lowercase hex, or None if the url has no btih info hash
+    """
+    @staticmethod
+    def get_info_hash(magnet_url: str) -> str:
+        url = urlparse(magnet_url)
+        if url.scheme != 'magnet':
+            return None
+
+        for xt in parse_qs(url.query).get('xt', []):
+            if not xt.lower().startswith('urn:btih:'):
+                continue
+
+            hash = xt[9:]
+            if len(hash) == 40:
+                return hash.lower()
+            if len(hash) == 32:
+                try:
+                    return base64.b32decode(hash.upper()).hex()
+                except ValueError:
+                    return None
+
+        return None
+
+    """
+    Send a magnet url to realdebrid to start the download process.
+    If the info hash is already on the account the existing torrent is used without adding it again.
+    The index can be behind RD, so the torrent is looked up first and the magnet added if it is gone.
+    magnet: The magnet url url.
+    state_manager: The StateManager holding the info hash index, None to always add the magnet
+    returns: A tuple of (bool, id/error)
+    """
+    def send_to_rd(self, magnet_url: str, state_manager: StateManager = None) -> tuple:
+        hash = RDManager.get_info_hash(magnet_url)
+        if hash != None and state_manager != None:
+            id = state_manager.get_torrent_id(hash)
+            if id != None:
+                try:
+                    ok, file = self._parse_torrent_info(self._request('GET', "torrents/info/%s" % id))
+                except requests.exceptions.RequestException as e:
+                    return (False, "Error in checking the torrent on RD. %s" % str(e))
+                if not ok:
+                    return (False, "Error in checking the torrent with id: %s on RD." % id)
+
+                if file != None:
+                    self._logger.debug("Magnet %s is already on RD with id: %s" % (hash, id))
+                    return (True, id)
+
+                # Deleted from RD since the account was last indexed.
+                state_manager.delete_torrent_ids([id])
+
+        data = {'magnet': magnet_url}
+        try:
+            req = self._request('POST', "torrents/addMagnet", data=data)
+        except requests.exceptions.RequestException as e:
+            return (False, "Error in sending magnet link to RD. %s" % str(e))
+
+        if req.status_code != 201:
+            return (False, "Error in sending magnet link to RD. Code: %d, Text: %s" % (req.status_code, req.text))
+        else:
+            res = json.loads(req.text)
+            id = res['id']
+            try:
+                req = self._request('POST', "torrents/selectFiles/%s" % id, data={'files': "all"})
+            except requests.exceptions.RequestException as e:
+                return (False, "Error in selecting files on RD. %s" % str(e))
+            if req.status_code != 204 and req.status_code != 202:
+                return (False, "Error in sending magnet link to RD. Code: %d, Text: %s" % (req.status_code, req.text))
+            else:
+                if hash != None and state_manager != None:
+                    state_manager.save_torrent_hashes([(hash, id)])
+                return (True, id)
+
+    """
+    List every torrent on the account and rebuild the info hash index from it.
+    Picks up torrents added to RD outside of DLAPI.
+    returns: True if the whole account was listed
+    """
+    def index_account(self, state_manager: StateManager) -> bool:
+        listed = []
+        page = 1
+        try:
+            while True:
+                req = self._request('GET', "torrents", params={'page': page, 'limit': RDManager.PAGE_SIZE})
+                items = self._parse_torrent_list(req)
+                if items == None:
+                    return False
+
+                listed.extend(items)
+                if not self._add_page(items, req, set(), []):
+                    break
+                page += 1
+        except requests.exceptions.RequestException as e:
+            self._logger.warning("Failed to index the torrents on Real-Debrid. %s" % str(e))
+            return False
+
+        state_manager.replace_torrent_hashes(self._hash_rows(listed))
+        return True
+
+    """
+    Get the (hash, id) rows of every torrent that has an info hash.
+    """
+    def _hash_rows(self, torrents: list) -> list:
+        return [(file['hash'].lower(), file['id']) for file in torrents if file.get('hash')]
+
+    """
+    Unrestrict a single RD hoster link.
+    link: The RD link to unrestrict
+    returns: A tuple of (bool, download url/error)
+    """
+    def _unrestrict_link(self, link: str) -> tuple:
+        try:
+            req = self._request('POST', "unrestrict/link", data={'link': link})
+        except requests.exceptions.RequestException as e:
+            return (False, "Failed to unrestrict %s: %s" % (link, str(e)))
+
+        return self._parse_unrestrict(link, req)
+
+    """
+    Get the download url out of an unrestrict/link response.
+    returns: A tuple of (bool, download url/error)
+    """
+    def _parse_unrestrict(self, link: str, req) -> tuple:
+        # The status code returned meant we had a bad token or account was locked. Nothing we can do.
+        if(req.status_code == 401 or req.status_code == 403):
+            return (False, "Failed to connect to real debrid. Error code: %s. Out of premium/banned?" % (str(req.status_code)))
+
+        try:
+            res = json.loads(req.text)
+        except ValueError:
+            return (False, "Failed to unrestrict %s. Code: %d, Text: %s" % (link, req.status_code, req.text))
+
+        if 'download' not in res:
+            return (False, "Failed to unrestrict %s. Code: %d, Text: %s" % (link, req.status_code, req.text))
+
+        return (True, res['download'])
+
+    """
+    Unrestrict RD hoster links concurrently on the unrestrict worker pool.
+    Links still in the link cache are not sent to RD again.
+    links: List of RD links to unrestrict
+    returns: A list of (bool, download url/error) tuples in the same order as links
+    """
+    def unrestrict_links(self, links: list) -> list:
+        cached, missing = self._cached_unrestricts(links)
+        results = dict(zip(missing, self._unrestrict_pool.map(self._unrestrict_link, missing)))
+        return self._merge_unrestricts(links, cached, results)
+
+    """
+    Look up links in the link cache.
+    returns: A tuple of (dictionary of link to cached download url, list of links that still need unrestricting)
+    """
+    def _cached_unrestricts(self, links: list) -> tuple:
+        cached = self.link_cache.get_many(links)
+        return cached, [link for link in dict.fromkeys(links) if link not in cached]
+
+    """
+    Cache the links that were unrestricted and put every result back in the order of links.
+    results: Dictionary of link to (bool, download url/error) for the links sent to RD
+    """
+    def _merge_unrestricts(self, links: list, cached: dict, results: dict) -> list:
+        self.link_cache.set_many({link: result[1] for link, result in results.items() if result[0]})
+        return [(True, cached[link]) if link in cached else results[link] for link in links]
+
+    """
+    Download the provided real debrid ID using JDownloader
+    id: The realdebrid internal id.
+    """
+    def download_id(self, id : str, path: str) -> dict:
+        return self.submit_download(id, path).result()
+
+    """
+    Unrestrict the links of a real debrid ID and hand them to JDownloader without waiting for it.
+    id: The realdebrid internal id.
+    returns: A future with the JDownloader result
+    """
+    def submit_download(self, id: str, path: str) -> concurrent.futures.Future:
+        urls = self.get_rd_download_urls(id)
+        download_urls, error = self._successful_downloads(id, urls, self.unrestrict_links(urls))
+        if error != None:
+            return self._failed_handoff(error)
+        return self.jdownloader.submit(download_urls, path)
+
+    """
+    Get a future for a handoff that failed before reaching JDownloader.
+    error: Why the handoff failed
+    """
+    @staticmethod
+    def _failed_handoff(error: str) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        future.set_exception(RuntimeError(error))
+        return future
+
+    """
+    Log the failed unrestricts for an id and get its download urls.
+    A download missing some of its links would be incomplete, so any failure fails the whole id.
+    urls: The RD links of the id
+    results: The list of (bool, download url/error) tuples from unrestricting
+    returns: A tuple of (download urls, error). The error is None if RD gave links and every one was unrestricted.
+    """
+    def _successful_downloads(self, id: str, urls: list, results: list) -> tuple:
+        if len(urls) == 0:
+            return [], "RD returned no links for id: %s" % id
+
+        download_urls = []
+        failed = 0
+        for success, result in results:
+            if not success:
+                self._logger.error("Failed to unrestrict a link for id: %s. %s" % (id, result))
+                failed += 1
+                continue
+
+            download_urls.append(result)
+
+        if failed > 0:
+            return [], "Failed to unrestrict %d of %d links for id: %s" % (failed, len(urls), id)
+        return download_urls, None
+
+    """
+    Handler for torrents that finished on RD. Moves them into the download job table,
+    which is drained by the download pool at the end of the cycle.
+    """
+    def _handle_downloaded(self, file: dict, info: dict, changes: dict, cycle: dict) -> bool:
+        changes['downloads'].append(file['id'])
+        cycle['downloaded'] += 1
+        return False
+
+    """
+    Handler for torrents that will never finish on RD. Logs and stops watching them.
+    """
+    def _handle_error(self, file: dict, info: dict, changes: dict, cycle: dict) -> bool:
+        self._logger.error("%s with id: %s, path: %s" 
+            % (RDManager.ERROR_STATUSES[file['status']], file['id'], info['path']))
+        cycle['errored'] += 1
+
+        # Submitting the magnet again should add a fresh torrent.
+        changes['forgotten'].append(file['id'])
+        return True
+
+    """
+    Handler for torrents still downloading on RD. Counts the ones close to finishing.
+    """
+    def _handle_active(self, file: dict, info: dict, changes: dict, cycle: dict) -> bool:
+        if file.get('progress', 0) >= RDManager.FINISHING_PROGRESS:
+            cycle['finishing'] += 1
+        return False
+
+    """
+    Handler for torrents waiting on file selection. Selects all files.
+    """
+    def _handle_waiting_files_selection(self, file: dict, info: dict, changes: dict, cycle: dict) -> bool:
+        self._select_files_for_torrent(file['id'])
+        return True
+
+    """
+    Claim due download jobs up to the number of free download workers and run them.
+    Called every cycle and whenever a job finishes, so the queue drains with bounded concurrency.
+    Only the leader claims jobs, a process that lost the lease finishes the ones it has and stops.
+    returns: The number of jobs that still need to be handed off
+    """
+    def process_jobs(self, state_manager: StateManager) -> int:
+        with self._in_flight_lock:
+            free = self._download_workers - self._busy
+        if self.leader != None and not self.leader.is_leader():
+            free = 0
+
+        owner = None if self.leader == None else self.leader.holder
+        for id, path, attempts in state_manager.claim_jobs(free, owner):
+            self._submit_job(id, path, attempts, state_manager)
+
+        return state_manager.count_open_jobs()
+
+    """
+    Delete the jobs handed off more than JOB_KEEP_SECONDS ago. Run on a schedule rather than every cycle.
+    """
+    def purge_jobs(self, state_manager: StateManager):
+        state_manager.delete_finished_jobs(time.time() - RDManager.JOB_KEEP_SECONDS)
+
+    """
+    Start a claimed job unless it is already running.
+    This guards against overlapping poll cycles sending the same id twice.
+    returns: True if the job was submitted.
+    """
+    def _submit_job(self, id: str, path: str, attempts: int, state_manager: StateManager) -> bool:
+        with self._in_flight_lock:
+            if id in self._in_flight:
+                return False
+            self._in_flight[id] = concurrent.futures.Future()
+            self._busy += 1
+        self._start_job(id, path, attempts, state_manager)
+        return True
+
+    """
+    Run a job on the download pool.
+    """
+    def _start_job(self, id: str, path: str, attempts: int, state_manager: StateManager):
+        self._download_pool.submit(self._run_job, id, path, attempts, state_manager)
+
+    """
+    Unrestrict a job's links and hand them to JDownloader. Runs on the download pool.
+    """
+    def _run_job(self, id: str, path: str, attempts: int, state_manager: StateManager):
+        try:
+            handoff = self.submit_download(id, path)
+        except Exception as e:
+            self._logger.exception("Failed to download id: %s, path: %s" % (id, path))
+            handoff = self._failed_handoff(str(e))
+        self._await_handoff(id, path, attempts, handoff, state_manager)
+
+    """
+    Free the job's download worker and record its outcome once JDownloader answers.
+    A batching JDownloader holds the handoff for a while, so the worker is not kept waiting on it.
+    handoff: Future with the JDownloader result
+    """
+    def _await_handoff(self, id: str, path: str, attempts: int, handoff: concurrent.futures.Future, state_manager: StateManager):
+        with self._in_flight_lock:
+            self._busy -= 1
+        handoff.add_done_callback(lambda future: self._finish_job(id, path, attempts, future, state_manager))
+        self.process_jobs(state_manager)
+
+    """
+    Record the outcome of a job handed to JDownloader and take it out of flight.
+    """
+    def _finish_job(self, id: str, path: str, attempts: int, handoff: concurrent.futures.Future, state_manager: StateManager):
+        try:
+            try:
+                result = handoff.result()
+                error = None if len(result) > 0 else "JDownloader did not accept the links."
+            except Exception as e:
+                error = str(e)
+            self._complete_job(id, path, attempts, error, state_manager)
+        finally:
+            # Only leave in flight once the outcome is recorded, so waiting on downloads sees it.
+            with self._in_flight_lock:
+                done = self._in_flight.pop(id)
+            done.set_result(None)
+
+    """
+    Record the outcome of a job, scheduling a retry if it failed and has attempts left.
+    error: Why the attempt failed, None if it succeeded
+    """
+    def _complete_job(self, id: str, path: str, attempts: int, error: str, state_manager: StateManager):
+        attempts += 1
+        if error == None:
+            state_manager.update_job(id, JobState.HANDED_OFF, attempts)
+        elif attempts >= RDManager.JOB_MAX_ATTEMPTS:
+            self._logger.error("Giving up on id: %s, path: %s after %d attempts. %s" % (id, path, attempts, error))
+            state_manager.update_job(id, JobState.FAILED, attempts, error=error)
+        else:
+            delay = min(RDManager.JOB_RETRY_CAP, RDManager.JOB_RETRY_BASE * (2 ** (attempts - 1)))
+            self._logger.warning("Failed to hand off id: %s, path: %s. Retrying in %d seconds. %s" % (id, path, delay, error))
+            state_manager.update_job(id, JobState.PENDING, attempts, time.time() + delay, error)
+
+    """
+    Wait for every download job currently in flight, and any they start, to finish.
+    timeout: The maximum number of seconds to wait. None waits forever.
+    """
+    def wait_for_downloads(self, timeout: float = None):
+        end = None if timeout == None else time.monotonic() + timeout
+        while True:
+            with self._in_flight_lock:
+                futures = list(self._in_flight.values())
+            if len(futures) == 0:
+                return
+
+            remaining = None if end == None else end - time.monotonic()
+            if remaining != None and remaining <= 0:
+                return
+            concurrent.futures.wait(futures, timeout=remaining)
+
+    """
+    Select all files for the given id when it has waiting_file_selection
+    """
+    def _select_files_for_torrent(self, id: str):
+        try:
+            self._request('POST', "torrents/selectFiles/" + id, data={'files': 'all'})
+        except requests.exceptions.RequestException as e:
+            self._logger.warning("Failed to select files for torrent with id: %s. %s" % (id, str(e)))
+
+    """
+    Function to check with real debrid to see file status and react accordingly
+    """
+    def rd_listener(self, state_manager: StateManager) -> bool:
+
+        # Retry any download jobs that are due before checking RD.
+        open_jobs = self.process_jobs(state_manager)
+
+        # If nothing is due for a check, why poll RD?
+        plan = self._start_cycle(state_manager, open_jobs)
+        if plan == None:
             return True
+        due, progress, watched_count = plan
 
-        # Try to get RD torrents list
+        # Try to get the due torrents from RD, keeping every listed torrent for the info hash index.
+        listed = []
         try:
-            req = requests.get(self._server + "torrents", headers=self._header)
-        except:
-            # Most likely polling too quicly. Just wait for the next poll
+            if self._choose_strategy(len(due)) == 'info':
+                torrents = self._fetch_torrents_by_id(due)
+            else:
+                torrents = self._fetch_torrents_by_page(due, listed)
+        except requests.exceptions.RequestException:
+            # Out of retries. Just wait for the next poll
             self._logger.warning("Failed to get the torrent list from Real-Debrid. Might be polling too fast.")
             return False
 
+        if torrents == None:
+            return False
+
+        self._finish_cycle(torrents, due, watched_count, state_manager, progress, listed)
+        return True
+
+    """
+    Work out which watched ids are due for a check this cycle. Ids whose ETA puts
+    their completion in the future are skipped until their next check.
+    returns: A tuple of (due content, progress samples, watched count), or None if nothing is due.
+    """
+    def _start_cycle(self, state_manager: StateManager, open_jobs: int = 0) -> tuple:
+        watched = state_manager.get_all_as_dict()
+        if len(watched) == 0:
+            self.last_cycle = self._new_cycle(0, open_jobs)
+            return None
+
+        progress = state_manager.get_all_progress()
+        now = time.time()
+        due = {id: info for id, info in watched.items()
+            if id not in progress or progress[id]['next_check'] == None or progress[id]['next_check'] <= now}
+        if len(due) == 0:
+            self.last_cycle = self._new_cycle(len(watched), open_jobs)
+            return None
+
+        return due, progress, len(watched)
+
+    """
+    Pick the cheaper way to fetch the watched torrents. Listing costs one call per page
+    of account history, the info endpoint costs one call per watched id.
+    watched_count: The number of ids being checked
+    returns: 'pages' or 'info'
+    """
+    def _choose_strategy(self, watched_count: int) -> str:
+
+        # Until the account has been listed once we do not know how many pages there are.
+        if self._account_size == None:
+            strategy = 'pages'
+        else:
+            pages = max(1, -(-self._account_size // RDManager.PAGE_SIZE))
+            strategy = 'info' if watched_count < pages else 'pages'
+
+        if strategy != self._strategy:
+            self._logger.info("RD listener fetching %d watched torrents using %s (account size: %s)."
+                % (watched_count, 'the info endpoint' if strategy == 'info' else 'the paged torrent list', self._account_size))
+        self._strategy = strategy
+        return strategy
+
+    """
+    Page through the account torrents, newest first, until every watched id has been found.
+    returns: The watched torrents, or None if RD returned an error
+    """
+    def _fetch_torrents_by_page(self, watched: dict, listed: list = None) -> list:
+        torrents = []
+        remaining = set(watched)
+        page = 1
+        while len(remaining) > 0:
+            req = self._request('GET', "torrents", params={'page': page, 'limit': RDManager.PAGE_SIZE})
+            items = self._parse_torrent_list(req)
+            if items == None:
+                return None
+
+            if not self._add_page(items, req, remaining, torrents, listed):
+                break
+            page += 1
+
+        return torrents
+
+    """
+    Keep the watched torrents from one page of the torrent list.
+    listed: List every torrent on the page is added to, if given
+    returns: True if there may be more pages
+    """
+    def _add_page(self, items: list, req, remaining: set, torrents: list, listed: list = None) -> bool:
+        if 'X-Total-Count' in req.headers:
+            self._account_size = int(req.headers['X-Total-Count'])
+
+        if listed != None:
+            listed.extend(items)
+
+        for file in items:
+            if file['id'] in remaining:
+                remaining.discard(file['id'])
+                torrents.append(file)
+
+        return len(items) >= RDManager.PAGE_SIZE
+
+    """
+    Get each watched torrent from the info endpoint.
+    returns: The watched torrents that still exist on RD, or None if RD returned an error
+    """
+    def _fetch_torrents_by_id(self, watched: dict) -> list:
+        torrents = []
+        for id in watched:
+            ok, file = self._parse_torrent_info(self._request('GET', "torrents/info/%s" % id))
+            if not ok:
+                return None
+            if file != None:
+                torrents.append(file)
+        return torrents
+
+    """
+    Get the torrent out of a torrents/info response.
+    returns: A tuple of (bool, torrent). The bool is False if RD returned an error,
+    the torrent is None if it no longer exists on RD.
+    """
+    def _parse_torrent_info(self, req) -> tuple:
+        if req.status_code == 404:
+            return (True, None)
+
+        if(req.status_code == 401 or req.status_code == 403):
+            self._logger.error("Failed to connect to real debrid. Error code: %s. Out of premium/banned?" % (str(req.status_code)))
+            return (False, None)
+
+        if req.status_code != 200:
+            self._logger.warning("Failed to get torrent info from Real-Debrid. Code: %d" % req.status_code)
+            return (False, None)
+
+        return (True, json.loads(req.text))
+
+    """
+    Get the torrents out of a torrents response.
+    returns: The list of torrents, or None if RD returned an error
+    """
+    def _parse_torrent_list(self, req) -> list:
+
         # Check if we failed to connect.
         if(req.status_code == 401 or req.status_code == 403):
             self._logger.error("Failed to connect to real debrid. Error code: %s. Out of premium/banned?" % (str(req.status_code)))
-            return False
+            return None
 
-        res = json.loads(req.text)
-        seen_ids = {}
+        # RD answers 204 when there are no torrents on the account.
+        if req.status_code == 204:
+            return []
+        elif req.status_code == 200:
+            return json.loads(req.text)
+
+        self._logger.warning("Failed to get the torrent list from Real-Debrid. Code: %d" % req.status_code)
+        return None
+
+    """
+    Reconcile the torrent list with the due content, then apply every change from this cycle
+    and a progress sample for everything still being watched in one commit.
+    listed: Every torrent listed from RD this cycle, added to the info hash index
+    """
+    def _finish_cycle(self, torrents: list, due: dict, watched_count: int, state_manager: StateManager, progress: dict,
+        listed: list = None):
+        changes, cycle = self._reconcile(torrents, due)
+
+        now = time.time()
+        removed = set(changes['removals']) | set(changes['downloads'])
+        samples = [self._sample(file, progress.get(file['id']), now) for file in torrents
+            if file['id'] in due and file['id'] not in removed]
+        state_manager.save_cycle(self._hash_rows(torrents if listed == None else listed + torrents), changes['downloads'],
+            changes['removals'], changes['forgotten'], samples)
+
+        cycle['watched'] = watched_count
+        cycle['jobs'] = self.process_jobs(state_manager)
+        self.last_cycle = cycle
+        self._logger.debug("RD listener cycle: %s" % cycle)
+
+    """
+    Build a progress sample for a torrent, estimating when it will finish.
+    Uses the speed RD reports and falls back to the progress made since the last sample.
+    file: The torrent from RD
+    previous: The last progress sample for the torrent, None if there is none
+    now: The current time in seconds
+    returns: A tuple of (id, status, progress, speed, eta, next_check, sampled_at)
+    """
+    def _sample(self, file: dict, previous: dict, now: float) -> tuple:
+        percent = file.get('progress', 0)
+        speed = file.get('speed', 0)
+        eta = None
+
+        if file['status'] == 'downloading':
+            if speed > 0 and file.get('bytes', 0) > 0:
+                eta = file['bytes'] * (100 - percent) / 100 / speed
+            elif previous != None and previous['progress'] != None and percent > previous['progress']:
+                rate = (percent - previous['progress']) / (now - previous['sampled_at'])
+                eta = (100 - percent) / rate
+
+        # Without an estimate the torrent is checked every cycle.
+        next_check = now if eta == None else now + min(eta, RDManager.MAX_CHECK_DELAY)
+        return (file['id'], file['status'], percent, speed, eta, next_check, now)
+
+    """
+    Diff the RD torrent list against the watched content and dispatch each watched
+    torrent to the handler for its status. Runs in O(torrents + watched).
+    Nothing is written here, the changes are saved together at the end of the cycle.
+    torrents: The torrent list returned by RD
+    watched: Dictionary of watched content in the format {ID: {title: "", path: ""}}
+    returns: A tuple of (changes, dictionary of cycle counters). Changes is a dictionary of lists of ids:
+    removals to stop watching, downloads that finished and forgotten to drop from the info hash index.
+    """
+    def _reconcile(self, torrents: list, watched: dict) -> tuple:
+        cycle = self._new_cycle(len(watched))
+        cycle['checked'] = len(watched)
+        changes = {'removals': [], 'downloads': [], 'forgotten': []}
+        removals = changes['removals']
+        unseen = set(watched)
+
+        for file in torrents:
+
+            # Skip anything not being watched, or already handled this cycle.
+            if file['id'] not in unseen:
+                continue
+            unseen.discard(file['id'])
+            cycle['seen'] += 1
+
+            handler = self._status_handlers.get(file['status'])
+            if handler != None and handler(file, watched[file['id']], changes, cycle):
+                removals.append(file['id'])
 
-        watched_ids = state_manager.get_all_ids()
-        
-        # For each of the different torrent files we obtained
-        for file in res:
-
-            # If the file is being watched, check status
-            if file['id'] in watched_ids:
-                seen_ids[file['id']] = True
-
-                info = state_manager.get_info(file['id'])
-
-                # If there is no info, then the id isn't in the database.
-                # Remove it from the state manager as some how its reporting with an id.
-                if info == ():
-                    state_manager.delete_id(file['id'])
-                    continue
-
-                path = info[1]
-
-                # If its downloaded and ready, process and remove for next cycle. 
-                # Otherwise if error log and remove.
-                if file['status'] == 'downloaded':
-                    self._download_id_and_remove_if_success(file['id'], path, state_manager)
-                elif file['status'] == 'magnet_error':
-                    self._logger.error("Magnet error on torrent with id: %s, path: %s" 
-                        % (file['id'], path))
-                    state_manager.delete_id(file['id'])
-                    continue
-                elif file['status'] == 'virus':
-                    self._logger.error("Virus detected on torrent with id: %s, path: %s" 
-                        % (file['id'], path))
-                    state_manager.delete_id(file['id'])
-                    continue
-                elif file['status'] == 'error':
-                    self._logger.error("Generic error on torrent with id: %s, path: %s" 
-                        % (file['id'], path))
-                    state_manager.delete_id(file['id'])
-                    continue
-                elif file['status'] == 'dead':
-                    self._logger.error("Dead torrent with id: %s, path: %s" 
-                        % (file['id'], path))
-                    state_manager.delete_id(file['id'])
-                    continue
-                elif file['status'] == 'waiting_files_selection':
-                    self._select_files_for_torrent(file['id'])
-                    state_manager.delete_id(file['id'])
-                    continue
-        
         # Remove all ids that were not included in the torrents check.
         # I believe this only happens when the torrent is deleted from real-debrid.
-        watched_ids = state_manager.get_all_ids()
-
-        for id in watched_ids:
-            if id not in seen_ids:
-                
-                # Same check as above, make sure there is info
-                info = state_manager.get_info(id)
-                if info == ():
-                    state_manager.delete_id(id)
-                    self._logger.warning("Torrent failed to be checked with RD (deleted from torrents?) id: %s" 
-                        % (id))
-                    continue
-
-                path = info[1]
-                self._logger.warning("Torrent failed to be checked with RD (deleted from torrents?) id: %s, path: %s" 
-                    % (id, path))
-                state_manager.delete_id(id)
-
-        return True
\ No newline at end of file
+        for id in unseen:
+            self._logger.warning("Torrent failed to be checked with RD (deleted from torrents?) id: %s, path: %s" 
+                % (id, watched[id]['path']))
+            cycle['vanished'] += 1
+            removals.append(id)
+        changes['forgotten'].extend(unseen)
+
+        return changes, cycle
+
+    """
+    Get the counters for a new listener cycle.
+    watched: The number of ids being watched this cycle
+    jobs: The number of download jobs still to be handed off
+    """
+    def _new_cycle(self, watched: int, jobs: int = 0) -> dict:
+        return {'watched': watched, 'checked': 0, 'seen': 0, 'downloaded': 0, 'errored': 0, 'vanished': 0, 'finishing': 0,
+            'jobs': jobs}
+
+class RDPoller():
+    """
+    Adaptive scheduler running the RD listener on its own thread.
+    Sleeps while nothing is watched and wakes as soon as content is added, polls faster
+    while torrents are close to finishing, and backs off exponentially when RD fails.
+
+    Attributes:
+        rd_manager: The RDManager whose listener is run
+        state_manager: The StateManager holding the watched content
+        interval: Seconds between polls while torrents are being watched
+        fast_interval: Seconds between polls while a torrent is close to finishing
+        max_backoff: The longest wait in seconds after repeated RD failures
+        leader: The LeaderElection deciding if this process polls, None to always poll
+        _idle_version: The content version when the poller went idle, None while it is not idle
+        _failures: Number of failed polls in a row
+        _wake: Event set when the poller should poll right away
+    """
+
+    def __init__(self, rd_manager: RDManager, state_manager: StateManager, logger: logging.Logger = None,
+        interval: float = 15, fast_interval: float = 5, max_backoff: float = 300, leader: LeaderElection = None):
+        self.rd_manager = rd_manager
+        self.leader = leader
+        self.state_manager = state_manager
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.max_backoff = max_backoff
+        self._idle_version = None
+        self._failures = 0
+        self._wake = threading.Event()
+        self._thread = None
+
+        # Use default logger if none is provided.
+        if logger == None:
+            logger = logging.getLogger()
+        self._logger = logger
+
+        state_manager.register_callback(self.wake)
+
+    """
+    Start polling on a daemon thread.
+    """
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='rd-poller', daemon=True)
+        self._thread.start()
+
+    """
+    Poll right away. Called when content is added.
+    """
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                delay = self.poll()
+            except Exception:
+                self._logger.exception("RD poller failed.")
+                delay = self._next_delay(False)
+
+            # Wait out a backoff in full, otherwise an add can cut the wait short.
+            if self._failures > 0:
+                time.sleep(delay)
+            else:
+                self._wake.wait(delay)
+
+    """
+    Run the listener once.
+    returns: Seconds until the next poll, None to wait until woken
+    """
+    def poll(self) -> float:
+
+        # Only the leader polls. The others check back in case the leader goes away.
+        if self.leader != None and not self.leader.is_leader():
+            return self.interval
+
+        version = None
+        try:
+            # Content added by another worker does not wake this one, so while idle the content version
+            # is checked instead. The listener only runs again once it changes.
+            if self.leader != None:
+                version = self.state_manager.get_content_version()
+                if version == self._idle_version:
+                    return self.interval
+            self._idle_version = None
+
+            success = self.rd_manager.rd_listener(self.state_manager)
+        except Exception:
+            self._logger.exception("RD listener failed.")
+            success = False
+
+        delay = self._next_delay(success)
+        if delay == None and self.leader != None:
+            self._idle_version = version
+            return self.interval
+        return delay
+
+    """
+    Work out the wait before the next poll from the result of the last one.
+    success: If the last poll succeeded
+    returns: Seconds until the next poll, None to wait until woken
+    """
+    def _next_delay(self, success: bool) -> float:
+        if not success:
+            self._failures += 1
+            delay = min(self.max_backoff, self.interval * (2 ** self._failures))
+            self._logger.warning("RD listener failed %d times in a row. Next poll in %d seconds." % (self._failures, delay))
+            return delay
+
+        self._failures = 0
+        cycle = self.rd_manager.last_cycle
+        if cycle.get('watched', 0) == 0 and cycle.get('jobs', 0) == 0:
+            return None
+        if cycle.get('finishing', 0) > 0:
+            return self.fast_interval
+        return self.interval
+
+class MagnetResolver():
+    """
+    Resolves Jackett download urls to magnet links. Redirects are read from the Location header
+    one hop at a time rather than followed, so no response body is downloaded unless Jackett
+    answers with the .torrent itself, in which case the magnet is built from its info hash.
+    Attributes:
+        max_hops: The most redirects followed before giving up
+        timeout: Seconds to wait on each hop
+        _cache: TTLCache of url to resolved magnet
+        _session: Keep-alive HTTP session used for every hop
+        _logger: Logger used to report failures
+    """
+
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+    # Largest .torrent read when Jackett returns the file instead of a magnet.
+    MAX_TORRENT_SIZE = 10 * 1024 * 1024
+
+    # Deepest nesting of lists and dictionaries accepted in a torrent file.
+    MAX_BENCODE_DEPTH = 32
+
+    def __init__(self, max_hops: int = 5, timeout: float = 10, cache_size: int = 500, cache_ttl: float = 60 * 60,
+        logger: logging.Logger = None):
+        self.max_hops = max_hops
+        self.timeout = timeout
+        self._cache = TTLCache(cache_size, cache_ttl)
+        self._session = requests.Session()
+        self._logger = logger if logger != None else logging.getLogger(__name__)
+
+    """
+    Resolve a url to a magnet link.
+    url: A magnet link, or a url that redirects to a magnet link or .torrent file
+    returns: A tuple of (bool, magnet/error)
+    """
+    def resolve(self, url: str) -> tuple:
+        if url.startswith('magnet:'):
+            return (True, url)
+
+        magnet = self._cache.get(url)
+        if magnet != None:
+            return (True, magnet)
+
+        result = self._resolve(url)
+        if result[0]:
+            self._cache.set(url, result[1])
+        else:
+            self._logger.warning(result[1])
+        return result
+
+    def _resolve(self, url: str) -> tuple:
+        current = url
+        for hop in range(0, self.max_hops + 1):
+            try:
+                with self._session.get(current, allow_redirects=False, stream=True, timeout=self.timeout) as req:
+                    if req.status_code in MagnetResolver.REDIRECT_STATUSES:
+                        location = req.headers.get('Location')
+                        if location == None:
+                            return (False, "Redirect from %s has no location." % current)
+                        if location.startswith('magnet:'):
+                            return (True, location)
+                        current = urljoin(current, location)
+                        continue
+
+                    if req.status_code != 200:
+                        return (False, "Failed to resolve %s. Code: %d" % (current, req.status_code))
+
+                    return self._magnet_from_torrent(req)
+            except requests.exceptions.RequestException as e:
+                return (False, "Failed to resolve %s. %s" % (current, str(e)))
+
+        return (False, "Too many redirects resolving %s." % url)
+
+    """
+    Build a magnet link from a .torrent response.
+    returns: A tuple of (bool, magnet/error)
+    """
+    def _magnet_from_torrent(self, req) -> tuple:
+        data = bytearray()
+        for chunk in req.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > MagnetResolver.MAX_TORRENT_SIZE:
+                return (False, "Torrent from %s is too large." % req.url)
+        data = bytes(data)
+
+        try:
+            torrent, end, info = self._bdecode(data, 0)
+            if not isinstance(torrent, dict) or info == None or not isinstance(torrent[b'info'], dict):
+                raise ValueError("no info dictionary")
+        except (ValueError, IndexError, TypeError, AttributeError, RecursionError) as e:
+            return (False, "Response from %s is not a magnet or torrent. %s" % (req.url, str(e)))
+
+        params = [('xt', 'urn:btih:' + hashlib.sha1(data[info[0]:info[1]]).hexdigest())]
+        name = torrent[b'info'].get(b'name')
+        if isinstance(name, bytes):
+            params.append(('dn', name.decode('utf-8', 'replace')))
+
+        tiers = torrent.get(b'announce-list')
+        trackers = [torrent.get(b'announce')] + [x for tier in (tiers if isinstance(tiers, list) else []) if isinstance(tier, list) for x in tier]
+        for tracker in dict.fromkeys(x for x in trackers if isinstance(x, bytes)):
+            params.append(('tr', tracker.decode('utf-8', 'replace')))
+
+        return (True, 'magnet:?' + urlencode(params, safe=':/'))
+
+    """
+    Decode a bencoded value.
+    data: The bencoded bytes
+    i: The index the value starts at
+    depth: How deeply the value is nested, 0 for the top level
+    returns: A tuple of (value, index after the value, (start, end) of the top level info dictionary or None)
+    raises: ValueError when the data is not valid bencode
+    """
+    def _bdecode(self, data: bytes, i: int, depth: int = 0) -> tuple:
+        if depth > MagnetResolver.MAX_BENCODE_DEPTH:
+            raise ValueError("nested too deeply at %d" % i)
+
+        kind = data[i:i + 1]
+        if kind == b'i':
+            end = data.index(b'e', i)
+            return int(data[i + 1:end]), end + 1, None
+
+        if kind == b'l':
+            values = []
+            i += 1
+            while data[i:i + 1] != b'e':
+                value, i, _ = self._bdecode(data, i, depth + 1)
+                values.append(value)
+            return values, i + 1, None
+
+        if kind == b'd':
+            values = {}
+            info = None
+            i += 1
+            while data[i:i + 1] != b'e':
+                key, i, _ = self._bdecode(data, i, depth + 1)
+                if not isinstance(key, bytes):
+                    raise ValueError("dictionary key is not a string at %d" % i)
+                start = i
+                values[key], i, _ = self._bdecode(data, i, depth + 1)
+                if depth == 0 and key == b'info':
+                    info = (start, i)
+            return values, i + 1, info
+
+        if kind.isdigit():
+            colon = data.index(b':', i)
+            end = colon + 1 + int(data[i:colon])
+            if end > len(data):
+                raise ValueError("string runs past the end of the data")
+            return data[colon + 1:end], end, None
+
+        raise ValueError("unexpected %r at %d" % (kind, i))
+
+class JackettManager():
+    """
+    Manager for Jackett searches. Results are cached by normalized query and categories.
+    Fresh results are returned straight from the cache, stale results are returned while
+    being refreshed in the background, and identical searches running at the same time
+    share a single call to Jackett.
+    Attributes:
+        _url: The Jackett server url
+        _api_key: The Jackett api key
+        ttl: Seconds a result is fresh for
+        stale_ttl: Seconds a result can still be returned while it is refreshed
+        timeout: Seconds to wait for Jackett to answer
+        _cache: TTLCache of search key to (text, status code, time fetched, trimmed results)
+        _in_flight: Dictionary of search key to the future of the call to Jackett running for it
+        _lock: Lock guarding _in_flight and the counters
+        _refresh_pool: Worker pool refreshing stale results
+        _stats: Counters of fresh hits, stale hits, misses, shared calls and refreshes
+        _logger: Logger used to report failures
+    """
+
+    def __init__(self, url: str, api_key: str, cache_size: int = 100, ttl: float = 5 * 60, stale_ttl: float = 60 * 60,
+        timeout: float = 60, logger: logging.Logger = None):
+        self._url = url
+        self._api_key = api_key
+        self.ttl = ttl
+        self.stale_ttl = max(ttl, stale_ttl)
+        self.timeout = timeout
+        self._cache = TTLCache(cache_size, self.stale_ttl)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='jackett-refresh')
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'shared': 0, 'refreshes': 0}
+        self._logger = logger if logger != None else logging.getLogger(__name__)
+
+    # Fields kept for each result when results are trimmed, as (field, Jackett field).
+    RESULT_FIELDS = (('title', 'Title'), ('size', 'Size'), ('seeders', 'Seeders'), ('peers', 'Peers'),
+        ('magnet', 'MagnetUri'), ('link', 'Link'), ('tracker', 'Tracker'), ('published', 'PublishDate'))
+
+    """
+    Search every Jackett indexer.
+    query: The item to search for
+    categories: List of Jackett categories
+    returns: A tuple of (response text, status code)
+    """
+    def search(self, query: str, categories: list) -> tuple:
+        text, status, results = self._search(query, categories)
+        return (text, status)
+
+    """
+    Search every Jackett indexer and get the results cut down to RESULT_FIELDS.
+    returns: A tuple of (list of results, response text, status code). The list is None if the search failed.
+    """
+    def search_results(self, query: str, categories: list) -> tuple:
+        text, status, results = self._search(query, categories)
+        return (results, text, status)
+
+    def _search(self, query: str, categories: list) -> tuple:
+        key = self._key(query, categories)
+        entry = self._cache.get(key)
+        if entry != None:
+            text, status, fetched, results = entry
+            if time.time() - fetched < self.ttl:
+                self._count('hits')
+                return (text, status, results)
+
+            self._count('stale_hits')
+            self._revalidate(key)
+            return (text, status, results)
+
+        self._count('misses')
+        return self._fetch(key)
+
+    """
+    Sort, filter and page trimmed results.
+    sort: The field to sort by, None to keep Jackett's order
+    descending: True to sort from largest to smallest
+    min_seeders: Results with fewer seeders are dropped, None for no limit
+    max_size: Results larger than this many bytes are dropped, None for no limit
+    page: The page to return, starting at 1
+    limit: The number of results on each page
+    returns: A tuple of (number of results matching the filters, list of results on the page)
+    """
+    @staticmethod
+    def select(results: list, sort: str = None, descending: bool = True, min_seeders: int = None, max_size: int = None,
+        page: int = 1, limit: int = 50) -> tuple:
+        matches = [x for x in results
+            if (min_seeders == None or (x['seeders'] or 0) >= min_seeders) and (max_size == None or (x['size'] or 0) <= max_size)]
+
+        if sort != None:
+            # Results missing the field always go last.
+            present = [x for x in matches if x[sort] != None]
+            missing = [x for x in matches if x[sort] == None]
+            matches = sorted(present, key=lambda x: x[sort], reverse=descending) + missing
+
+        start = (page - 1) * limit
+        return len(matches), matches[start:start + limit]
+
+    """
+    Get the cache counters.
+    returns: Dictionary of counter name to value, with the number of cached searches as size
+    """
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._in_flight)
+        stats['size'] = len(self._cache)
+        return stats
+
+    """
+    Get the cache key for a search. Case, surrounding whitespace and category order do not matter.
+    """
+    def _key(self, query: str, categories: list) -> tuple:
+        return (" ".join(query.lower().split()), tuple(sorted(set(x.strip() for x in categories if x.strip() != ''))))
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._stats[counter] += 1
+
+    """
+    Refresh a stale result in the background unless it is already being fetched.
+    """
+    def _revalidate(self, key: tuple):
+        with self._lock:
+            if key in self._in_flight:
+                return
+            self._stats['refreshes'] += 1
+        self._refresh_pool.submit(self._fetch, key)
+
+    """
+    Get a search from Jackett, joining the call already running for the same key if there is one.
+    Only successful results are cached.
+    returns: A tuple of (response text, status code, trimmed results or None)
+    """
+    def _fetch(self, key: tuple) -> tuple:
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future == None
+            if owner:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+            else:
+                self._stats['shared'] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            text, status = self._request(key)
+            results = self._trim(text) if status == 200 else None
+            result = (text, status, results)
+            if results != None:
+                self._cache.set(key, (text, status, time.time(), results))
+        except Exception as e:
+            self._logger.warning("Jackett search failed. %s" % str(e))
+            result = (json.dumps({'Error': "Jackett search failed. %s" % str(e)}), 502, None)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+        future.set_result(result)
+        return result
+
+    def _request(self, key: tuple) -> tuple:
+        query, categories = key
+        params = [('apikey', self._api_key)] + [('Category', x) for x in categories] + [('t', 'search'), ('limit', 1000), ('Query', query)]
+        req = requests.get(self._url + "api/v2.0/indexers/all/results/", params=params, timeout=self.timeout)
+        return (req.text, req.status_code)
+
+    """
+    Parse a Jackett response and keep only RESULT_FIELDS of each result.
+    returns: The list of trimmed results, or None if the response could not be parsed
+    """
+    def _trim(self, text: str) -> list:
+        try:
+            data = json.loads(text)
+        except ValueError:
+            self._logger.warning("Jackett returned a response that is not JSON.")
+            return None
+
+        return [{field: x.get(name) for field, name in JackettManager.RESULT_FIELDS} for x in data.get('Results', [])]
@@ -1,6 +1,10 @@
 from enum import Enum
 from datetime import date
+from collections import deque, OrderedDict
 from collections.abc import Callable
+from contextlib import contextmanager
+import threading
+import time
 
 class Session():
     """
@@ -32,22 +36,202 @@ class DictionaryEventType(Enum):
 
     SET_EVENT = 1
     DEL_EVENT = 2
+    BATCH_EVENT = 3
+
+class JobState(Enum):
+    """
+    State of a download job in the StateManager job table.
+    """
+
+    PENDING = 'pending'
+    UNRESTRICTING = 'unrestricting'
+    HANDED_OFF = 'handed_off'
+    FAILED = 'failed'
+
+class SubmissionState(Enum):
+    """
+    State of a content submission accepted in async mode.
+    """
+
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
 
 class EventDictionary(dict):
     """
     Dictionary class that will callback when items are set or deleted.
+    Changes made inside batch(), or by a bulk method such as update or clear, are grouped into
+    a single callback of the form func(None, [(key, val, DictionaryEventType)], DictionaryEventType.BATCH_EVENT).
     Attributes:
-        callback: A call back function of the form func(key, val, DictionaryEventType)
+        callback: A call back function of the form func(key, val, DictionaryEventType), or None
+        _batch: List of the changes made in the open batch, None outside a batch
+        _depth: Number of batches open, batches can be nested
     """
     def __init__(self, callback: Callable[[str, str, DictionaryEventType], None]):
         super().__init__()
         self.callback = callback
+        self._batch = None
+        self._depth = 0
 
     def __setitem__(self, key: str, value: str):
         super().__setitem__(key, value)
-        self.callback(key, value, DictionaryEventType.SET_EVENT)
+        self._notify(key, value, DictionaryEventType.SET_EVENT)
 
     def __delitem__(self, key: str):
         value = self[key]
         super().__delitem__(key)
-        self.callback(key, value, DictionaryEventType.DEL_EVENT)
\ No newline at end of file
+        self._notify(key, value, DictionaryEventType.DEL_EVENT)
+
+    """
+    Group every change made inside the with block into one BATCH_EVENT fired when the
+    outermost batch closes. Changes are applied straight away and are not rolled back on error.
+    """
+    @contextmanager
+    def batch(self):
+        if self._depth == 0:
+            self._batch = []
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                events, self._batch = self._batch, None
+                if len(events) > 0 and self.callback != None:
+                    self.callback(None, events, DictionaryEventType.BATCH_EVENT)
+
+    def update(self, *args, **kwargs):
+        with self.batch():
+            for key, value in dict(*args, **kwargs).items():
+                self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key: str, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if len(default) > 0:
+            return default[0]
+        raise KeyError(key)
+
+    def popitem(self) -> tuple:
+        key, value = super().popitem()
+        self._notify(key, value, DictionaryEventType.DEL_EVENT)
+        return (key, value)
+
+    def setdefault(self, key: str, default: str = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        with self.batch():
+            for key in list(self):
+                del self[key]
+
+    """
+    Send a change to the callback, or hold it until the open batch closes.
+    """
+    def _notify(self, key: str, value: str, event: DictionaryEventType):
+        if self._batch != None:
+            self._batch.append((key, value, event))
+        elif self.callback != None:
+            self.callback(key, value, event)
+
+class RateLimiter():
+    """
+    Thread safe limiter allowing at most a number of calls in a sliding time window.
+    Callers block in acquire until a call is allowed.
+    Attributes:
+        calls: The number of calls allowed in each period
+        period: The length of the window in seconds
+    """
+    def __init__(self, calls: int, period: float):
+        self.calls = calls
+        self.period = period
+        self._times = deque()
+        self._lock = threading.Lock()
+
+    """
+    Block until a call is allowed.
+    """
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    """
+    Take a call if one is allowed right now without blocking.
+    returns: 0 if the call was taken, otherwise the seconds to wait before trying again
+    """
+    def try_acquire(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            while len(self._times) > 0 and now - self._times[0] >= self.period:
+                self._times.popleft()
+
+            if len(self._times) < self.calls:
+                self._times.append(now)
+                return 0
+
+            return self.period - (now - self._times[0])
+
+class TTLCache():
+    """
+    Thread safe least recently used cache where every entry also expires after a time to live.
+    Attributes:
+        max_size: The most entries kept. The least recently used entry is dropped past this.
+        ttl: The default number of seconds an entry lives for
+        hits: The number of lookups answered from the cache
+        misses: The number of lookups that were missing or expired
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    """
+    Get a value from the cache.
+    returns: The value, or None if it is missing or expired
+    """
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry == None or entry[1] <= time.time():
+                if entry != None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    """
+    Put a value in the cache.
+    expires: The unix time the entry expires at. Defaults to now plus the ttl.
+    """
+    def set(self, key, value, expires: float = None):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl if expires == None else expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    """
+    Remove a value from the cache if it is there.
+    """
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,64 +1,153 @@
 from dlapi import (app, limiter, logger, session_manager,
- real_debrid_manager, jdownload_manager, state_manager)
+ real_debrid_manager, jdownload_manager, state_manager, content_pool, magnet_resolver, jackett_manager, leader)
 
-from flask import request, jsonify
+from dlapi.utilclasses import SubmissionState
+from flask import request, jsonify, Response
 import requests
 import os
+import json
 from urllib.parse import unquote_plus
 
+# Most items accepted by one batch submission.
+MAX_BATCH_SIZE = 100
+
 # Endpoint to add content to be watched
 @app.route('/api/v1/content', methods=['POST'])
 @session_manager.requires_authentication
 def add_content():
-    id = None
-    title = None
     content = request.get_json(silent=True, force=True)
 
     if content == None:
         return {'Error' : 'No JSON provided'}, 400
 
-    if 'magnet_url' in content:
-        magnet_url = content['magnet_url']
-    elif 'id' in content:
-        id = (True, content['id'])
-    elif 'url' in content:
-
-        # Resolve the url to get the magnet link
-        url = content['url']
-        if url == None:
-            return{'Error' : "No link was provided"}, 400
-            
-        try:
-            url = requests.get(url).url
-        except requests.exceptions.InvalidSchema as e:
-            # Remove error intro
-            url = str(e)[39:]
-            url = url[:-1]
-
-        # Set magnet url for later.
-        magnet_url = url
-    else:
-        content = {'Error' : 'magnet_url is missing from post.'}
-        return content, 400
-    
-    if 'path' in content:
-        path = content['path']
-    else:
-        content = {'Error' : 'Path is missing from post.'}
-        return content, 400
+    item, error = parse_content(content)
+    if item == None:
+        return error
 
-    if 'title' in content:
-        title = content['title']
+    # In async mode the client gets a submission id right away and polls GET /api/v1/jobs/<id>.
+    if request.args.get('async', '').lower() == 'true':
+        job = state_manager.add_submission(None if leader == None else leader.holder)
+        content_pool.submit(run_submission, job, item)
+        return {'job': job}, 202
 
     # Send magnet link to be downloaded
-    if id == None:
-        id = real_debrid_manager.send_to_rd(magnet_url)
+    id = submit_content(item)
     if id[0] == False:
         return {'Error': id[1]}, 417
 
-    state_manager.add_content(id[1], path, title)
+    state_manager.add_content(id[1], item['path'], item['title'])
     return {}, 200
 
+# Endpoint to add many pieces of content at once. Items are sent to RD in parallel
+# and every one that succeeds is added to the state in one transaction.
+@app.route('/api/v1/content/batch', methods=['POST'])
+@session_manager.requires_authentication
+def add_content_batch():
+    content = request.get_json(silent=True, force=True)
+
+    if content == None:
+        return {'Error' : 'No JSON provided'}, 400
+    if not isinstance(content, list):
+        return {'Error' : 'A list of content was expected.'}, 400
+    if len(content) > MAX_BATCH_SIZE:
+        return {'Error' : 'At most %d items can be sent at once.' % MAX_BATCH_SIZE}, 400
+
+    # Identical sources are only sent to RD once. Sources can be any JSON value so they are keyed by their JSON.
+    parsed = [parse_content(x) if isinstance(x, dict) else (None, ({'Error' : 'Item is not an object.'}, 400)) for x in content]
+    keys = [None if item == None else json.dumps(item['source']) for item, error in parsed]
+    futures = {}
+    for (item, error), key in zip(parsed, keys):
+        if item != None and key not in futures:
+            futures[key] = content_pool.submit(try_submit_content, item)
+
+    results = []
+    rows = []
+    for (item, error), key in zip(parsed, keys):
+        if item == None:
+            results.append(dict(error[0], code=error[1]))
+            continue
+
+        id = futures[key].result()
+        if id[0] == False:
+            results.append({'Error': id[1], 'code': 417})
+        else:
+            rows.append((id[1], item['path'], item['title']))
+            results.append({'id': id[1], 'code': 200})
+
+    state_manager.add_many(rows)
+    return jsonify(results), 200
+
+# Endpoint to get the outcome of a content submission made in async mode
+@app.route('/api/v1/jobs/<job>', methods=['GET'])
+@session_manager.requires_authentication
+def get_job(job):
+    submission = state_manager.get_submission(job)
+    if submission == None:
+        return {'Error' : 'Job does not exist.'}, 404
+    return submission, 200
+
+"""
+Submit content in the background and record the outcome against the submission.
+"""
+def run_submission(job: str, item: dict):
+    id = try_submit_content(item)
+    if id[0] == False:
+        state_manager.finish_submission(job, SubmissionState.FAILED, {'Error': id[1]})
+    else:
+        state_manager.add_content(id[1], item['path'], item['title'])
+        state_manager.finish_submission(job, SubmissionState.DONE, {'id': id[1]})
+
+"""
+Same as submit_content, but a failure is returned as an error rather than raised
+so one bad item cannot fail the others sent with it.
+returns: A tuple of (bool, id/error)
+"""
+def try_submit_content(item: dict) -> tuple:
+    try:
+        return submit_content(item)
+    except Exception as e:
+        logger.exception("Failed to submit %s." % str(item['source']))
+        return (False, str(e))
+
+"""
+Validate a piece of content from a POST.
+content: The JSON object describing the content
+returns: A tuple of (item, error). item is None when the content is invalid, error is then a tuple of (error json, HTTP code)
+"""
+def parse_content(content: dict) -> tuple:
+    if 'magnet_url' in content:
+        source = ('magnet_url', content['magnet_url'])
+    elif 'id' in content:
+        source = ('id', content['id'])
+    elif 'url' in content:
+        if content['url'] == None:
+            return None, ({'Error' : "No link was provided"}, 400)
+        source = ('url', content['url'])
+    else:
+        return None, ({'Error' : 'magnet_url is missing from post.'}, 400)
+
+    if 'path' not in content:
+        return None, ({'Error' : 'Path is missing from post.'}, 400)
+
+    return {'source': source, 'path': content['path'], 'title': content.get('title')}, None
+
+"""
+Get the RD id for a parsed piece of content, resolving the url and sending the magnet to RD if needed.
+returns: A tuple of (bool, id/error)
+"""
+def submit_content(item: dict) -> tuple:
+    kind, value = item['source']
+    if kind == 'id':
+        return (True, value)
+
+    if kind == 'url':
+        # Resolve the url to get the magnet link
+        resolved, value = magnet_resolver.resolve(value)
+        if not resolved:
+            return (False, value)
+
+    return real_debrid_manager.send_to_rd(value, state_manager)
+
 # Endpoint for deleting content from being watched
 @app.route('/api/v1/content', methods=['DELETE'])
 @session_manager.requires_authentication
@@ -83,7 +172,7 @@ def remove_content():
 @app.route('/api/v1/content/all', methods=['GET'])
 @session_manager.requires_authentication
 def get_content():
-    return jsonify(state_manager.get_all_as_dict())
+    return jsonify(state_manager.get_all_with_progress())
 
 # Endpoint to get all watched content on RD
 @app.route('/api/v1/content/all', methods=['DELETE'])
@@ -126,7 +215,7 @@ def CORS_proxy():
 @app.route('/api/v1/jackett/search', methods=['GET'])
 @session_manager.requires_authentication
 def search_jackett():
-    if 'JACKETT_URL' not in os.environ or 'JACKETT_API_KEY' not in os.environ:
+    if jackett_manager == None:
         return {'Error': 'Jackett module is not enabled.'}, 410
 
     # Get query and categories
@@ -138,16 +227,68 @@ def search_jackett():
     if categories == None:
         return {'Error': 'Categories was not provided'}, 400
 
-    categories = '&Category=' + '&Category='.join(categories.split(','))
-
-    # Build the URL to connect to the JACKETT API.
-    build_query = os.environ['JACKETT_URL'] + "api/v2.0/indexers/all/results/?apikey=" + os.environ['JACKETT_API_KEY'] + categories + '&t=search&limit=1000&Query=' + query
-    
-    # Fix quotations and request a get to the link.
-    req = requests.get(build_query)
+    # Without a format the raw jackett response is returned as it always has been.
+    output_format = request.args.get('format')
+    if output_format == None:
+        # Search through the cache. Repeated searches are answered without asking jackett.
+        text, status = jackett_manager.search(query, categories.split(','))
+        return text, status
+
+    if output_format not in ('json', 'jsonl'):
+        return {'Error': 'format must be json or jsonl'}, 400
+
+    sort = request.args.get('sort')
+    if sort != None and sort not in ('title', 'size', 'seeders', 'peers', 'published'):
+        return {'Error': 'sort must be one of title, size, seeders, peers or published'}, 400
+
+    try:
+        min_seeders = int_arg('min_seeders', None, 0)
+        max_size = int_arg('max_size', None, 0)
+        page = int_arg('page', 1, 1)
+        limit = min(int_arg('limit', 50, 1), 1000)
+    except ValueError as e:
+        return {'Error': str(e)}, 400
+
+    results, text, status = jackett_manager.search_results(query, categories.split(','))
+    if results == None:
+        return text, status
+
+    total, selected = jackett_manager.select(results, sort, request.args.get('order', 'desc').lower() != 'asc',
+        min_seeders, max_size, page, limit)
+
+    # Stream the results rather than building the whole body.
+    if output_format == 'jsonl':
+        return Response((json.dumps(x) + '\n' for x in selected), mimetype='application/x-ndjson')
+
+    def generate():
+        yield '{"total": %d, "page": %d, "limit": %d, "results": [' % (total, page, limit)
+        for i, x in enumerate(selected):
+            yield (',' if i > 0 else '') + json.dumps(x)
+        yield ']}'
+    return Response(generate(), mimetype='application/json')
+
+"""
+Get an integer URL parameter.
+default: The value when the parameter is missing
+minimum: The smallest value allowed
+raises: ValueError when the parameter is not an integer of at least minimum
+"""
+def int_arg(name: str, default: int, minimum: int) -> int:
+    value = request.args.get(name)
+    if value == None:
+        return default
+    if not value.isdigit() or int(value) < minimum:
+        raise ValueError('%s must be an integer of at least %d' % (name, minimum))
+    return int(value)
+
+# Endpoint to see how well the jackett search cache is doing.
+@app.route('/api/v1/jackett/stats', methods=['GET'])
+@session_manager.requires_authentication
+def jackett_stats():
+    if jackett_manager == None:
+        return {'Error': 'Jackett module is not enabled.'}, 410
 
-    # Implement the jackett search functionality here.
-    return req.text, req.status_code
+    return jackett_manager.get_stats(), 200
 
 
 @app.route('/api/v1/authenticate', methods=['POST'])
@@ -12,4 +12,7 @@ setup(
         'flask-cors',
         'Flask-Limiter',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
 )
\ No newline at end of file
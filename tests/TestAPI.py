@@ -1,6 +1,7 @@
 
 import unittest
 import os
+import time
 from dlapi import app, state_manager
 
 class TestAPI(unittest.TestCase):
@@ -14,9 +15,10 @@ class TestAPI(unittest.TestCase):
         # As these are used in two test cases, might as well.
         # These are urls that require authentication to be used and need to be tested so that un-authorized access is not allowed.
         state_manager.clear()
-        self.post_urls = ['/api/v1/content']
+        self.post_urls = ['/api/v1/content', '/api/v1/content/batch']
         self.delete_urls = ['/api/v1/content', '/api/v1/content/all']
-        self.get_urls = ['/api/v1/content/all', '/api/v1/content/check', '/api/v1/corsproxy', '/api/v1/jackett/search']
+        self.get_urls = ['/api/v1/content/all', '/api/v1/content/check', '/api/v1/corsproxy', '/api/v1/jackett/search',
+            '/api/v1/jobs/x', '/api/v1/jackett/stats']
 
     def tearDown(self):
         state_manager.clear()
@@ -138,6 +140,36 @@ class TestAPI(unittest.TestCase):
             content = response.get_data()
             self.assertIsNotNone(content)
 
+    # Test the formatted, sorted and paged Jackett results
+    # GET /api/v1/jackett/search
+    def test_jackett_search_formatted(self):
+        with app.test_client() as c:
+            response = c.get('/api/v1/jackett/search?query=test&categories=8000&format=json&sort=seeders&limit=5',
+                headers={'Authorization': os.environ['API_KEY']})
+            self.assertEqual(response.status_code, 200)
+            data = response.get_json()
+            self.assertEqual(list(data.keys()), ['total', 'page', 'limit', 'results'])
+            self.assertEqual(data['page'], 1)
+            self.assertLessEqual(len(data['results']), 5)
+            seeders = [x['seeders'] for x in data['results'] if x.get('seeders') != None]
+            self.assertEqual(seeders, sorted(seeders, reverse=True))
+
+            # Bad parameters are rejected before jackett is asked.
+            for args in ['format=xml', 'format=json&sort=name', 'format=json&page=0', 'format=json&limit=x']:
+                response = c.get('/api/v1/jackett/search?query=test&categories=8000&' + args,
+                    headers={'Authorization': os.environ['API_KEY']})
+                self.assertEqual(response.status_code, 400)
+
+    # Test the Jackett cache statistics
+    # GET /api/v1/jackett/stats
+    def test_jackett_stats(self):
+        with app.test_client() as c:
+            response = c.get('/api/v1/jackett/stats', headers={'Authorization': os.environ['API_KEY']})
+            self.assertEqual(response.status_code, 200)
+            data = response.get_json()
+            for key in ['hits', 'stale_hits', 'misses', 'shared', 'refreshes', 'in_flight', 'size']:
+                self.assertIn(key, data)
+
     # Test deleting specific and all content from DLAPI
     # DELETE /api/v1/content, DELETE /api/v1/content/all
     def test_delete_content(self):
@@ -172,19 +204,28 @@ class TestAPI(unittest.TestCase):
             response = c.get('/api/v1/content/all', headers={'Authorization': os.environ['API_KEY']})
             data = response.get_json()
             self.assertEqual(response.status_code, 200)
-            self.assertEqual(state_manager.get_all_as_dict(), data)
+            self.assertEqual(data['test'], {'title': '', 'path': '123', 'status': None, 'progress': None, 'speed': None, 'eta': None})
+            self.assertEqual(state_manager.get_all_with_progress(), data)
+
+            # The last progress seen on RD is included once the id has been checked.
+            state_manager.update_progress_many([('test', 'downloading', 50, 1000, 60, 0, 0)])
+            response = c.get('/api/v1/content/all', headers={'Authorization': os.environ['API_KEY']})
+            data = response.get_json()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['test'], {'title': '', 'path': '123', 'status': 'downloading', 'progress': 50, 'speed': 1000, 'eta': 60})
+            self.assertEqual(state_manager.get_all_with_progress(), data)
 
             state_manager.delete_id('test')
             response = c.get('/api/v1/content/all', headers={'Authorization': os.environ['API_KEY']})
             data = response.get_json()
             self.assertEqual(response.status_code, 200)
-            self.assertEqual(state_manager.get_all_as_dict(), data)
+            self.assertEqual(state_manager.get_all_with_progress(), data)
 
             state_manager.delete_id('test2')
             response = c.get('/api/v1/content/all', headers={'Authorization': os.environ['API_KEY']})
             data = response.get_json()
             self.assertEqual(response.status_code, 200)
-            self.assertEqual(state_manager.get_all_as_dict(), data)
+            self.assertEqual(state_manager.get_all_with_progress(), data)
 
     # Test posting content to be managed by rdmanager to the server
     # POST /api/v1/content
@@ -207,7 +248,49 @@ class TestAPI(unittest.TestCase):
             # Test that our values are properly in the system. Cannot test for key as it is the RD ID and changes
             self.assertEqual(path, '/test')
             self.assertEqual(title, 'Test Magnet File')
-            
-            
 
+    # Test posting many items at once. Items given by RD id are not sent to RD.
+    # POST /api/v1/content/batch
+    def test_posting_batch(self):
+        with app.test_client() as c:
+            response = c.post('/api/v1/content/batch', json=[{'id': 'test', 'path': '/test', 'title': 'Test'},
+                {'path': '/test'}, 'test', {'id': 'test', 'path': '/test2'}], headers={'Authorization': os.environ['API_KEY']})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json(), [{'id': 'test', 'code': 200},
+                {'Error': 'magnet_url is missing from post.', 'code': 400},
+                {'Error': 'Item is not an object.', 'code': 400}, {'id': 'test', 'code': 200}])
 
+            # The first item with an id wins.
+            self.assertEqual(len(state_manager), 1)
+            self.assertEqual(state_manager.get_info('test'), ['Test', '/test'])
+
+            # The batch must be a list of at most MAX_BATCH_SIZE items.
+            response = c.post('/api/v1/content/batch', json={'id': 'test', 'path': '/test'}, headers={'Authorization': os.environ['API_KEY']})
+            self.assertEqual(response.status_code, 400)
+            response = c.post('/api/v1/content/batch', json=[{'id': 'test', 'path': '/test'}] * 101, headers={'Authorization': os.environ['API_KEY']})
+            self.assertEqual(response.status_code, 400)
+
+    # Test posting content in async mode and polling the job until it is done
+    # POST /api/v1/content?async=true, GET /api/v1/jobs/<id>
+    def test_posting_async(self):
+        with app.test_client() as c:
+            response = c.post('/api/v1/content?async=true', json={'id': 'test', 'path': '/test', 'title': 'Test'},
+                headers={'Authorization': os.environ['API_KEY']})
+            self.assertEqual(response.status_code, 202)
+            job = response.get_json()['job']
+
+            for i in range(0, 50):
+                response = c.get('/api/v1/jobs/' + job, headers={'Authorization': os.environ['API_KEY']})
+                self.assertEqual(response.status_code, 200)
+                data = response.get_json()
+                if data['state'] != 'pending':
+                    break
+                time.sleep(0.1)
+
+            self.assertEqual(data['state'], 'done')
+            self.assertEqual(data['result'], {'id': 'test'})
+            self.assertEqual(state_manager.get_info('test'), ['Test', '/test'])
+
+            # Unknown jobs are not found.
+            response = c.get('/api/v1/jobs/notajob', headers={'Authorization': os.environ['API_KEY']})
+            self.assertEqual(response.status_code, 404)
@@ -0,0 +1,105 @@
+import unittest
+import logging
+from dlapi.managers import StateManager
+from tests.helpers import remove_database, FakeJDownloadManager
+
+try:
+    from aiohttp import web
+    from dlapi.asyncmanagers import AsyncRDManager
+except ImportError:
+    web = None
+
+@unittest.skipIf(web == None, "aiohttp is not installed.")
+class TestAsyncRDManager(unittest.TestCase):
+    """
+    Test the asyncio RD client against a local fake of the RD API.
+    """
+
+    def setUp(self):
+        self.jdownloader = FakeJDownloadManager()
+        self.rmanager = AsyncRDManager('key', logging.getLogger(), self.jdownloader)
+        self.unrestricted = []
+        self.failing = {'link2'}
+
+        statuses = {'done': 'downloaded', 'busy': 'downloading'}
+
+        async def torrents(request):
+            return web.json_response([{'id': id, 'status': status} for id, status in statuses.items()])
+
+        async def info(request):
+            id = request.match_info['id']
+            if id not in statuses:
+                return web.json_response({'error': 'unknown_ressource'}, status=404)
+            return web.json_response({'id': id, 'status': statuses[id], 'links': ['link1', 'link2', 'link3']})
+
+        async def unrestrict(request):
+            link = (await request.post())['link']
+            self.unrestricted.append(link)
+            if link in self.failing:
+                return web.json_response({'error': 'hoster_unavailable'}, status=503)
+            return web.json_response({'download': 'download/' + link})
+
+        async def start():
+            app = web.Application()
+            app.router.add_get('/torrents', torrents)
+            app.router.add_get('/torrents/info/{id}', info)
+            app.router.add_post('/unrestrict/link', unrestrict)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, '127.0.0.1', 0)
+            await site.start()
+            return self.runner.addresses[0][1]
+
+        port = self.rmanager._run(start())
+        self.rmanager._server = 'http://127.0.0.1:%d/' % port
+        self.rmanager._backoff = lambda attempt, retry_after=None: 0
+
+    def tearDown(self):
+        self.rmanager._run(self.runner.cleanup())
+        self.rmanager.close()
+        remove_database()
+
+    # The requests session and worker pools of the sync client are never created.
+    def test_no_sync_transport(self):
+        for name in ['_session', '_unrestrict_pool', '_download_pool']:
+            self.assertFalse(hasattr(self.rmanager, name))
+
+    def test_unrestrict_links_keeps_order(self):
+        result = self.rmanager.unrestrict_links(['link1', 'link2', 'link3'])
+        self.assertEqual(result[0], (True, 'download/link1'))
+        self.assertEqual(result[1][0], False)
+        self.assertEqual(result[2], (True, 'download/link3'))
+
+        # RD may have acted on a POST that got a 503, so it is not sent again.
+        self.assertEqual(self.unrestricted.count('link2'), 1)
+
+    def test_rd_listener(self):
+        state = StateManager('test.db')
+        state.add_many([('done', 'path/done'), ('busy', 'path/busy')])
+
+        self.assertTrue(self.rmanager.rd_listener(state))
+        self.rmanager.wait_for_downloads()
+
+        # One of the links failed to unrestrict, so nothing is handed off and the job is retried later.
+        self.assertEqual(self.jdownloader.downloads, [])
+        self.assertEqual(state.get_all_jobs()['done']['state'], 'pending')
+        self.assertEqual(state.get_all_ids(), ['busy'])
+        self.assertEqual(self.rmanager.last_cycle['downloaded'], 1)
+
+    def test_download_id(self):
+        self.failing.clear()
+        self.assertEqual(self.rmanager.download_id('busy', 'path'), {'id': 1})
+        self.assertEqual(self.jdownloader.downloads, [(['download/link1', 'download/link2', 'download/link3'], 'path')])
+
+    def test_rd_listener_by_id(self):
+        state = StateManager('test.db')
+        state.add_many([('done', 'path/done'), ('busy', 'path/busy'), ('gone', 'path/gone')])
+
+        # A large account makes the info endpoint cheaper than listing.
+        self.rmanager._account_size = 10000
+        self.assertTrue(self.rmanager.rd_listener(state))
+        self.rmanager.wait_for_downloads()
+
+        self.assertEqual(self.rmanager._strategy, 'info')
+        self.assertEqual(state.get_all_ids(), ['busy'])
+        self.assertEqual(self.rmanager.last_cycle['vanished'], 1)
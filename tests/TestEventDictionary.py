@@ -104,4 +104,50 @@ class TestEventDictionary(unittest.TestCase):
         edict = EventDictionary(None)
         tomerge = {'item': 'value', 'item2': 'value2'}
         edict.update(tomerge)
-        self.assertEqual(edict, tomerge)
\ No newline at end of file
+        self.assertEqual(edict, tomerge)
+
+    def test_batch(self):
+        events = []
+        edict = EventDictionary(lambda key, value, event: events.append((key, value, event)))
+        with edict.batch():
+            edict['test'] = 'yes'
+            edict['test2'] = 'no'
+            del edict['test']
+
+            # Nested batches fire with the outermost one.
+            with edict.batch():
+                edict['test3'] = 'maybe'
+            self.assertEqual(events, [])
+
+        self.assertEqual(events, [(None, [
+            ('test', 'yes', DictionaryEventType.SET_EVENT),
+            ('test2', 'no', DictionaryEventType.SET_EVENT),
+            ('test', 'yes', DictionaryEventType.DEL_EVENT),
+            ('test3', 'maybe', DictionaryEventType.SET_EVENT)
+        ], DictionaryEventType.BATCH_EVENT)])
+
+        # An empty batch fires nothing.
+        with edict.batch():
+            pass
+        self.assertEqual(len(events), 1)
+
+    def test_bulk_methods(self):
+        events = []
+        edict = EventDictionary(lambda key, value, event: events.append((key, value, event)))
+        edict.update({'item': 'value', 'item2': 'value2'})
+        self.assertEqual(events[-1][2], DictionaryEventType.BATCH_EVENT)
+        self.assertEqual(len(events[-1][1]), 2)
+
+        self.assertEqual(edict.pop('item'), 'value')
+        self.assertEqual(events[-1], ('item', 'value', DictionaryEventType.DEL_EVENT))
+        self.assertEqual(edict.pop('missing', None), None)
+
+        self.assertEqual(edict.setdefault('item3', 'value3'), 'value3')
+        self.assertEqual(events[-1], ('item3', 'value3', DictionaryEventType.SET_EVENT))
+        count = len(events)
+        self.assertEqual(edict.setdefault('item3', 'other'), 'value3')
+        self.assertEqual(len(events), count)
+
+        edict.clear()
+        self.assertEqual(edict, {})
+        self.assertEqual([x[2] for x in events[-1][1]], [DictionaryEventType.DEL_EVENT] * 2)
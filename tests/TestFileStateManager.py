@@ -13,11 +13,17 @@ class TestFileStateManager(unittest.TestCase):
     Test the original State manager class, a class which wraps
     the event dictionary but does it to what we need.
     """
+
+    def tearDown(self):
+        for f in ["state.txt", "state.txt.journal", "state.txt.tmp"]:
+            if os.path.exists(f):
+                os.remove(f)
     
     # Test that setting a new value updates the file
     def test_internal_call(self):
         mngr = FileStateManager("state.txt")
         mngr['test'] = 'z'
+        mngr.save_state()
         x = read_state_manager_file()
         self.assertEqual(x, ['{"test": "z"}'])
 
@@ -26,6 +32,7 @@ class TestFileStateManager(unittest.TestCase):
         mngr = FileStateManager("state.txt")
         mngr['test'] = 'z'
         mngr['test2'] = 'kkz'
+        mngr.save_state()
         x = read_state_manager_file()
         self.assertEqual(x, ['{"test": "z", "test2": "kkz"}'])
 
@@ -34,6 +41,7 @@ class TestFileStateManager(unittest.TestCase):
         mngr['test'] = 'z'
         mngr['test2'] = 'kkz'
         del mngr['test2']
+        mngr.save_state()
         x = read_state_manager_file()
         self.assertEqual(x, ['{"test": "z"}'])
 
@@ -44,10 +52,12 @@ class TestFileStateManager(unittest.TestCase):
 
         mngr['test'] = 'z'
         mngr['test2'] = 'kkz'
+        mngr.save_state()
         x = read_state_manager_file()
         self.assertEqual(x, ['{"test": "z", "test2": "kkz"}'])
 
         del mngr['test']
+        mngr.save_state()
         x = read_state_manager_file()
         self.assertEqual(x, ['{"test2": "kkz"}'])
         
@@ -55,3 +65,66 @@ class TestFileStateManager(unittest.TestCase):
         clean.save_state()
         clean.load_state()
         self.assertEqual(clean, {})
+
+    # Test that changes are journaled in one write and replayed on load
+    def test_journal_replay(self):
+        mngr = FileStateManager("state.txt", flush_delay=60)
+        mngr['test'] = 'z'
+        mngr.save_state()
+        mngr['test2'] = 'kkz'
+        del mngr['test']
+
+        # Nothing is written until the changes are flushed.
+        self.assertEqual(os.path.getsize("state.txt.journal"), 0)
+        mngr.flush()
+        self.assertEqual(read_state_manager_file(), ['{"test": "z"}'])
+
+        loaded = FileStateManager("state.txt")
+        loaded.load_state()
+        self.assertEqual(loaded, {'test2': 'kkz'})
+
+    # Test that a journal entry cut short by a crash is ignored
+    def test_partial_journal_entry(self):
+        mngr = FileStateManager("state.txt")
+        mngr['test'] = 'z'
+        mngr.flush()
+        with open("state.txt.journal", 'a') as f:
+            f.write('{"op": "set", "ke')
+
+        loaded = FileStateManager("state.txt")
+        loaded.load_state()
+        self.assertEqual(loaded, {'test': 'z'})
+
+    # Test that the journal is compacted into the state file once it is long enough
+    def test_compaction(self):
+        mngr = FileStateManager("state.txt", compact_every=3)
+        for i in range(0, 3):
+            mngr[str(i)] = i
+        mngr.flush()
+        self.assertEqual(os.path.getsize("state.txt.journal"), 0)
+        self.assertEqual(read_state_manager_file(), ['{"0": 0, "1": 1, "2": 2}'])
+
+    # Test that a batch of changes is written to the journal at once
+    def test_batch_written_once(self):
+        mngr = FileStateManager("state.txt", flush_delay=60)
+        mngr.save_state()
+        mngr.update({'test': 'z', 'test2': 'kkz'})
+        with mngr.batch():
+            del mngr['test']
+
+        loaded = FileStateManager("state.txt")
+        loaded.load_state()
+        self.assertEqual(loaded, {'test2': 'kkz'})
+        self.assertEqual(mngr._timer, None)
+
+    # Test that closing writes pending changes without waiting for the timer
+    def test_close_flushes(self):
+        mngr = FileStateManager("state.txt", flush_delay=60)
+        mngr.save_state()
+        mngr['test'] = 'z'
+        mngr.close()
+        self.assertEqual(mngr._timer, None)
+
+        loaded = FileStateManager("state.txt")
+        loaded.load_state()
+        self.assertEqual(loaded, {'test': 'z'})
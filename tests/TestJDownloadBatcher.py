@@ -0,0 +1,45 @@
+from dlapi.managers import JDownloadBatcher
+import unittest
+import threading
+from tests.helpers import FakeJDownloadManager
+
+class TestJDownloadBatcher(unittest.TestCase):
+    """
+    Test the batching of handoffs to JDownloader.
+    """
+
+    def setUp(self):
+        self.jmanager = FakeJDownloadManager()
+
+    def test_flush_on_size(self):
+        batcher = JDownloadBatcher(self.jmanager, 60, 3)
+        futures = [batcher.submit(['link%d' % i], 'path%d' % i) for i in range(0, 3)]
+
+        # The third submission fills the batch so nothing waits for the window.
+        self.assertEqual([f.result(1) for f in futures], [{'id': 1}] * 3)
+        self.assertEqual(self.jmanager.calls, [[(['link0'], 'path0'), (['link1'], 'path1'), (['link2'], 'path2')]])
+
+    def test_flush_on_timeout(self):
+        batcher = JDownloadBatcher(self.jmanager, 0.05, 10)
+        first = batcher.submit(['link0'], 'path0')
+        second = batcher.submit(['link1'], 'path1')
+        self.assertEqual(first.result(1), {'id': 1})
+        self.assertEqual(second.result(1), {'id': 1})
+        self.assertEqual(len(self.jmanager.calls), 1)
+
+    def test_download_blocks_for_result(self):
+        batcher = JDownloadBatcher(self.jmanager, 0.05, 10)
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(batcher.download(['link%d' % i], 'path'))) for i in range(0, 4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(1)
+        self.assertEqual(results, [{'id': 1}] * 4)
+        self.assertEqual(len(self.jmanager.calls[0]), 4)
+
+    def test_failure_gives_every_entry_empty_result(self):
+        self.jmanager.download_many = lambda entries: {}
+        batcher = JDownloadBatcher(self.jmanager, 60, 2)
+        futures = [batcher.submit(['link'], 'path'), batcher.submit(['link'], 'path')]
+        self.assertEqual([f.result(1) for f in futures], [{}, {}])
@@ -1,7 +1,10 @@
 from dlapi.managers import JDownloadManager
+from myjdapi.myjdapi import MYJDException
 import unittest
 import json
 import os
+import time
+import types
 
 class TestJDownloadManager(unittest.TestCase):
     """
@@ -34,3 +37,58 @@ class TestJDownloadManager(unittest.TestCase):
         self.mngr.get_jd().disconnect()
         result = self.mngr.download([os.environ['TEST_RD_LINK_TWO']], 'test')
         self.assertEqual(list(result.keys()), ['id'])
+
+
+class FakeLinkgrabber():
+    """
+    Records add_links calls, failing the first fail_count of them.
+    """
+    def __init__(self, fail_count: int = 0):
+        self.calls = []
+        self.fail_count = fail_count
+
+    def add_links(self, params: list):
+        self.calls.append(params)
+        if len(self.calls) <= self.fail_count:
+            raise MYJDException('Session expired')
+        return {'id': len(self.calls)}
+
+class OfflineJDownloadManager(JDownloadManager):
+    """
+    JDownloadManager with the connection to my.jdownloader.org replaced by counters.
+    """
+    def _initialize_session(self):
+        self.restarts = 0
+        self.device = types.SimpleNamespace(linkgrabber=FakeLinkgrabber())
+        self._verified_at = time.monotonic()
+
+    def _restart_session(self):
+        self.restarts += 1
+        self._verified_at = time.monotonic()
+
+class TestJDownloadManagerSession(unittest.TestCase):
+    """
+    Test the session reuse of the JDownloadManager without connecting to JDownloader.
+    """
+
+    def test_fresh_session_is_reused(self):
+        mngr = OfflineJDownloadManager('user', 'pass', 'device')
+        self.assertEqual(mngr.download(['link'], 'path'), {'id': 1})
+        self.assertEqual(mngr.download(['link'], 'path'), {'id': 2})
+        self.assertEqual(mngr.restarts, 0)
+
+    def test_expired_session_is_refreshed(self):
+        mngr = OfflineJDownloadManager('user', 'pass', 'device', session_ttl=0)
+        self.assertFalse(mngr.is_session_fresh())
+        mngr.download(['link'], 'path')
+        self.assertEqual(mngr.restarts, 1)
+
+    def test_failed_call_reconnects_and_retries(self):
+        mngr = OfflineJDownloadManager('user', 'pass', 'device')
+        mngr.device.linkgrabber.fail_count = 1
+        self.assertEqual(mngr.download(['link'], 'path'), {'id': 2})
+        self.assertEqual(mngr.restarts, 1)
+
+        # Give up after the retry fails too.
+        mngr.device.linkgrabber.fail_count = 10
+        self.assertEqual(mngr.download(['link'], 'path'), {})
@@ -0,0 +1,88 @@
+from dlapi.managers import JackettManager
+import unittest
+import threading
+import time
+
+RESULT = '{"Results": [{"Title": "result %d"}]}'
+
+class TestJackettManager(unittest.TestCase):
+    """
+    Test the jackett search cache without a jackett server.
+    """
+
+    def setUp(self):
+        self.jmanager = JackettManager('http://jackett/', 'key', ttl=10, stale_ttl=100)
+        self.calls = []
+        self.jmanager._request = self.request
+
+    def request(self, key: tuple) -> tuple:
+        self.calls.append(key)
+        return (RESULT % len(self.calls), 200)
+
+    def test_cached_by_normalized_key(self):
+        self.assertEqual(self.jmanager.search('Some Movie', ['2000', '2040']), (RESULT % 1, 200))
+        self.assertEqual(self.jmanager.search('  some   movie ', ['2040', '2000', '']), (RESULT % 1, 200))
+        self.assertEqual(self.calls, [('some movie', ('2000', '2040'))])
+        self.assertEqual(self.jmanager.get_stats()['hits'], 1)
+        self.assertEqual(self.jmanager.get_stats()['misses'], 1)
+
+    def test_stale_result_returned_while_refreshing(self):
+        self.jmanager.search('movie', ['2000'])
+        key = self.jmanager._key('movie', ['2000'])
+        text, status, fetched, results = self.jmanager._cache.get(key)
+        self.jmanager._cache.set(key, (text, status, fetched - 50, results), time.time() + 50)
+
+        # The stale result comes back at once and the refresh lands in the cache.
+        self.assertEqual(self.jmanager.search('movie', ['2000']), (RESULT % 1, 200))
+        self.jmanager._refresh_pool.shutdown(wait=True)
+        self.assertEqual(self.jmanager.search('movie', ['2000']), (RESULT % 2, 200))
+        self.assertEqual(self.jmanager.get_stats()['stale_hits'], 1)
+        self.assertEqual(self.jmanager.get_stats()['refreshes'], 1)
+
+    def test_concurrent_searches_share_one_call(self):
+        release = threading.Event()
+        def request(key):
+            self.calls.append(key)
+            release.wait(5)
+            return (RESULT % 1, 200)
+        self.jmanager._request = request
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.jmanager.search('movie', ['2000']))) for x in range(0, 5)]
+        for thread in threads:
+            thread.start()
+        while self.jmanager.get_stats()['shared'] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [(RESULT % 1, 200)] * 5)
+
+    def test_failures_not_cached(self):
+        self.jmanager._request = lambda key: ('error', 500)
+        self.assertEqual(self.jmanager.search('movie', ['2000']), ('error', 500))
+        self.assertEqual(self.jmanager.get_stats()['size'], 0)
+
+        def request(key):
+            raise ConnectionError("refused")
+        self.jmanager._request = request
+        self.assertEqual(self.jmanager.search('movie', ['2000'])[1], 502)
+
+    def test_results_trimmed(self):
+        self.jmanager._request = lambda key: ('{"Results": [{"Title": "a", "Size": 10, "Seeders": 5, "MagnetUri": "magnet:?a", '
+            '"Tracker": "t", "Description": "long"}], "Indexers": []}', 200)
+        results, text, status = self.jmanager.search_results('movie', ['2000'])
+        self.assertEqual(results, [{'title': 'a', 'size': 10, 'seeders': 5, 'peers': None, 'magnet': 'magnet:?a',
+            'link': None, 'tracker': 't', 'published': None}])
+
+    def test_select(self):
+        results = [{'title': str(x), 'size': x * 100, 'seeders': x} for x in range(0, 10)] + [{'title': 'none', 'size': None, 'seeders': None}]
+        total, page = JackettManager.select(results, 'seeders', True, min_seeders=2, max_size=800, page=2, limit=3)
+        self.assertEqual(total, 7)
+        self.assertEqual([x['title'] for x in page], ['5', '4', '3'])
+
+        total, page = JackettManager.select(results, 'size', False, limit=100)
+        self.assertEqual(page[0]['title'], '0')
+        self.assertEqual(page[-1]['title'], 'none')
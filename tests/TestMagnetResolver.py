@@ -0,0 +1,96 @@
+from dlapi.managers import MagnetResolver
+import unittest
+import hashlib
+
+class FakeStreamResponse():
+    """
+    Response returned by FakeSession, usable as a context manager like a streamed requests response.
+    """
+    def __init__(self, url: str, status_code: int, headers: dict = {}, body: bytes = b''):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def iter_content(self, size: int):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+class FakeSession():
+    """
+    Answers each url from a dictionary of url to (status, headers, body) and records the calls.
+    """
+    def __init__(self, responses: dict):
+        self.responses = responses
+        self.calls = []
+
+    def get(self, url: str, **kwargs):
+        self.calls.append((url, kwargs['allow_redirects']))
+        status, headers, body = self.responses[url]
+        return FakeStreamResponse(url, status, headers, body)
+
+class TestMagnetResolver(unittest.TestCase):
+    """
+    Test resolving Jackett urls to magnets without a network.
+    """
+
+    INFO = b'd6:lengthi10e4:name4:test12:piece lengthi16384e6:pieces20:aaaaaaaaaaaaaaaaaaaae'
+    TORRENT = b'd8:announce15:http://tracker/4:info' + INFO + b'e'
+
+    def setUp(self):
+        self.resolver = MagnetResolver(max_hops=2)
+
+    def test_magnet_passes_through(self):
+        self.assertEqual(self.resolver.resolve('magnet:?xt=urn:btih:abc'), (True, 'magnet:?xt=urn:btih:abc'))
+
+    def test_redirects_read_without_following(self):
+        session = FakeSession({
+            'http://jackett/dl': (302, {'Location': '/dl2'}, b''),
+            'http://jackett/dl2': (301, {'Location': 'magnet:?xt=urn:btih:abc'}, b'')
+        })
+        self.resolver._session = session
+        self.assertEqual(self.resolver.resolve('http://jackett/dl'), (True, 'magnet:?xt=urn:btih:abc'))
+        self.assertEqual(session.calls, [('http://jackett/dl', False), ('http://jackett/dl2', False)])
+
+        # The second lookup is answered from the cache.
+        self.assertEqual(self.resolver.resolve('http://jackett/dl'), (True, 'magnet:?xt=urn:btih:abc'))
+        self.assertEqual(len(session.calls), 2)
+
+    def test_hop_limit(self):
+        self.resolver._session = FakeSession({'http://jackett/loop': (302, {'Location': 'http://jackett/loop'}, b'')})
+        self.assertFalse(self.resolver.resolve('http://jackett/loop')[0])
+        self.assertEqual(len(self.resolver._session.calls), 3)
+
+    def test_torrent_payload(self):
+        self.resolver._session = FakeSession({'http://jackett/dl': (200, {}, TestMagnetResolver.TORRENT)})
+        resolved, magnet = self.resolver.resolve('http://jackett/dl')
+        self.assertTrue(resolved)
+        self.assertEqual(magnet, 'magnet:?xt=urn:btih:%s&dn=test&tr=http://tracker/' % hashlib.sha1(TestMagnetResolver.INFO).hexdigest())
+
+    def test_invalid_payload(self):
+        self.resolver._session = FakeSession({
+            'http://jackett/html': (200, {}, b'<html></html>'),
+            'http://jackett/missing': (404, {}, b'')
+        })
+        self.assertFalse(self.resolver.resolve('http://jackett/html')[0])
+        self.assertFalse(self.resolver.resolve('http://jackett/missing')[0])
+
+    def test_malformed_torrent(self):
+        payloads = {
+            'http://jackett/infolist': b'd4:infoli1eee',
+            'http://jackett/listkey': b'dli1ee1:ae',
+            'http://jackett/nested': b'd4:info' + b'l' * 5000,
+            'http://jackett/tiers': b'd13:announce-listi1e4:infod4:name1:aee'
+        }
+        self.resolver._session = FakeSession({url: (200, {}, body) for url, body in payloads.items()})
+        for url in ['http://jackett/infolist', 'http://jackett/listkey', 'http://jackett/nested']:
+            self.assertFalse(self.resolver.resolve(url)[0])
+
+        # Trackers that are not lists are ignored.
+        self.assertTrue(self.resolver.resolve('http://jackett/tiers')[0])
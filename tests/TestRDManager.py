@@ -1,7 +1,13 @@
 import unittest
-from dlapi.managers import RDManager, JDownloadManager, StateManager
+import requests
+import urllib3
+from dlapi.managers import RDManager, JDownloadManager, JDownloadBatcher, StateManager, LinkCache, LeaderElection
 import logging
 import os
+import time
+import json
+import threading
+from tests.helpers import remove_database, handed_off, FakeJDownloadManager
 
 class TestRDManager(unittest.TestCase):
     """
@@ -51,7 +57,423 @@ class TestRDManager(unittest.TestCase):
         # Run listener to check and find file
         res = self.rmanager.rd_listener(cd)
         self.assertTrue(res)
+        self.rmanager.wait_for_downloads()
 
         # Check and see if we are no longer watching the movie
         self.assertEqual(cd.get_all(), [])
-        
\ No newline at end of file
+        
+
+class TestRDManagerOffline(unittest.TestCase):
+    """
+    Test the parts of the Real Debrid Manager that do not talk to RD or JDownloader.
+    """
+
+    def setUp(self):
+        self.rmanager = RDManager('key', logging.getLogger(), None)
+        self.downloaded = []
+        self.rmanager.download_id = self.download_id
+        self.rmanager.submit_download = lambda id, path: handed_off(self.rmanager.download_id(id, path))
+        self.rmanager._select_files_for_torrent = lambda id: None
+
+    def download_id(self, id: str, path: str) -> dict:
+        self.downloaded.append((id, path))
+        return {'id': len(self.downloaded)}
+
+    def tearDown(self):
+        remove_database()
+
+    def test_reconcile_statuses(self):
+        torrents = [
+            {'id': 'done', 'status': 'downloaded'},
+            {'id': 'busy', 'status': 'downloading'},
+            {'id': 'bad', 'status': 'magnet_error'},
+            {'id': 'dead', 'status': 'dead'},
+            {'id': 'select', 'status': 'waiting_files_selection'},
+            {'id': 'notwatched', 'status': 'downloaded'}
+        ]
+        watched = {x: {'title': '', 'path': 'path/' + x} for x in ['done', 'busy', 'bad', 'dead', 'select', 'gone']}
+
+        state = StateManager('test.db')
+        state.add_many([(x, 'path/' + x) for x in watched])
+        changes, cycle = self.rmanager._reconcile(torrents, watched)
+        self.assertEqual(sorted(changes['removals']), ['bad', 'dead', 'gone', 'select'])
+        self.assertEqual(changes['downloads'], ['done'])
+        self.assertEqual(sorted(changes['forgotten']), ['bad', 'dead', 'gone'])
+        self.assertEqual(cycle, {'watched': 6, 'checked': 6, 'seen': 5, 'downloaded': 1, 'errored': 2, 'vanished': 1, 'finishing': 0,
+            'jobs': 0})
+
+        # Nothing is written until the cycle is saved.
+        self.assertIn('done', state.get_all_ids())
+        state.save_cycle([], changes['downloads'], changes['removals'], changes['forgotten'], [])
+
+        # Finished torrents move to the job table and are handed off from there.
+        self.assertEqual(state.get_all_ids(), ['busy'])
+        self.assertEqual(state.count_open_jobs(), 1)
+        self.rmanager.process_jobs(state)
+        self.rmanager.wait_for_downloads()
+        self.assertEqual(self.downloaded, [('done', 'path/done')])
+        self.assertEqual(state.get_all_jobs()['done']['state'], 'handed_off')
+
+    def test_reconcile_nothing_watched(self):
+        changes, cycle = self.rmanager._reconcile([{'id': 'done', 'status': 'downloaded'}], {})
+        self.assertEqual(changes, {'removals': [], 'downloads': [], 'forgotten': []})
+        self.assertEqual(cycle, {'watched': 0, 'checked': 0, 'seen': 0, 'downloaded': 0, 'errored': 0, 'vanished': 0, 'finishing': 0,
+            'jobs': 0})
+
+    def test_reconcile_counts_finishing(self):
+        torrents = [
+            {'id': 'almost', 'status': 'downloading', 'progress': 95},
+            {'id': 'slow', 'status': 'downloading', 'progress': 10},
+            {'id': 'waiting', 'status': 'queued', 'progress': 0}
+        ]
+        watched = {x['id']: {'title': '', 'path': 'path'} for x in torrents}
+        changes, cycle = self.rmanager._reconcile(torrents, watched)
+        self.assertEqual(changes['removals'], [])
+        self.assertEqual(cycle['finishing'], 1)
+        self.assertEqual(self.downloaded, [])
+
+    def test_job_not_submitted_twice(self):
+        release = threading.Event()
+        self.rmanager.download_id = lambda id, path: release.wait(5) and {'id': 1}
+        state = StateManager('test.db')
+        state.add_content('done', 'path')
+        state.enqueue_downloads(['done'])
+
+        # The second cycle overlaps the first and must not claim the job again.
+        self.assertEqual(self.rmanager.process_jobs(state), 1)
+        self.assertEqual(self.rmanager.process_jobs(state), 1)
+        self.assertEqual(len(self.rmanager._in_flight), 1)
+
+        release.set()
+        self.rmanager.wait_for_downloads()
+        self.assertEqual(state.count_open_jobs(), 0)
+        self.assertEqual(state.get_all_jobs()['done']['attempts'], 1)
+
+    def test_only_leader_hands_off_jobs(self):
+        state = StateManager('test.db')
+        self.rmanager.leader = LeaderElection(state, 'scheduler', 30)
+        state.add_content('done', 'path')
+        state.enqueue_downloads(['done'])
+
+        # Until it holds the lease this process leaves the job for the leader.
+        self.assertEqual(self.rmanager.process_jobs(state), 1)
+        self.assertEqual(len(self.rmanager._in_flight), 0)
+
+        self.assertTrue(self.rmanager.leader.renew())
+        self.rmanager.process_jobs(state)
+        self.rmanager.wait_for_downloads()
+        self.assertEqual(state.get_all_jobs()['done']['state'], 'handed_off')
+
+    def test_failed_job_is_retried_later(self):
+        self.rmanager.download_id = lambda id, path: {}
+        state = StateManager('test.db')
+        state.add_content('done', 'path')
+        state.enqueue_downloads(['done'])
+
+        self.rmanager.process_jobs(state)
+        self.rmanager.wait_for_downloads()
+        job = state.get_all_jobs()['done']
+        self.assertEqual(job['state'], 'pending')
+        self.assertEqual(job['attempts'], 1)
+        self.assertGreater(job['next_retry'], time.time())
+
+        # Not due yet, so nothing is claimed.
+        self.rmanager.process_jobs(state)
+        self.assertEqual(len(self.rmanager._in_flight), 0)
+
+    def test_batched_jobs_do_not_hold_workers(self):
+        jdownloader = FakeJDownloadManager()
+        self.rmanager = RDManager('key', logging.getLogger(), JDownloadBatcher(jdownloader, 60, 3), download_workers=2)
+        self.rmanager.get_rd_download_urls = lambda id: ['link/' + id]
+        self.rmanager.unrestrict_links = lambda links: [(True, link) for link in links]
+        state = StateManager('test.db')
+        state.add_many([('a', 'path'), ('b', 'path'), ('c', 'path')])
+        state.enqueue_downloads(['a', 'b', 'c'])
+
+        # With two workers the third job is only claimed once a worker leaves its job waiting on the batch.
+        self.rmanager.process_jobs(state)
+        self.rmanager.wait_for_downloads(5)
+        self.assertEqual(len(jdownloader.calls), 1)
+        self.assertEqual(sorted(jdownloader.calls[0]), [(['link/a'], 'path'), (['link/b'], 'path'), (['link/c'], 'path')])
+        self.assertEqual({x['state'] for x in state.get_all_jobs().values()}, {'handed_off'})
+
+    def test_incomplete_download_is_retried(self):
+        self.assertEqual(self.rmanager._successful_downloads('id', ['a', 'b'], [(True, 'da'), (True, 'db')]), (['da', 'db'], None))
+        self.assertEqual(self.rmanager._successful_downloads('id', ['a', 'b'], [(True, 'da'), (False, 'error')])[0], [])
+        self.assertEqual(self.rmanager._successful_downloads('id', [], []), ([], "RD returned no links for id: id"))
+
+        # RD giving no links, such as on a 401, fails the job rather than handing off nothing.
+        del self.rmanager.submit_download
+        self.rmanager.get_rd_download_urls = lambda id: []
+        state = StateManager('test.db')
+        state.add_content('done', 'path')
+        state.enqueue_downloads(['done'])
+        self.rmanager.process_jobs(state)
+        self.rmanager.wait_for_downloads()
+
+        job = state.get_all_jobs()['done']
+        self.assertEqual((job['state'], job['last_error']), ('pending', "RD returned no links for id: done"))
+
+    def test_job_fails_after_max_attempts(self):
+        self.rmanager.download_id = lambda id, path: {}
+        state = StateManager('test.db')
+        state.add_content('done', 'path')
+        state.enqueue_downloads(['done'])
+
+        self.rmanager._complete_job('done', 'path', RDManager.JOB_MAX_ATTEMPTS - 1, 'error', state)
+        job = state.get_all_jobs()['done']
+        self.assertEqual(job['state'], 'failed')
+        self.assertEqual(job['last_error'], 'error')
+        self.assertEqual(state.count_open_jobs(), 0)
+
+    def test_unrestrict_links_keeps_order_and_failures(self):
+        def unrestrict(link):
+            # Finish the first links last to make sure the order is kept.
+            time.sleep(0.01 * (5 - int(link)))
+            if link == '2':
+                return (False, 'failed')
+            return (True, 'download' + link)
+
+        self.rmanager._unrestrict_link = unrestrict
+        result = self.rmanager.unrestrict_links(['0', '1', '2', '3', '4'])
+        self.assertEqual(result, [(True, 'download0'), (True, 'download1'), (False, 'failed'), (True, 'download3'), (True, 'download4')])
+
+    def test_unrestrict_links_uses_cache(self):
+        calls = []
+        def unrestrict(link):
+            calls.append(link)
+            if link == '2':
+                return (False, 'failed')
+            return (True, 'download' + link)
+
+        self.rmanager._unrestrict_link = unrestrict
+        self.rmanager.unrestrict_links(['0', '1', '2'])
+
+        # Only the failed link is sent to RD again.
+        result = self.rmanager.unrestrict_links(['0', '1', '2', '0'])
+        self.assertEqual(result, [(True, 'download0'), (True, 'download1'), (False, 'failed'), (True, 'download0')])
+        self.assertEqual(calls, ['0', '1', '2', '2'])
+
+    def test_link_cache_survives_restart(self):
+        state = StateManager('test.db')
+        LinkCache(state).set_many({'link': 'download'})
+
+        # A new cache reads the link back from the database.
+        self.assertEqual(LinkCache(state).get_many(['link', 'other']), {'link': 'download'})
+
+        # Expired links are not used.
+        cache = LinkCache(state, ttl=-1)
+        cache.set_many({'old': 'download'})
+        self.assertEqual(cache.get_many(['old']), {})
+        self.assertEqual(state.get_unrestricted_many(['old']), {})
+
+    def test_get_info_hash(self):
+        self.assertEqual(RDManager.get_info_hash('magnet:?xt=urn:btih:C12FE1C06BBA254A9DC9F519B335AA7C1367A88A&dn=test'),
+            'c12fe1c06bba254a9dc9f519b335aa7c1367a88a')
+        self.assertEqual(RDManager.get_info_hash('magnet:?dn=test&xt=urn:btih:YEX6DQDLXISUVHOJ6UM3GNNKPQJWPKEK'),
+            'c12fe1c06bba254a9dc9f519b335aa7c1367a88a')
+        self.assertEqual(RDManager.get_info_hash('magnet:?dn=test'), None)
+        self.assertEqual(RDManager.get_info_hash('http://google.ca/'), None)
+
+    def test_send_to_rd_reuses_known_hash(self):
+        requests_made = []
+        deleted = set()
+        def request(method, endpoint, **kwargs):
+            requests_made.append(endpoint)
+            if endpoint == 'torrents/addMagnet':
+                return FakeResponse(201, text='{"id": "NEWID%d"}' % len(requests_made))
+            if endpoint.startswith('torrents/info/'):
+                id = endpoint.split('/')[-1]
+                if id in deleted:
+                    return FakeResponse(404, text='{"error": "unknown_ressource"}')
+                return FakeResponse(200, text=json.dumps({'id': id, 'status': 'downloading'}))
+            return FakeResponse(204)
+
+        self.rmanager._request = request
+        state = StateManager('test.db')
+        magnet = 'magnet:?xt=urn:btih:C12FE1C06BBA254A9DC9F519B335AA7C1367A88A'
+        self.assertEqual(self.rmanager.send_to_rd(magnet, state), (True, 'NEWID1'))
+        self.assertEqual(len(requests_made), 2)
+
+        # The second submission attaches to the same torrent after only reading it.
+        self.assertEqual(self.rmanager.send_to_rd(magnet, state), (True, 'NEWID1'))
+        self.assertEqual(requests_made[2:], ['torrents/info/NEWID1'])
+
+        # A torrent deleted on RD before the next index is added again.
+        deleted.add('NEWID1')
+        self.assertEqual(self.rmanager.send_to_rd(magnet, state), (True, 'NEWID5'))
+        self.assertEqual(state.get_torrent_id('c12fe1c06bba254a9dc9f519b335aa7c1367a88a'), 'NEWID5')
+        requests_made.clear()
+
+        # Once the torrent is gone from RD the magnet is added again.
+        self.rmanager._finish_cycle([], {'NEWID5': {'title': '', 'path': 'path'}}, 1, state, {})
+        self.assertEqual(state.get_torrent_id('c12fe1c06bba254a9dc9f519b335aa7c1367a88a'), None)
+
+    def test_index_account(self):
+        pages = {1: [{'id': str(x), 'hash': '%040x' % x} for x in range(0, 100)], 2: [{'id': '100', 'hash': '%040x' % 100}]}
+        def request(method, endpoint, **kwargs):
+            return FakeResponse(200, {}, json.dumps(pages.get(kwargs['params']['page'], [])))
+
+        self.rmanager._request = request
+        state = StateManager('test.db')
+        state.save_torrent_hashes([('old', 'deleted')])
+        self.assertTrue(self.rmanager.index_account(state))
+        self.assertEqual(state.get_torrent_id('%040x' % 100), '100')
+        self.assertEqual(state.get_torrent_id('old'), None)
+
+    def test_request_retries_with_backoff(self):
+        responses = [FakeResponse(503), FakeResponse(429, {'Retry-After': '0'}), FakeResponse(200)]
+        calls = []
+        def request(method, url, **kwargs):
+            calls.append(kwargs['timeout'])
+            return responses.pop(0)
+
+        self.rmanager._session.request = request
+        self.rmanager._backoff = lambda attempt, retry_after=None: 0
+        self.assertEqual(self.rmanager._request('GET', 'torrents').status_code, 200)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[0], self.rmanager._timeout)
+
+    def test_request_gives_up_after_retries(self):
+        def request(method, url, **kwargs):
+            raise requests.exceptions.ConnectionError()
+
+        self.rmanager._session.request = request
+        self.rmanager._backoff = lambda attempt, retry_after=None: 0
+        self.assertRaises(requests.exceptions.RequestException, self.rmanager._request, 'GET', 'torrents')
+        self.assertEqual(self.rmanager.send_to_rd('magnet:?xt=urn:btih:test')[0], False)
+
+    def test_post_only_retried_when_safe(self):
+        responses = [FakeResponse(429), FakeResponse(503), FakeResponse(201)]
+        calls = []
+        def request(method, url, **kwargs):
+            calls.append(url)
+            return responses.pop(0)
+
+        self.rmanager._session.request = request
+        self.rmanager._backoff = lambda attempt, retry_after=None: 0
+
+        # A 429 was never acted on, a 503 might have been.
+        self.assertEqual(self.rmanager._request('POST', 'torrents/addMagnet').status_code, 503)
+        self.assertEqual(len(calls), 2)
+
+        def timeout(method, url, **kwargs):
+            calls.append(url)
+            raise requests.exceptions.ReadTimeout()
+
+        calls.clear()
+        self.rmanager._session.request = timeout
+        self.assertRaises(requests.exceptions.ReadTimeout, self.rmanager._request, 'POST', 'torrents/addMagnet')
+        self.assertEqual(len(calls), 1)
+
+        # A connection dropped after the POST was sent is not retried, one never made is.
+        errors = [requests.exceptions.ConnectionError(urllib3.exceptions.ProtocolError('Connection aborted.', ConnectionResetError())),
+            requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(None, 'url',
+                urllib3.exceptions.NewConnectionError(None, 'Connection refused'))),
+            requests.exceptions.ConnectTimeout()]
+        def error(method, url, **kwargs):
+            calls.append(url)
+            raise errors[0]
+
+        calls.clear()
+        self.rmanager._session.request = error
+        self.assertRaises(requests.exceptions.ConnectionError, self.rmanager._request, 'POST', 'torrents/addMagnet')
+        self.assertEqual(len(calls), 1)
+        for e in errors[1:]:
+            errors[0] = e
+            calls.clear()
+            self.assertRaises(type(e), self.rmanager._request, 'POST', 'torrents/addMagnet')
+            self.assertEqual(len(calls), self.rmanager._max_retries + 1)
+
+    def test_backoff_is_bounded(self):
+        for attempt in range(0, 10):
+            self.assertLessEqual(self.rmanager._backoff(attempt), RDManager.BACKOFF_CAP)
+        self.assertEqual(self.rmanager._backoff(0, '2'), 2)
+
+    def test_choose_strategy(self):
+        self.assertEqual(self.rmanager._choose_strategy(1), 'pages')
+        self.rmanager._account_size = 1000
+        self.assertEqual(self.rmanager._choose_strategy(3), 'info')
+        self.assertEqual(self.rmanager._choose_strategy(10), 'pages')
+
+    def test_fetch_by_page_stops_when_all_found(self):
+        pages = {1: [{'id': str(x)} for x in range(0, 100)], 2: [{'id': str(x)} for x in range(100, 200)]}
+        requested = []
+        def request(method, endpoint, **kwargs):
+            requested.append(kwargs['params']['page'])
+            return FakeResponse(200, {'X-Total-Count': '1000'}, json.dumps(pages.get(kwargs['params']['page'], [])))
+
+        self.rmanager._request = request
+        torrents = self.rmanager._fetch_torrents_by_page({'5': {}, '150': {}})
+        self.assertEqual([x['id'] for x in torrents], ['5', '150'])
+        self.assertEqual(requested, [1, 2])
+        self.assertEqual(self.rmanager._account_size, 1000)
+
+        # A missing id reads to the end of the list so it can be reported as vanished.
+        requested.clear()
+        torrents = self.rmanager._fetch_torrents_by_page({'5': {}, 'gone': {}})
+        self.assertEqual([x['id'] for x in torrents], ['5'])
+        self.assertEqual(requested, [1, 2, 3])
+
+    def test_fetch_by_id(self):
+        def request(method, endpoint, **kwargs):
+            if endpoint.endswith('gone'):
+                return FakeResponse(404, text='{"error": "unknown_ressource"}')
+            return FakeResponse(200, text=json.dumps({'id': endpoint.split('/')[-1], 'status': 'downloading'}))
+
+        self.rmanager._request = request
+        torrents = self.rmanager._fetch_torrents_by_id({'a': {}, 'gone': {}})
+        self.assertEqual(torrents, [{'id': 'a', 'status': 'downloading'}])
+
+        # An error from RD must not look like every torrent vanished.
+        self.rmanager._request = lambda method, endpoint, **kwargs: FakeResponse(503)
+        self.assertIsNone(self.rmanager._fetch_torrents_by_id({'a': {}}))
+
+    def test_sample_estimates_eta(self):
+        file = {'id': 'a', 'status': 'downloading', 'progress': 50, 'speed': 100, 'bytes': 100000}
+        sample = self.rmanager._sample(file, None, 1000)
+        self.assertEqual(sample, ('a', 'downloading', 50, 100, 500, 1300, 1000))
+
+        # Without a speed the progress since the last sample is used.
+        file = {'id': 'a', 'status': 'downloading', 'progress': 60, 'speed': 0}
+        previous = {'progress': 50, 'sampled_at': 1000}
+        sample = self.rmanager._sample(file, previous, 1010)
+        self.assertEqual(sample[4], 40)
+        self.assertEqual(sample[5], 1050)
+
+        # Nothing to estimate from, so it is checked next cycle.
+        file = {'id': 'a', 'status': 'queued', 'progress': 0}
+        sample = self.rmanager._sample(file, None, 1000)
+        self.assertEqual(sample[4], None)
+        self.assertEqual(sample[5], 1000)
+
+    def test_only_due_torrents_are_checked(self):
+        state = StateManager('test.db')
+        state.add_many([('slow', 'path'), ('new', 'path')])
+        state.update_progress_many([('slow', 'downloading', 10, 5, 1000, time.time() + 100, time.time())])
+
+        requested = []
+        def request(method, endpoint, **kwargs):
+            requested.append(endpoint)
+            return FakeResponse(200, text=json.dumps({'id': 'new', 'status': 'downloading', 'progress': 5, 'speed': 10, 'bytes': 1000}))
+
+        self.rmanager._request = request
+        self.rmanager._account_size = 10000
+        self.assertTrue(self.rmanager.rd_listener(state))
+        self.assertEqual(requested, ['torrents/info/new'])
+        self.assertEqual(self.rmanager.last_cycle['watched'], 2)
+        self.assertEqual(self.rmanager.last_cycle['checked'], 1)
+
+        progress = state.get_all_with_progress()
+        self.assertEqual(progress['new']['progress'], 5)
+        self.assertEqual(progress['new']['eta'], 95)
+
+
+class FakeResponse():
+    """
+    Minimal stand in for a requests response.
+    """
+    def __init__(self, status_code: int, headers: dict = {}, text: str = ''):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
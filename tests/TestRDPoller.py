@@ -0,0 +1,131 @@
+from dlapi.managers import RDPoller, StateManager, LeaderElection
+from tests.helpers import remove_database
+import unittest
+import logging
+import time
+import sqlite3
+
+class FakeRDManager():
+    """
+    Stands in for the RDManager, returning a fixed result and cycle.
+    """
+    def __init__(self):
+        self.success = True
+        self.last_cycle = {}
+        self.calls = 0
+
+    def rd_listener(self, state_manager):
+        self.calls += 1
+        return self.success
+
+class LockedStateManager(StateManager):
+    """
+    StateManager whose reads fail as if the database were locked.
+    """
+    def get_content_version(self):
+        raise sqlite3.OperationalError("database is locked")
+
+    def recover_abandoned(self):
+        raise sqlite3.OperationalError("database is locked")
+
+class TestRDPoller(unittest.TestCase):
+    """
+    Test the adaptive scheduling of the RD listener.
+    """
+
+    def setUp(self):
+        self.rmanager = FakeRDManager()
+        self.state = StateManager("test.db")
+        self.poller = RDPoller(self.rmanager, self.state, logging.getLogger(), 15, 5, 100)
+
+    def tearDown(self):
+        remove_database()
+
+    def test_sleeps_when_nothing_watched(self):
+        self.rmanager.last_cycle = {'watched': 0}
+        self.assertIsNone(self.poller.poll())
+
+    def test_normal_and_fast_interval(self):
+        self.rmanager.last_cycle = {'watched': 3, 'finishing': 0}
+        self.assertEqual(self.poller.poll(), 15)
+
+        self.rmanager.last_cycle = {'watched': 3, 'finishing': 1}
+        self.assertEqual(self.poller.poll(), 5)
+
+    def test_backoff_on_failure(self):
+        self.rmanager.success = False
+        self.assertEqual(self.poller.poll(), 30)
+        self.assertEqual(self.poller.poll(), 60)
+        self.assertEqual(self.poller.poll(), 100)
+
+        # A successful poll resets the backoff.
+        self.rmanager.success = True
+        self.rmanager.last_cycle = {'watched': 1}
+        self.assertEqual(self.poller.poll(), 15)
+        self.rmanager.success = False
+        self.assertEqual(self.poller.poll(), 30)
+
+    def test_wakes_on_add(self):
+        self.rmanager.last_cycle = {'watched': 0}
+        self.poller.start()
+
+        # The first poll finds nothing and sleeps until content is added.
+        time.sleep(0.1)
+        self.assertEqual(self.rmanager.calls, 1)
+
+        self.state.add_content('id', 'path')
+        for i in range(0, 100):
+            if self.rmanager.calls == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.rmanager.calls, 2)
+
+    def test_only_leader_polls(self):
+        first = LeaderElection(self.state, 'scheduler', 30)
+        second = LeaderElection(self.state, 'scheduler', 30)
+        elected = []
+        second.register_callback(lambda: elected.append(second.holder))
+        self.assertTrue(first.renew())
+        self.assertFalse(second.renew())
+
+        poller = RDPoller(self.rmanager, self.state, logging.getLogger(), 15, 5, 100, second)
+        self.assertEqual(poller.poll(), 15)
+        self.assertEqual(self.rmanager.calls, 0)
+
+        # Once the leader steps down the other process takes over.
+        first.release()
+        self.assertTrue(second.renew())
+        self.assertEqual(elected, [second.holder])
+        self.rmanager.last_cycle = {'watched': 0}
+        self.assertEqual(poller.poll(), 15)
+        self.assertEqual(self.rmanager.calls, 1)
+
+        # While idle the listener only runs again once content is added, by any worker.
+        self.assertEqual(poller.poll(), 15)
+        self.assertEqual(self.rmanager.calls, 1)
+        StateManager("test.db").add_content('id', 'path')
+        self.assertEqual(poller.poll(), 15)
+        self.assertEqual(self.rmanager.calls, 2)
+
+    # A database error backs off instead of stopping the poller.
+    def test_database_error(self):
+        state = LockedStateManager("test.db")
+        leader = LeaderElection(state, 'scheduler', 30)
+        self.assertTrue(leader.renew())
+        poller = RDPoller(self.rmanager, state, logging.getLogger(), 15, 5, 100, leader)
+        self.assertEqual(poller.poll(), 30)
+        self.assertEqual(self.rmanager.calls, 0)
+
+        poller.poll = lambda: 1 / 0
+        poller.start()
+        time.sleep(0.1)
+        self.assertTrue(poller._thread.is_alive())
+        self.assertEqual(poller._failures, 2)
+
+    # A failing callback does not stop the process from becoming the leader.
+    def test_leader_callback_error(self):
+        state = LockedStateManager("test.db")
+        leader = LeaderElection(state, 'scheduler', 30)
+        leader.register_callback(state.recover_abandoned)
+        self.assertTrue(leader.renew())
+        self.assertTrue(leader.is_leader())
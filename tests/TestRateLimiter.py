@@ -0,0 +1,29 @@
+from dlapi.utilclasses import RateLimiter
+import unittest
+import time
+
+class TestRateLimiter(unittest.TestCase):
+    """
+    Test the sliding window RateLimiter.
+    """
+
+    def test_calls_under_limit_do_not_wait(self):
+        limiter = RateLimiter(5, 10)
+        start = time.monotonic()
+        for i in range(0, 5):
+            limiter.acquire()
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_calls_over_limit_wait_for_window(self):
+        limiter = RateLimiter(2, 0.2)
+        start = time.monotonic()
+        for i in range(0, 3):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_try_acquire_does_not_block(self):
+        limiter = RateLimiter(1, 10)
+        self.assertEqual(limiter.try_acquire(), 0)
+        wait = limiter.try_acquire()
+        self.assertGreater(wait, 9)
+        self.assertLessEqual(wait, 10)
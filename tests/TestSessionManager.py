@@ -1,8 +1,9 @@
-from dlapi.managers import SessionManager
+from dlapi.managers import SessionManager, SQLiteSessionStore, StateManager
 from dlapi.utilclasses import Session
 import unittest
 from datetime import date, timedelta
 import os
+from tests.helpers import remove_database
 
 class TestSessionManager(unittest.TestCase):
     """
@@ -117,3 +118,63 @@ class TestSessionManager(unittest.TestCase):
         self.assertTrue(mngr.authenticate_user('192.168.0.1', os.environ['API_KEY']))
         self.assertFalse(mngr.authenticate_user('192.168.0.1', os.environ['API_KEY'][:-1]))
 
+
+    # Test closing a session from another ip does nothing.
+    def test_close_session_wrong_ip(self):
+        mngr = SessionManager(10)
+        token = mngr.create_session('192.168.0.1')
+        self.assertFalse(mngr.close_session('192.168.0.2', token))
+        self.assertTrue(mngr.authenticate_user('192.168.0.1', token))
+        self.assertTrue(mngr.close_session('192.168.0.1', token))
+        self.assertEqual(mngr.get_sessions(), {})
+
+    # Test the expiry sweep stops at sessions that have not expired and skips closed ones.
+    def test_expire_sessions_after_close(self):
+        mngr = SessionManager(10)
+        for days in [-3, -2, 5]:
+            mngr._add_session('192.168.0.1', Session('192.168.0.1', 'token%d' % days, date.today() + timedelta(days=days)))
+        mngr.close_session('192.168.0.1', 'token-3')
+
+        mngr.remove_expired_sessions()
+        self.assertEqual([x.get_token() for x in mngr.get_sessions()['192.168.0.1']], ['token5'])
+        self.assertEqual(len(mngr._store._expiry_heap), 1)
+
+
+class TestSQLiteSessionManager(unittest.TestCase):
+    """
+    Test sessions shared between processes through the sqlite store.
+    """
+
+    def setUp(self):
+        self.state = StateManager("test.db")
+        self.mngr = SessionManager(10, SQLiteSessionStore(self.state))
+        self.other = SessionManager(10, SQLiteSessionStore(self.state))
+
+    def tearDown(self):
+        remove_database()
+
+    # A token created by one worker is accepted by another.
+    def test_shared_sessions(self):
+        token = self.mngr.create_session('192.168.0.1')
+        self.assertTrue(self.other.authenticate_user('192.168.0.1', token))
+        self.assertFalse(self.other.authenticate_user('192.168.0.2', token))
+        self.assertEqual([x.get_token() for x in self.other.get_sessions()['192.168.0.1']], [token])
+
+        self.assertTrue(self.other.close_session('192.168.0.1', token))
+        self.assertFalse(self.other.authenticate_user('192.168.0.1', token))
+        self.assertEqual(self.mngr.get_sessions(), {})
+
+    def test_expire_sessions(self):
+        self.mngr._add_session('192.168.0.1', Session('192.168.0.1', 'old', date.today() + timedelta(days=-1)))
+        self.mngr._add_session('192.168.0.1', Session('192.168.0.1', 'new', date.today() + timedelta(days=1)))
+        self.assertFalse(self.other.authenticate_user('192.168.0.1', 'old'))
+
+        self.other.remove_expired_sessions()
+        self.assertEqual([x.get_token() for x in self.mngr.get_sessions()['192.168.0.1']], ['new'])
+
+    # Tokens from the request JSON may be any type, which never authenticates.
+    def test_token_not_a_string(self):
+        for mngr in [SessionManager(10), self.mngr]:
+            for token in [5, None, ['token'], {'token': 1}]:
+                self.assertFalse(mngr.authenticate_user('192.168.0.1', token))
+                self.assertFalse(mngr.close_session('192.168.0.1', token))
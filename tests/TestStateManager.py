@@ -1,6 +1,8 @@
 from dlapi.managers import StateManager
 import unittest
-import os
+from tests.helpers import remove_database
+import threading
+from dlapi.utilclasses import SubmissionState, JobState
 
 class TestStateManager(unittest.TestCase):
     """
@@ -111,5 +113,177 @@ class TestStateManager(unittest.TestCase):
         inf = db.get_info('25435')
         self.assertEqual(inf, ['', '25'])
 
+    def test_add_many(self):
+        db = StateManager("test.db")
+        db.add_content('25235', 'i325', 'Original')
+        db.add_many([('25235', 'changed', 'Duplicate'), ('25255', '325', 'Title'), ('25435', '25')])
+
+        data = db.get_all()
+        self.assertEqual(data, [['25235', 'i325', 'Original'], ['25255', '325', 'Title'], ['25435', '25', '']])
+
+    def test_delete_many(self):
+        db = StateManager("test.db")
+        db.add_many([('25235', 'i325'), ('25255', '325'), ('25435', '25')])
+        db.delete_many(['25235', '25435', 'notwatched'])
+
+        ids = db.get_all_ids()
+        self.assertEqual(ids, ['25255'])
+
+        db.delete_many([])
+        self.assertEqual(len(db), 1)
+
+    def test_get_info_many(self):
+        db = StateManager("test.db")
+        db.add_many([('25235', 'i325', 'Title'), ('25255', '325'), ('25435', '25')])
+
+        info = db.get_info_many(['25235', '25435', 'notwatched'])
+        self.assertEqual(info, {'25235': ['Title', 'i325'], '25435': ['', '25']})
+        self.assertEqual(db.get_info_many([]), {})
+
+        # More ids than sqlite allows in one statement.
+        ids = [str(x) for x in range(StateManager.MAX_QUERY_PARAMETERS * 2 + 1)]
+        db.add_many([(x, 'path') for x in ids])
+        self.assertEqual(len(db.get_info_many(ids)), len(ids))
+
+    def test_save_cycle(self):
+        db = StateManager("test.db")
+        db.add_many([('done', 'i325'), ('busy', '325'), ('bad', '25')])
+        db.save_torrent_hashes([('badhash', 'bad')])
+        db.save_cycle([('busyhash', 'busy')], ['done'], ['bad'], ['bad'], [('busy', 'downloading', 50, 100, 30, 200, 100)])
+
+        self.assertEqual(db.get_all_ids(), ['busy'])
+        self.assertEqual(list(db.get_all_jobs()), ['done'])
+        self.assertEqual(db.get_torrent_id('busyhash'), 'busy')
+        self.assertEqual(db.get_torrent_id('badhash'), None)
+        self.assertEqual(list(db.get_all_progress()), ['busy'])
+
+    def test_progress(self):
+        db = StateManager("test.db")
+        db.add_many([('25235', 'i325', 'Title'), ('25255', '325')])
+        db.update_progress_many([('25235', 'downloading', 50, 100, 30, 200, 100), ('notwatched', 'downloading', 1, 1, 1, 1, 1)])
+
+        self.assertEqual(db.get_all_progress(), {'25235': {'status': 'downloading', 'progress': 50, 'speed': 100, 'eta': 30, 'next_check': 200, 'sampled_at': 100}})
+        self.assertEqual(db.get_all_with_progress(), {
+            '25235': {'title': 'Title', 'path': 'i325', 'status': 'downloading', 'progress': 50, 'speed': 100, 'eta': 30},
+            '25255': {'title': '', 'path': '325', 'status': None, 'progress': None, 'speed': None, 'eta': None}
+        })
+
+        # Progress goes away with the content.
+        db.delete_id('25235')
+        self.assertEqual(db.get_all_progress(), {})
+
+    def test_callback_on_add(self):
+        db = StateManager("test.db")
+        calls = []
+        db.register_callback(lambda: calls.append(len(db)))
+
+        db.add_content('25235', 'i325')
+        db.add_many([('25255', '325'), ('25435', '25')])
+        db.delete_id('25235')
+
+        # Callbacks run after the commit so they see the new rows.
+        self.assertEqual(calls, [1, 3])
+
+    def test_content_version(self):
+        db = StateManager("test.db")
+        self.assertEqual(db.get_content_version(), 0)
+        db.add_content('25235', 'i325')
+        db.add_many([('25255', '325')])
+
+        # Another process sees the change on its own connection.
+        self.assertEqual(StateManager("test.db").get_content_version(), 2)
+
+    def test_connection_reused_per_thread(self):
+        db = StateManager("test.db")
+        self.assertIs(db._get_connection(), db._get_connection())
+
+        # Another thread should get a connection of its own.
+        other = []
+        thread = threading.Thread(target=lambda: other.append(db._get_connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], db._get_connection())
+
+        db.close()
+        self.assertEqual(db.get_all(), [])
+
+    def test_download_jobs(self):
+        db = StateManager("test.db")
+        db.add_many([('25235', 'i325', 'Title'), ('25255', '325')])
+        db.enqueue_downloads(['25235'])
+
+        # The content moves over to the job table.
+        self.assertEqual(db.get_all_ids(), ['25255'])
+        self.assertEqual(db.count_open_jobs(), 1)
+
+        # A job can only be claimed once.
+        self.assertEqual(db.claim_jobs(5, 'a'), [('25235', 'i325', 0)])
+        self.assertEqual(db.claim_jobs(5, 'b'), [])
+
+        # Jobs are left with their owner while it holds a lease.
+        db.acquire_lease('process:a', 'a', 30)
+        db.recover_abandoned()
+        self.assertEqual(db.get_all_jobs()['25235']['state'], 'unrestricting')
+
+        # Claimed jobs left behind by a crash become pending again.
+        db.acquire_lease('process:a', 'a', -1)
+        db.recover_abandoned()
+        self.assertEqual(db.get_all_jobs()['25235']['state'], 'pending')
+        self.assertEqual(db.claim_jobs(5), [('25235', 'i325', 0)])
+
+    def test_finished_job_queued_again(self):
+        db = StateManager("test.db")
+        db.add_content('25235', 'i325')
+        db.enqueue_downloads(['25235'])
+        db.claim_jobs(5)
+        db.update_job('25235', JobState.FAILED, 5, error='error')
+
+        # Adding the content again retries it with the new path.
+        db.add_content('25235', 'new')
+        db.enqueue_downloads(['25235'])
+        job = db.get_all_jobs()['25235']
+        self.assertEqual((job['state'], job['path'], job['attempts'], job['last_error']), ('pending', 'new', 0, None))
+
+        # An open job is left alone.
+        db.add_content('25235', 'other')
+        db.enqueue_downloads(['25235'])
+        self.assertEqual(db.get_all_jobs()['25235']['path'], 'new')
+
+    def test_submissions(self):
+        db = StateManager("test.db")
+        id = db.add_submission()
+        self.assertEqual(db.get_submission(id)['state'], 'pending')
+        self.assertEqual(db.get_submission('missing'), None)
+
+        db.finish_submission(id, SubmissionState.DONE, {'id': '25235'})
+        self.assertEqual(db.get_submission(id)['result'], {'id': '25235'})
+
+        # Pending submissions only fail once their owner is gone.
+        db.acquire_lease('process:a', 'a', 30)
+        other = db.add_submission('a')
+        orphan = db.add_submission()
+        db.recover_abandoned()
+        self.assertEqual(db.get_submission(other)['state'], 'pending')
+        self.assertEqual(db.get_submission(orphan)['state'], 'failed')
+
+        db.release_lease('process:a', 'a')
+        db.recover_abandoned()
+        self.assertEqual(db.get_submission(other)['state'], 'failed')
+        self.assertEqual(db.get_submission(id)['state'], 'done')
+
+    def test_leases(self):
+        db = StateManager("test.db")
+        self.assertTrue(db.acquire_lease('scheduler', 'a', 30))
+        self.assertFalse(db.acquire_lease('scheduler', 'b', 30))
+
+        # The holder renews its own lease, and an expired lease can be taken.
+        self.assertTrue(db.acquire_lease('scheduler', 'a', -1))
+        self.assertTrue(db.acquire_lease('scheduler', 'b', 30))
+
+        db.release_lease('scheduler', 'a')
+        self.assertFalse(db.acquire_lease('scheduler', 'a', 30))
+        db.release_lease('scheduler', 'b')
+        self.assertTrue(db.acquire_lease('scheduler', 'a', 30))
+
     def tearDown(self):
-        os.remove("test.db")
\ No newline at end of file
+        remove_database()
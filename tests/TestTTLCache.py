@@ -0,0 +1,34 @@
+from dlapi.utilclasses import TTLCache
+import unittest
+import time
+
+class TestTTLCache(unittest.TestCase):
+    """
+    Test the LRU and TTL cache.
+    """
+
+    def test_get_and_set(self):
+        cache = TTLCache(5, 10)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_entries_expire(self):
+        cache = TTLCache(5, 0.05)
+        cache.set('a', 1)
+        cache.set('b', 2, time.time() + 10)
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_least_recently_used_dropped(self):
+        cache = TTLCache(2, 10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
@@ -0,0 +1,43 @@
+import concurrent.futures
+import os
+import gc
+
+def remove_database(path: str = "test.db"):
+    """
+    Delete a test database with its WAL files. Pooled connections are closed first so the
+    WAL files are cleaned up with the database.
+    """
+    gc.collect()
+    for f in [path, path + "-wal", path + "-shm"]:
+        if os.path.exists(f):
+            os.remove(f)
+
+def handed_off(result: dict) -> concurrent.futures.Future:
+    """
+    Get a finished future with the given JDownloader result.
+    """
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+class FakeJDownloadManager():
+    """
+    Records the downloads it is given instead of sending them to JDownloader.
+    Attributes:
+        downloads: Every (urls, path) given to download or submit
+        calls: The entries of each download_many call
+    """
+    def __init__(self):
+        self.downloads = []
+        self.calls = []
+
+    def download(self, urls: list, path: str) -> dict:
+        self.downloads.append((urls, path))
+        return {'id': len(self.downloads)}
+
+    def download_many(self, entries: list) -> dict:
+        self.calls.append(entries)
+        return {'id': len(self.calls)}
+
+    def submit(self, urls: list, path: str) -> concurrent.futures.Future:
+        return handed_off(self.download(urls, path))